@@ -0,0 +1,53 @@
+"""multi resolution rollups of the sensor entries and their watermarks
+
+Revision ID: 9b1e4f7c2a80
+Revises: c4a7d2e9f301
+Create Date: 2024-03-23 14:26:09.381527
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b1e4f7c2a80'
+down_revision: Union[str, None] = 'c4a7d2e9f301'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ROLLUP_TABLES = ('rollup_1m', 'rollup_1h', 'rollup_1d')
+
+
+def upgrade() -> None:
+    #filled from the first entry on by the background compaction, see src/rollups.py
+    for table in ROLLUP_TABLES:
+        op.create_table(table,
+            sa.Column('sensor_id', sa.Integer(), primary_key=True),
+            sa.Column('plant_sensor', sa.Boolean(), primary_key=True),
+            sa.Column('bucket', sa.DateTime(), primary_key=True),
+            sa.Column('entry_count', sa.Integer(), nullable=False),
+            sa.Column('temperature_avg', sa.Float(), nullable=False),
+            sa.Column('temperature_min', sa.Float(), nullable=False),
+            sa.Column('temperature_max', sa.Float(), nullable=False),
+            sa.Column('humidity_avg', sa.Float(), nullable=False),
+            sa.Column('humidity_min', sa.Float(), nullable=False),
+            sa.Column('humidity_max', sa.Float(), nullable=False),
+            sa.Column('wetness_avg', sa.Float(), nullable=True),
+            sa.Column('wetness_min', sa.Float(), nullable=True),
+            sa.Column('wetness_max', sa.Float(), nullable=True),
+        )
+        #the next resolution and the retention select the buckets by time for all sensors
+        op.create_index(f'ix_{table}_bucket', table, ['bucket'])
+    op.create_table('rollup_watermark',
+        sa.Column('resolution', sa.String(), primary_key=True),
+        sa.Column('watermark', sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('rollup_watermark')
+    for table in reversed(ROLLUP_TABLES):
+        op.drop_index(f'ix_{table}_bucket', table_name=table)
+        op.drop_table(table)
@@ -0,0 +1,36 @@
+"""measurement chunks for the cold storage of closed windows of entries
+
+Revision ID: a93d5e17c08b
+Revises: f3a81c6d2b97
+Create Date: 2024-04-13 10:22:08.731154
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a93d5e17c08b'
+down_revision: Union[str, None] = 'f3a81c6d2b97'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    #filled by the archiver (src/cold_storage.py), the entries it archives are removed from the entry tables
+    op.create_table('measurement_chunk',
+        sa.Column('sensor_id', sa.Integer(), primary_key=True),
+        sa.Column('plant_sensor', sa.Boolean(), primary_key=True),
+        sa.Column('window_start', sa.DateTime(), primary_key=True),
+        sa.Column('first_timestamp', sa.DateTime(), nullable=False),
+        sa.Column('last_timestamp', sa.DateTime(), nullable=False),
+        sa.Column('entry_count', sa.Integer(), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    #the archived entries are lost unless they are restored into the entry tables first
+    op.drop_table('measurement_chunk')
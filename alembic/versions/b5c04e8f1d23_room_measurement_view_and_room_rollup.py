@@ -0,0 +1,56 @@
+"""view of the measurements of both entry tables resolved to their room, and its hourly room rollup
+
+Revision ID: b5c04e8f1d23
+Revises: a93d5e17c08b
+Create Date: 2024-04-20 15:37:44.092318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5c04e8f1d23'
+down_revision: Union[str, None] = 'a93d5e17c08b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    #same definition as room_measurement_select in src/orm.py
+    op.execute("""
+        CREATE OR REPLACE VIEW room_measurement AS
+        SELECT sensor.room_id, humidity_temperature_entry.sensor_id, false AS plant_sensor,
+               humidity_temperature_entry.entry_timestamp, humidity_temperature_entry.temperature,
+               humidity_temperature_entry.humidity, NULL::double precision AS wetness
+        FROM humidity_temperature_entry JOIN sensor ON humidity_temperature_entry.sensor_id = sensor.serial_number
+        WHERE sensor.room_id IS NOT NULL
+        UNION ALL
+        SELECT plant.room_id, plant_sensor_entry.sensor_id, true AS plant_sensor,
+               plant_sensor_entry.entry_timestamp, plant_sensor_entry.temperature,
+               plant_sensor_entry.humidity, plant_sensor_entry.wetness
+        FROM plant_sensor_entry JOIN plant_sensor ON plant_sensor_entry.sensor_id = plant_sensor.serial_number
+        JOIN plant ON plant_sensor.plant_id = plant.id
+        WHERE plant.room_id IS NOT NULL
+    """)
+    #filled from the first measurement on by the next rollup compaction, see src/room_stats.py
+    op.create_table('room_rollup_1h',
+        sa.Column('room_id', sa.Integer(), sa.ForeignKey('room.id'), primary_key=True),
+        sa.Column('bucket', sa.DateTime(), primary_key=True),
+        sa.Column('entry_count', sa.Integer(), nullable=False),
+        sa.Column('temperature_sum', sa.Float(), nullable=False),
+        sa.Column('temperature_min', sa.Float(), nullable=False),
+        sa.Column('temperature_max', sa.Float(), nullable=False),
+        sa.Column('humidity_sum', sa.Float(), nullable=False),
+        sa.Column('humidity_min', sa.Float(), nullable=False),
+        sa.Column('humidity_max', sa.Float(), nullable=False),
+        sa.Column('last_timestamp', sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('room_rollup_1h')
+    op.execute("DELETE FROM rollup_watermark WHERE resolution = 'room_1h'")
+    op.execute("DROP VIEW IF EXISTS room_measurement")
@@ -0,0 +1,57 @@
+"""running temperature aggregates per sensor and room
+
+Revision ID: c4a7d2e9f301
+Revises: b1e436844f10
+Create Date: 2024-03-16 10:12:44.512301
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a7d2e9f301'
+down_revision: Union[str, None] = 'b1e436844f10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('sensor_aggregate',
+        sa.Column('sensor_id', sa.Integer(), sa.ForeignKey('sensor.serial_number'), primary_key=True),
+        sa.Column('entry_count', sa.Integer(), nullable=False),
+        sa.Column('temperature_sum', sa.Float(), nullable=False),
+        sa.Column('temperature_min', sa.Float(), nullable=True),
+        sa.Column('temperature_max', sa.Float(), nullable=True),
+        sa.Column('last_timestamp', sa.DateTime(), nullable=True),
+    )
+    op.create_table('room_aggregate',
+        sa.Column('room_id', sa.Integer(), sa.ForeignKey('room.id'), primary_key=True),
+        sa.Column('entry_count', sa.Integer(), nullable=False),
+        sa.Column('temperature_sum', sa.Float(), nullable=False),
+        sa.Column('temperature_min', sa.Float(), nullable=True),
+        sa.Column('temperature_max', sa.Float(), nullable=True),
+        sa.Column('last_timestamp', sa.DateTime(), nullable=True),
+    )
+
+    #backfill from the existing history, later inserts are added by the repository
+    op.execute("""
+        INSERT INTO sensor_aggregate
+        SELECT sensor_id, COUNT(*), SUM(temperature), MIN(temperature), MAX(temperature), MAX(entry_timestamp)
+        FROM humidity_temperature_entry
+        GROUP BY sensor_id
+    """)
+    op.execute("""
+        INSERT INTO room_aggregate
+        SELECT sensor.room_id, COUNT(*), SUM(temperature), MIN(temperature), MAX(temperature), MAX(entry_timestamp)
+        FROM humidity_temperature_entry JOIN sensor ON humidity_temperature_entry.sensor_id = sensor.serial_number
+        WHERE sensor.room_id IS NOT NULL
+        GROUP BY sensor.room_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('room_aggregate')
+    op.drop_table('sensor_aggregate')
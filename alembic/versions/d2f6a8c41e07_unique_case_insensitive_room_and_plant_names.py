@@ -0,0 +1,35 @@
+"""unique case insensitive room and plant names
+
+Revision ID: d2f6a8c41e07
+Revises: b5c04e8f1d23
+Create Date: 2024-04-24 09:12:51.604127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2f6a8c41e07'
+down_revision: Union[str, None] = 'b5c04e8f1d23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    #the lower(name) indexes become the conflict target of the provisioning inserts, so "Bedroom" and
+    #"bedroom" registered concurrently cannot both be inserted. Fails if such duplicates already exist,
+    #they have to be merged by hand first
+    op.drop_index('ix_room_lower_name', table_name='room')
+    op.drop_index('ix_plant_lower_name', table_name='plant')
+    op.create_index('ix_room_lower_name', 'room', [sa.text('lower(name)')], unique=True)
+    op.create_index('ix_plant_lower_name', 'plant', [sa.text('lower(name)')], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_plant_lower_name', table_name='plant')
+    op.drop_index('ix_room_lower_name', table_name='room')
+    op.create_index('ix_room_lower_name', 'room', [sa.text('lower(name)')])
+    op.create_index('ix_plant_lower_name', 'plant', [sa.text('lower(name)')])
@@ -0,0 +1,44 @@
+"""late entry queue of the rollups and time range indexes of the entry tables
+
+Revision ID: e4c19b7a6d52
+Revises: d2f6a8c41e07
+Create Date: 2024-05-02 16:41:27.218934
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4c19b7a6d52'
+down_revision: Union[str, None] = 'd2f6a8c41e07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ENTRY_TABLES = ('humidity_temperature_entry', 'plant_sensor_entry')
+
+
+def upgrade() -> None:
+    #entries inserted in a minute the compaction may already have read, merged by the next
+    #compaction pass instead of under a lock of the watermarks, see src/rollups.py
+    op.create_table('late_entry',
+        sa.Column('rollup', sa.String(), primary_key=True),
+        sa.Column('entry_timestamp', sa.DateTime(), primary_key=True),
+        sa.Column('plant_sensor', sa.Boolean(), primary_key=True),
+        sa.Column('sensor_id', sa.Integer(), primary_key=True),
+        sa.Column('temperature', sa.Float(), nullable=False),
+        sa.Column('humidity', sa.Float(), nullable=False),
+        sa.Column('wetness', sa.Float(), nullable=True),
+    )
+    #the compaction, the archiving and the exports select the entries by time for all sensors,
+    #created on the partitioned tables the index is created on every partition
+    for table in ENTRY_TABLES:
+        op.create_index(f'ix_{table}_entry_timestamp', table, ['entry_timestamp'], postgresql_using='brin')
+
+
+def downgrade() -> None:
+    for table in reversed(ENTRY_TABLES):
+        op.drop_index(f'ix_{table}_entry_timestamp', table_name=table)
+    op.drop_table('late_entry')
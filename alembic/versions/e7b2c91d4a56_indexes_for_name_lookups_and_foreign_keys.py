@@ -0,0 +1,36 @@
+"""indexes for the case insensitive name lookups and the foreign keys
+
+Revision ID: e7b2c91d4a56
+Revises: 9b1e4f7c2a80
+Create Date: 2024-03-30 11:04:17.208644
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7b2c91d4a56'
+down_revision: Union[str, None] = '9b1e4f7c2a80'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    #rooms and plants are looked up with lower(name) = ..., which the unique constraints cannot serve
+    op.create_index('ix_room_lower_name', 'room', [sa.text('lower(name)')])
+    op.create_index('ix_plant_lower_name', 'plant', [sa.text('lower(name)')])
+    #postgres does not index the referencing side of a foreign key
+    op.create_index('ix_sensor_room_id', 'sensor', ['room_id'])
+    op.create_index('ix_plant_room_id', 'plant', ['room_id'])
+    op.create_index('ix_plant_sensor_plant_id', 'plant_sensor', ['plant_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_plant_sensor_plant_id', table_name='plant_sensor')
+    op.drop_index('ix_plant_room_id', table_name='plant')
+    op.drop_index('ix_sensor_room_id', table_name='sensor')
+    op.drop_index('ix_plant_lower_name', table_name='plant')
+    op.drop_index('ix_room_lower_name', table_name='room')
@@ -0,0 +1,78 @@
+"""partition the entry tables by month
+
+Revision ID: f3a81c6d2b97
+Revises: e7b2c91d4a56
+Create Date: 2024-04-06 09:41:52.377015
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a81c6d2b97'
+down_revision: Union[str, None] = 'e7b2c91d4a56'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+#entry table -> (sensor table it references, measurement columns)
+ENTRY_TABLES = {
+    'humidity_temperature_entry': ('sensor', ['temperature', 'humidity']),
+    'plant_sensor_entry': ('plant_sensor', ['temperature', 'humidity', 'wetness']),
+}
+#months created ahead of the current one, later ones are created by the partition maintenance job
+MONTHS_AHEAD = 3
+
+
+def entry_columns(sensor_table, measurements):
+    return [
+        sa.Column('sensor_id', sa.Integer(), sa.ForeignKey(f'{sensor_table}.serial_number'), nullable=False),
+        sa.Column('entry_timestamp', sa.DateTime(), nullable=False),
+        *[sa.Column(measurement, sa.Float(), nullable=False) for measurement in measurements],
+        sa.PrimaryKeyConstraint('sensor_id', 'entry_timestamp'),
+    ]
+
+
+def upgrade() -> None:
+    #the rows are copied into the partitioned tables, ingest should be stopped (or spooled) meanwhile
+    for table, (sensor_table, measurements) in ENTRY_TABLES.items():
+        columns = ', '.join(['sensor_id', 'entry_timestamp', *measurements])
+        op.rename_table(table, f'{table}_unpartitioned')
+        op.execute(f'ALTER INDEX IF EXISTS {table}_pkey RENAME TO {table}_unpartitioned_pkey')
+        op.create_table(table, *entry_columns(sensor_table, measurements),
+                        postgresql_partition_by='RANGE (entry_timestamp)')
+
+        #one partition per month from the first reading to MONTHS_AHEAD months from now,
+        #named like src/partitions.py names them
+        op.execute(f"""
+            DO $$
+            DECLARE month timestamp;
+            BEGIN
+                FOR month IN SELECT generate_series(
+                    date_trunc('month', coalesce((SELECT min(entry_timestamp) FROM {table}_unpartitioned), now() at time zone 'utc')),
+                    date_trunc('month', now() at time zone 'utc') + interval '{MONTHS_AHEAD} months',
+                    interval '1 month')
+                LOOP
+                    EXECUTE format('CREATE TABLE %I PARTITION OF {table} FOR VALUES FROM (%L) TO (%L)',
+                                   '{table}_' || to_char(month, '"y"YYYY"m"MM'), month, month + interval '1 month');
+                END LOOP;
+            END $$
+        """)
+        op.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+
+        op.execute(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_unpartitioned')
+        op.drop_table(f'{table}_unpartitioned')
+
+
+def downgrade() -> None:
+    for table, (sensor_table, measurements) in ENTRY_TABLES.items():
+        columns = ', '.join(['sensor_id', 'entry_timestamp', *measurements])
+        op.rename_table(table, f'{table}_partitioned')
+        op.execute(f'ALTER INDEX IF EXISTS {table}_pkey RENAME TO {table}_partitioned_pkey')
+        op.create_table(table, *entry_columns(sensor_table, measurements))
+        op.execute(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_partitioned')
+        #drops the partitions with it
+        op.drop_table(f'{table}_partitioned')
@@ -1,12 +1,34 @@
 import os
 from contextlib import asynccontextmanager
 import ipaddress
-from fastapi import FastAPI, Request, HTTPException, status, Response
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, HTTPException, status, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from dotenv import load_dotenv
 from src import models, orm
 from src.repository.sqlmodel_repository import *
-from src.helper_functions import parse_measurement
+from src.helper_functions import parse_measurement, parse_sensor_rows, validate_items, merge_results, database_unavailable
+from src.repository.async_sqlmodel_repository import AsyncSQLModelRepository
+from src.ingest_buffer import IngestBuffer
+from src.scheduler import PeriodicJob
+from src.history import MAX_PAGE_SIZE, entry_cursor, format_cursor, parse_cursor
+from src.export import EXPORT_FORMATS, format_chunks, aformat_chunks
+from src.latest import LatestReadings, reading_from_entry
+from src.live_feed import LiveFeed, format_event, KEEPALIVE_EVENT
+from src.stream_ingest import MeasurementStream, receive_frame
+from src.binary_frame import decode_frame
+from src.udp_ingest import UDPIngestProtocol
+from src.spool import Spool
+from src.retention import RetentionEngine, parse_retention, parse_duration, READING_KEYS
+from src.cold_storage import Archiver
+from src.ip_filter import IPFilter, IPFilterMiddleware
+from src.metrics import Metrics, MetricsMiddleware
+from src.slow_query import SlowQueryLog, RequestScopeMiddleware
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import create_async_engine
+import asyncio
+import inspect
+from functools import partial
+from typing import Any, Dict, List
 #error handling packages
 from sqlalchemy.exc import IntegrityError, OperationalError, DataError, ProgrammingError
 
@@ -26,6 +48,11 @@ ALLOWED_NETWORKS = [
     ipaddress.ip_network(os.getenv("LOCAL_IP_MASK")),
     ipaddress.ip_network("127.0.0.1/32")  # /32 specifies a single IP address
 ]
+#additional networks can be allowed with a comma separated list in ALLOWED_NETWORKS_EXTRA
+ALLOWED_NETWORKS += [ipaddress.ip_network(network.strip())
+                     for network in os.getenv("ALLOWED_NETWORKS_EXTRA", "").split(",") if network.strip()]
+#decisions are cached for the last IP_FILTER_CACHE_SIZE client addresses
+ip_filter = IPFilter(ALLOWED_NETWORKS, cache_size = int(os.getenv("IP_FILTER_CACHE_SIZE", 4096)))
 
 #database connection string for  sqlAlchemy
 DATABASE_URL = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}"
@@ -35,38 +62,231 @@ engine = create_engine(DATABASE_URL)
 
 
 #define repository, here we are using SQLModel
-repo = SQLModel_repository(engine)
+#set REPOSITORY_BACKEND=async to use the asyncio driver so requests overlap their database I/O
+REPOSITORY_BACKEND = os.getenv("REPOSITORY_BACKEND", "sync").lower()
+#set LEAN_WRITES=true to skip reading single measurements back after they are written
+LEAN_WRITES = os.getenv("LEAN_WRITES", "false").lower() == "true"
+#a minute is compacted into the rollups ROLLUP_GRACE_SECONDS after it ends, the readings arriving later
+#(spool replay, gateway batches) are queued by their insert and merged by the next compaction
+ROLLUP_GRACE = timedelta(seconds = float(os.getenv("ROLLUP_GRACE_SECONDS", 60)))
+if REPOSITORY_BACKEND == "async":
+    ASYNC_DATABASE_URL = f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{database}"
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
+    repo = AsyncSQLModelRepository(async_engine, lean_writes = LEAN_WRITES, rollup_grace = ROLLUP_GRACE)
+else:
+    async_engine = None
+    repo = SQLModel_repository(engine, lean_writes = LEAN_WRITES, rollup_grace = ROLLUP_GRACE)
+
+#prometheus metrics served on /metrics: request latency by route, ingest rate,
+#connection pools and statement timings of the engines
+metrics = Metrics()
+metrics.instrument_engine("sync", engine)
+if async_engine is not None:
+    metrics.instrument_engine("async", async_engine.sync_engine)
+
+#optional slow query log, disabled unless SLOW_QUERY_THRESHOLD_MS is set. The last SLOW_QUERY_LOG_SIZE
+#statements over the threshold are kept with the route that ran them, the plans of the
+#SLOW_QUERY_EXPLAIN_WORST slowest statements can be captured from /api/slow-queries
+SLOW_QUERY_THRESHOLD_MS = os.getenv("SLOW_QUERY_THRESHOLD_MS")
+slow_query_log = SlowQueryLog(
+    float(SLOW_QUERY_THRESHOLD_MS),
+    size = int(os.getenv("SLOW_QUERY_LOG_SIZE", 100)),
+    worst_size = int(os.getenv("SLOW_QUERY_EXPLAIN_WORST", 5))
+) if SLOW_QUERY_THRESHOLD_MS else None
+if slow_query_log is not None:
+    slow_query_log.instrument_engine(engine if async_engine is None else async_engine.sync_engine)
+
+
+async def call_repo(method, *args):
+    '''
+    Call a repository method, awaiting it when the repository is the async one
+    '''
+    result = method(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+#optional on-disk spool, disabled unless SPOOL_DIRECTORY is set. Readings that cannot be written
+#because the database is unavailable are appended to it and replayed in the background.
+#SPOOL_FSYNC is always (every append), segment (when a segment is sealed) or never
+SPOOL_DIRECTORY = os.getenv("SPOOL_DIRECTORY")
+spool = Spool(
+    SPOOL_DIRECTORY,
+    segment_bytes = int(os.getenv("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024)),
+    fsync = os.getenv("SPOOL_FSYNC", "always").lower()
+) if SPOOL_DIRECTORY else None
+SPOOL_REPLAY_INTERVAL = float(os.getenv("SPOOL_REPLAY_INTERVAL", 5))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", 5000))
+
+#last reading of every sensor, kept in memory for the latest endpoints
+latest_readings = LatestReadings()
+
+#fan-out of the new readings to the live feed subscribers, each one buffers at most
+#LIVE_FEED_QUEUE_SIZE readings before the oldest are dropped
+live_feed = LiveFeed(queue_size = int(os.getenv("LIVE_FEED_QUEUE_SIZE", 100)))
+LIVE_FEED_KEEPALIVE_SECONDS = float(os.getenv("LIVE_FEED_KEEPALIVE_SECONDS", 15))
+
+#readings streamed over the websocket are written every STREAM_FLUSH_ROWS readings
+#or STREAM_FLUSH_INTERVAL_MS after the first pending one, whichever comes first
+STREAM_FLUSH_ROWS = int(os.getenv("STREAM_FLUSH_ROWS", 500))
+STREAM_FLUSH_INTERVAL_MS = int(os.getenv("STREAM_FLUSH_INTERVAL_MS", 200))
+
+
+def record_readings(sensor_entries):
+    '''
+    Update the latest readings with the entries that were just ingested and publish them to the live feed
+    '''
+    readings = [reading_from_entry(sensor_entry) for sensor_entry in sensor_entries]
+    metrics.ingest_rows.add(len(readings))
+    for reading in readings:
+        latest_readings.store(reading)
+    live_feed.publish({**reading,
+                       "room": latest_readings.sensor_rooms.get(reading["sensor_id"]),
+                       "plant": latest_readings.sensor_plants.get(reading["sensor_id"])} for reading in readings)
+
+
+def create_ingest_buffer() -> IngestBuffer:
+    return IngestBuffer(
+        repo,
+        max_size = int(os.getenv("INGEST_BUFFER_MAX_SIZE", 10000)),
+        flush_rows = int(os.getenv("INGEST_FLUSH_ROWS", 500)),
+        flush_interval_ms = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", 200)),
+        spool = spool,
+        #the readings are recorded for the latest and live endpoints once the flush stored them
+        on_flushed = record_readings
+    )
+
+#optional write-behind mode, measurements are queued and written to the database in batches
+INGEST_BUFFERED = os.getenv("INGEST_BUFFERED", "false").lower() == "true"
+ingest_buffer = create_ingest_buffer() if INGEST_BUFFERED else None
+
+#optional UDP listener for fire-and-forget sensors, disabled unless UDP_INGEST_PORT is set.
+#Datagrams are always written through a buffer, the one of the write-behind mode when it is enabled
+UDP_INGEST_PORT = int(os.getenv("UDP_INGEST_PORT", 0))
+UDP_INGEST_HOST = os.getenv("UDP_INGEST_HOST", "0.0.0.0")
+udp_buffer = (ingest_buffer or create_ingest_buffer()) if UDP_INGEST_PORT else None
+udp_protocol = None
+
+
+async def write_entries(sensor_entries) -> List[models.EntryResult]:
+    '''
+    Batch write shared by the ingest endpoints, the readings stored are recorded for the latest and live endpoints.
+    When the database is unavailable the readings are spooled (if the spool is enabled).
+    '''
+    try:
+        entry_results = await call_repo(repo.add_data_entries, sensor_entries)
+    except Exception as e:
+        if spool is None or not database_unavailable(e):
+            raise
+        logger.error(f'database unavailable, spooling {len(sensor_entries)} entries')
+        logger.error(e)
+        await asyncio.to_thread(spool.append, sensor_entries)
+        entry_results = [models.EntryResult(index = index, sensor_id = sensor_entry.sensor_id, status = models.ENTRY_SPOOLED)
+                         for index, sensor_entry in enumerate(sensor_entries)]
+    record_readings([sensor_entry for sensor_entry, entry_result in zip(sensor_entries, entry_results)
+                     if entry_result.status in (models.ENTRY_CREATED, models.ENTRY_SPOOLED)])
+    return entry_results
+
+
+async def replay_spool() -> int:
+    #readings were already recorded for the latest and live endpoints when they were spooled
+    return await spool.replay(lambda sensor_entries: call_repo(repo.add_data_entries, sensor_entries), SPOOL_REPLAY_BATCH)
+
+#background maintenance jobs, an interval of 0 disables a job
+jobs = []
+#the rollups are compacted every ROLLUP_COMPACTION_INTERVAL seconds, see ROLLUP_GRACE above
+ROLLUP_COMPACTION_INTERVAL = float(os.getenv("ROLLUP_COMPACTION_INTERVAL", 60))
+if ROLLUP_COMPACTION_INTERVAL > 0:
+    jobs.append(PeriodicJob("rollup_compaction", repo.compact_rollups, ROLLUP_COMPACTION_INTERVAL))
+#monthly partitions of the entry tables are created PARTITION_MONTHS_AHEAD months ahead (postgres,
+#once the tables are partitioned), checked at startup and every PARTITION_MAINTENANCE_INTERVAL seconds
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 6 * 3600))
+if PARTITION_MAINTENANCE_INTERVAL > 0:
+    jobs.append(PeriodicJob("partition_maintenance", partial(repo.maintain_partitions, months_ahead = PARTITION_MONTHS_AHEAD),
+                            PARTITION_MAINTENANCE_INTERVAL))
+#optional retention, disabled unless RETENTION_POLICY is set, e.g. "raw=30d,1h=2y" keeps the raw
+#readings 30 days and the hourly rollups 2 years. Expired rows are deleted every RETENTION_INTERVAL
+#seconds in chunks of RETENTION_CHUNK_SIZE rows, at most RETENTION_MAX_CHUNKS chunks per run (0 for no limit)
+RETENTION_POLICY = os.getenv("RETENTION_POLICY")
+retention = RetentionEngine(
+    parse_retention(RETENTION_POLICY),
+    chunk_size = int(os.getenv("RETENTION_CHUNK_SIZE", 5000)),
+    max_chunks = int(os.getenv("RETENTION_MAX_CHUNKS", 100)) or None
+) if RETENTION_POLICY else None
+retention_job = PeriodicJob("retention", partial(repo.apply_retention, retention),
+                            float(os.getenv("RETENTION_INTERVAL", 3600))) if retention is not None else None
+if retention_job is not None:
+    jobs.append(retention_job)
+#optional cold storage, disabled unless ARCHIVE_AFTER is set, e.g. "30d" moves the entries older than
+#30 days (and compacted into the rollups) into compressed chunks of one ARCHIVE_WINDOW per sensor,
+#every ARCHIVE_INTERVAL seconds, at most ARCHIVE_MAX_WINDOWS windows per run (0 for no limit)
+ARCHIVE_AFTER = os.getenv("ARCHIVE_AFTER")
+archiver = Archiver(
+    parse_duration(ARCHIVE_AFTER),
+    window = parse_duration(os.getenv("ARCHIVE_WINDOW", "1d")),
+    max_windows = int(os.getenv("ARCHIVE_MAX_WINDOWS", 1000)) or None
+) if ARCHIVE_AFTER else None
+archive_job = PeriodicJob("archive", partial(repo.archive_measurements, archiver),
+                          float(os.getenv("ARCHIVE_INTERVAL", 3600))) if archiver is not None else None
+if archive_job is not None:
+    jobs.append(archive_job)
+#readings older than the archive or retention horizon of the readings are rejected, their window may
+#already be archived or deleted and they would be counted twice
+write_horizons = ([archiver.archive_after] if archiver is not None else []) + \
+    [retention.policy[key] for key in READING_KEYS if retention is not None and key in retention.policy]
+repo.write_horizon = min(write_horizons) if write_horizons else None
+spool_job = PeriodicJob("spool_replay", replay_spool, SPOOL_REPLAY_INTERVAL) if spool is not None else None
+if spool_job is not None:
+    jobs.append(spool_job)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    SQLModel.metadata.create_all(engine)
+    if async_engine is not None:
+        async with async_engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+    else:
+        SQLModel.metadata.create_all(engine)
+    await call_repo(repo.maintain_partitions, PARTITION_MONTHS_AHEAD)
+    latest_readings.warm(await call_repo(repo.get_latest_readings), await call_repo(repo.get_room_sensors))
+    if ingest_buffer is not None:
+        ingest_buffer.start()
+    udp_transport = None
+    if udp_buffer is not None:
+        global udp_protocol
+        if udp_buffer is not ingest_buffer:
+            udp_buffer.start()
+        udp_protocol = UDPIngestProtocol(udp_buffer, ip_filter.allowed)
+        udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: udp_protocol, local_addr = (UDP_INGEST_HOST, UDP_INGEST_PORT))
+        logger.info(f'listening for measurement datagrams on {UDP_INGEST_HOST}:{UDP_INGEST_PORT}')
+    for job in jobs:
+        job.start()
     yield
+    for job in jobs:
+        await job.stop()
+    if udp_transport is not None:
+        udp_transport.close()
+    #write everything still queued before shutting down
+    if ingest_buffer is not None:
+        await ingest_buffer.stop()
+    if udp_buffer is not None and udp_buffer is not ingest_buffer:
+        await udp_buffer.stop()
+    if spool is not None:
+        spool.close()
     
 
 app = FastAPI(lifespan= lifespan)
 
 # This middleware is not strictly necessary if ran as a container in a private network
-# with firewall enabled but this is just an extra layer of safety
-@app.middleware("http")
-async def ip_filter_middleware(request: Request, call_next):
-    #in case the app runs behind a reverse proxy, get the original IP
-    client_ip = request.headers.get("x-forwarded-for")
-
-    if client_ip:
-        # The header can contain multiple IP addresses delimited by commas
-        # due to successive proxies. The first one is the original IP.
-        client_ip = client_ip.split(",")[0].strip()
-    else:
-        # Fall back to the direct connection's IP address if no forwarding info
-        client_ip = request.client.host
-    client_ip_address = ipaddress.ip_address(client_ip)
-    if not any(client_ip_address in network for network in ALLOWED_NETWORKS):
-        data = {
-            'message': f'IP {request.client.host} is not allowed to access this resource.'
-        }
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=data)
-    response = await call_next(request)
-    return response
+# with firewall enabled but this is just an extra layer of safety.
+# It is a plain ASGI middleware so it also covers the websockets
+if slow_query_log is not None:
+    #gives the slow query log the route of the request running a statement
+    app.add_middleware(RequestScopeMiddleware)
+app.add_middleware(IPFilterMiddleware, ip_filter = ip_filter)
+#added last so it is the outermost middleware and also times the rejected requests
+app.add_middleware(MetricsMiddleware, metrics = metrics)
 
 
 @app.get('/', include_in_schema=False)
@@ -81,7 +301,7 @@ async def create_room(room: Room) -> dict:
     '''
 
     try:
-        room= repo.add_room(room)
+        room= await call_repo(repo.add_room, room)
     except ValueError as valerr:
         # Handle the exception and return a JSON error response
         raise HTTPException(status_code=409, detail=f"Integrity error occurred, "+ str(valerr))
@@ -95,6 +315,7 @@ async def create_room(room: Room) -> dict:
         logger.error(e)
         raise HTTPException(status_code=400, detail="An unexpected error occurred")
     else:
+        latest_readings.assign(room.name)
         return {"id": room.id, "message": f"Room {room.name} created."}
 
 @app.post("/api/sensor", status_code=status.HTTP_201_CREATED)
@@ -104,50 +325,14 @@ async def create_sensor(sensor: models.SensorIn) -> dict:
     have a serial number and a room attached, plant is optional.
     If a plant is specified, the sensor will be added to the plant
     sensor table.
+    The room and plant are created if they do not exist yet, everything
+    is done in a single transaction.
     '''
-    
-    room = repo.get_room(orm.Room(name = sensor.room))    
-
-    #if the room does not exist in the database, create it
-    if room is None:
-        try: 
-            room = repo.add_room(orm.Room(name = sensor.room))
-        except ValueError as valerr:
-            logger.error(valerr)
-            return HTTPException(status_code=409, detail = valerr)
-        except Exception as e:
-            logger.error(f"could not add room {room.room}")
-            logger.error(e)
-            return HTTPException(status_code= 500, detail = "Could not find the matching plant and could not create a new one")
-        
-    #check for field value in data, only plant sensor would report a plant name
-    if hasattr(sensor, 'plant') and sensor.plant is not None:
-        plant = repo.get_plant(orm.Plant(name = sensor.plant))
-    
-        #if the plant does not exist in the database, it is created
-        if plant is None:
-            try: 
-                plant = repo.add_plant(orm.Plant(name = sensor.plant, room = room))
-            except Exception as e:
-                logger.error(f"could not add plant {sensor.plant}")
-                logger.error(e)
-                raise HTTPException(status_code= 500, detail = "Could not find the matching plant and could not create a new one")
-      
-        #at this stage plant should be defined (either from the database or was just added)
-        sensor =  orm.PlantSensor(
-                    serial_number=sensor.serial_number,
-                    plant = plant
-        )
-
-    else:
-        sensor = orm.Sensor(
-            serial_number= sensor.serial_number,
-            room = room
-        )
 
+    room_name, plant_name = sensor.room, sensor.plant
     try:
-        #sensor can be a Plant or Regular sensor based on the processing done above
-        sensor = repo.add_sensor(sensor)
+        #sensor can be a Plant or Regular sensor depending on the plant field
+        sensor = await call_repo(repo.provision_sensor, sensor)
     except IntegrityError as e:
         logger.error(e)
         raise HTTPException(status_code= 409, detail = "Sensor already exists in database")
@@ -155,10 +340,42 @@ async def create_sensor(sensor: models.SensorIn) -> dict:
         logger.error(e)
         raise HTTPException(status_code= 500, detail = "An unexpected error occurred")
     else:
+        latest_readings.assign(room_name, sensor.serial_number, plant_name)
         return {"id": sensor.serial_number, "message": f"Sensor {sensor.serial_number} was created."}
 
+@app.post("/api/sensors/bulk", status_code=status.HTTP_200_OK)
+async def create_sensors(request: Request):
+    '''
+    End point to register a fleet of sensors at once. The body is either a json
+    list of sensors (same fields as /api/sensor) or a csv file sent with the
+    text/csv content type, with the columns serial_number, room and plant.
+    Missing rooms and plants are created, the response reports the outcome
+    of every sensor in the order they were sent.
+    '''
+    file_format = "csv" if "csv" in request.headers.get("content-type", "") else "json"
+    try:
+        rows = parse_sensor_rows((await request.body()).decode(), file_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail = f"Could not parse the sensor list: {e}")
+
+    valid, positions, results = validate_items(rows, models.SensorIn, "serial_number")
+
+    if valid:
+        try:
+            sensor_results = await call_repo(repo.provision_sensors, valid)
+        except Exception as e:
+            logger.error(e)
+            raise HTTPException(status_code=500, detail = "An unexpected error occurred")
+        for sensor_in, sensor_result in zip(valid, sensor_results):
+            if sensor_result.status == models.ENTRY_CREATED:
+                latest_readings.assign(sensor_in.room, sensor_in.serial_number, sensor_in.plant)
+        merge_results(results, positions, sensor_results)
+
+    created = sum(result.status == models.ENTRY_CREATED for result in results)
+    return {"message": f"{created} of {len(results)} sensors created", "results": results}
+
 @app.post("/api/measurement", status_code=status.HTTP_201_CREATED)
-async def add_measurement(measurement: models.Measurement):
+async def add_measurement(measurement: models.Measurement, response: Response):
     
     '''
     Endpoint to add measurements from sensor to the database.
@@ -171,18 +388,332 @@ async def add_measurement(measurement: models.Measurement):
         data will be timestamped when it is received by the server
         - wetness, only comes from plant sensors. If this field is present the data 
         is processed as a plant measurement automatically
+    A reading already recorded (same sensor and timestamp, e.g. resent by a sensor that
+    missed the ack) is not saved twice, the endpoint answers 200 with a duplicate status.
+    In buffered mode the measurement is queued and written in the background,
+    the endpoint then answers 202, or 503 if the buffer is full. It reaches the latest
+    and live endpoints once it is written.
     '''
     
     #parse data entry into a database object, plant or regular sensor entry
     measurement_object = parse_measurement(measurement)
 
+    if ingest_buffer is not None:
+        try:
+            ingest_buffer.put(measurement_object)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail = "Ingest buffer is full, retry later")
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": f"Measurement queued for sensor {measurement_object.sensor_id}"}
+
     try:
-        sensor_entry = repo.add_data_entry(measurement_object)
+        sensor_entry = await call_repo(repo.add_data_entry, measurement_object)
+    except ValueError as e:
+        #older than the write horizon
+        raise HTTPException(status_code=422, detail = f"Entry cannot be added: {e}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail = f"Entry cannot be added: {e}")
+        if spool is None or not database_unavailable(e):
+            raise HTTPException(status_code=500, detail = f"Entry cannot be added: {e}")
+        #the database is unavailable, keep the reading on disk until it comes back
+        logger.error(e)
+        await asyncio.to_thread(spool.append, [measurement_object])
+        record_readings([measurement_object])
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": f"Database unavailable, measurement spooled for sensor {measurement_object.sensor_id}",
+                "status": models.ENTRY_SPOOLED}
+
+    if sensor_entry is None:
+        #retransmitted reading, it is acknowledged so the sensor stops resending it
+        response.status_code = status.HTTP_200_OK
+        return {"message": f"Measurement already recorded for sensor {measurement_object.sensor_id}",
+                "status": models.ENTRY_DUPLICATE}
 
+    record_readings([measurement_object])
     return {"message": f"Measurement recorded for sensor sensor_entry {sensor_entry.sensor_id}"}
 
+@app.post("/api/measurements/batch", status_code=status.HTTP_200_OK)
+async def add_measurements(measurements: List[Dict[str, Any]]):
+    '''
+    Endpoint to add a batch of measurements to the database in one transaction.
+    Each item follows the same format as /api/measurement. Items are validated
+    individually so an invalid reading is reported as failed without cancelling
+    the rest of the batch. The response lists the outcome of every item, in the
+    order they were sent.
+    '''
+
+    valid, positions, results = validate_items(measurements, models.Measurement, "sensor_id")
+    entries = [parse_measurement(measurement) for measurement in valid]
+
+    if entries:
+        try:
+            entry_results = await write_entries(entries)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail = f"Entries cannot be added: {e}")
+        merge_results(results, positions, entry_results)
+
+    created = sum(result.status == models.ENTRY_CREATED for result in results)
+    duplicates = sum(result.status == models.ENTRY_DUPLICATE for result in results)
+    return {"message": f"{created} of {len(results)} measurements recorded, {duplicates} already recorded",
+            "results": results}
+
+@app.post("/api/measurements/binary", status_code=status.HTTP_200_OK)
+async def add_binary_measurements(request: Request):
+    '''
+    Endpoint for constrained devices sending a batch of measurements as a compact binary
+    frame (application/octet-stream), see src/binary_frame.py for the layout.
+    The records are checked with the same ranges as /api/measurement and written in
+    one transaction, the response is the same as /api/measurements/batch.
+    '''
+    try:
+        entries, positions, results = decode_frame(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail = f"Invalid frame: {e}")
+
+    if entries:
+        try:
+            entry_results = await write_entries(entries)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail = f"Entries cannot be added: {e}")
+        merge_results(results, positions, entry_results)
+
+    created = sum(result.status == models.ENTRY_CREATED for result in results)
+    duplicates = sum(result.status == models.ENTRY_DUPLICATE for result in results)
+    return {"message": f"{created} of {len(results)} measurements recorded, {duplicates} already recorded",
+            "results": results}
+
+@app.websocket("/api/ws/measurements")
+async def measurement_stream(websocket: WebSocket):
+    '''
+    Websocket for gateways streaming measurements. Each text frame holds one measurement
+    or a list of measurements, with the same fields as /api/measurement (a binary frame is
+    acked as one failed reading). Readings are numbered from 1 in order of arrival on the
+    connection and written in batches, after each batch the server sends a cumulative ack:
+        {"ack": n, "created": ..., "duplicate": ..., "spooled": ..., "failed": [{"seq": ..., "detail": ...}]}
+    meaning every reading up to n was processed. If the database cannot be reached the
+    connection is closed (code 1011) after an error message holding the last ack, the gateway
+    can reconnect and resend the readings after it (already stored readings are skipped).
+    '''
+    await websocket.accept()
+
+    stream = MeasurementStream(STREAM_FLUSH_ROWS, STREAM_FLUSH_INTERVAL_MS)
+    try:
+        while True:
+            await receive_frame(websocket, stream)
+            if stream.due():
+                try:
+                    ack = await stream.flush(write_entries)
+                except Exception as e:
+                    logger.error(f'could not write streamed measurements up to {stream.received}')
+                    logger.error(e)
+                    await websocket.send_json({"ack": stream.acked, "error": f"Entries cannot be added: {e}"})
+                    await websocket.close(code = status.WS_1011_INTERNAL_ERROR)
+                    return
+                await websocket.send_json(ack)
+    except WebSocketDisconnect:
+        #the gateway left, keep what it already sent
+        if stream.pending:
+            try:
+                await stream.flush(write_entries)
+            except Exception as e:
+                logger.error(f'could not write streamed measurements up to {stream.received}')
+                logger.error(e)
+
+@app.get("/api/sensor/{sensor_id}/latest")
+async def get_sensor_latest(sensor_id: int):
+    '''
+    Last reading of a sensor, served from memory without querying the database
+    '''
+    reading = latest_readings.sensor(sensor_id)
+    if reading is None:
+        raise HTTPException(status_code=404, detail = f"No reading for sensor {sensor_id}")
+    return reading
+
+@app.get("/api/room/{room_name}/latest")
+async def get_room_latest(room_name: str):
+    '''
+    Last reading of every sensor of a room (case insensitive), served from memory
+    without querying the database
+    '''
+    readings = latest_readings.room(room_name)
+    if readings is None:
+        raise HTTPException(status_code=404, detail = f"Room {room_name} does not exist")
+    return {"room": room_name, "readings": readings}
+
+@app.get("/api/live")
+async def get_live_feed(request: Request, sensor_id: Optional[int] = None, room: Optional[str] = None,
+                        plant: Optional[str] = None):
+    '''
+    Server-sent events stream of the readings as they are ingested, optionally only those
+    of a sensor, a room or a plant (names are case insensitive). Each event holds one reading
+    as json. A client that falls behind loses its oldest readings rather than slowing ingestion.
+    '''
+    subscriber = live_feed.subscribe(sensor_id, room, plant)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                message = await subscriber.get(timeout = LIVE_FEED_KEEPALIVE_SECONDS)
+                yield format_event(message) if message is not None else KEEPALIVE_EVENT
+        finally:
+            live_feed.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type = "text/event-stream", headers = {"Cache-Control": "no-cache"})
+
+@app.get("/api/live/stats")
+async def get_live_feed_stats():
+    '''
+    Number of live feed subscribers and of readings published and dropped
+    '''
+    return live_feed.stats()
+
+@app.get("/api/ingest/stats")
+async def get_ingest_stats():
+    '''
+    Counters of the write-behind ingest buffer (queue depth, flushed rows, flush latency)
+    and of the UDP listener when it is enabled
+    '''
+    stats = {"buffered": False} if ingest_buffer is None else {"buffered": True, **ingest_buffer.stats()}
+    if udp_protocol is not None:
+        stats["udp"] = {**udp_protocol.stats(), "buffer": udp_buffer.stats()}
+    return stats
+
+@app.get("/api/spool")
+async def get_spool_status():
+    '''
+    Status of the on-disk spool: segments waiting to be replayed, rows spooled and
+    replayed, and the last run of the replayer
+    '''
+    if spool is None:
+        return {"enabled": False}
+    return {"enabled": True, **spool.stats(), "replay_job": spool_job.status()}
+
+@app.get("/api/retention")
+async def get_retention_status():
+    '''
+    Retention policy and progress of the current or last run: cutoff, rows deleted and
+    partitions dropped per table
+    '''
+    if retention is None:
+        return {"enabled": False}
+    return {"enabled": True, **retention.status(), "job": retention_job.status()}
+
+@app.get("/api/archive")
+async def get_archive_status():
+    '''
+    Cold storage settings and progress: cutoff, rows archived and chunks written
+    '''
+    if archiver is None:
+        return {"enabled": False}
+    return {"enabled": True, **archiver.status(), "job": archive_job.status()}
+
+@app.get("/api/jobs")
+async def get_jobs():
+    '''
+    Status of the background maintenance jobs
+    '''
+    return {"jobs": [job.status() for job in jobs]}
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    '''
+    Metrics in the Prometheus text exposition format
+    '''
+    return PlainTextResponse(metrics.expose(), media_type = "text/plain; version=0.0.4")
+
+@app.get("/api/slow-queries")
+async def get_slow_queries(explain: bool = False):
+    '''
+    Recent statements slower than SLOW_QUERY_THRESHOLD_MS with the route that ran them, and the
+    slowest run of the slowest statements. With explain=true the plans of the slowest select
+    statements are captured (EXPLAIN ANALYZE on postgres, the statements are run again).
+    '''
+    if slow_query_log is None:
+        return {"enabled": False}
+    if not explain:
+        worst = slow_query_log.worst()
+    elif async_engine is not None:
+        async with async_engine.connect() as connection:
+            worst = await connection.run_sync(slow_query_log.explain)
+    else:
+        def explain_worst():
+            with engine.connect() as connection:
+                return slow_query_log.explain(connection)
+        worst = await asyncio.to_thread(explain_worst)
+    return {"enabled": True, **slow_query_log.stats(), "recent": slow_query_log.entries(), "worst": worst}
+
+@app.get("/api/sensor/{sensor_id}/measurements")
+async def get_sensor_measurements(sensor_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                  limit: int = 100, after: Optional[str] = None):
+    '''
+    Measurements of a sensor in timestamp order, optionally between start and end.
+    Results are paginated: pass the next_cursor of a page as the after parameter
+    to get the following page. next_cursor is null on the last page.
+    '''
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail = f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    try:
+        cursor = parse_cursor(after) if after is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail = str(e))
+
+    entries = await call_repo(repo.get_measurements, sensor_id, start, end, cursor, limit)
+    next_cursor = format_cursor(entry_cursor(entries[-1])) if len(entries) == limit else None
+    return {"sensor_id": sensor_id, "measurements": entries, "next_cursor": next_cursor}
+
+@app.get("/api/export")
+async def export_measurements(format: str = "ndjson", start: Optional[datetime] = None, end: Optional[datetime] = None,
+                              sensor_id: Optional[int] = None):
+    '''
+    Stream all the measurements (optionally of one sensor, between start and end)
+    as NDJSON or CSV. Rows are read with a server side cursor and sent as they come,
+    so exports of any size use the same amount of memory.
+    '''
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail = f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+    chunks = repo.stream_measurements(start, end, sensor_id)
+    if inspect.isasyncgen(chunks):
+        body = aformat_chunks(chunks, format)
+    else:
+        #starlette iterates synchronous generators in a worker thread
+        body = format_chunks(chunks, format)
+    return StreamingResponse(body, media_type = EXPORT_FORMATS[format],
+                             headers = {"Content-Disposition": f"attachment; filename=measurements.{format}"})
+
+@app.get("/api/sensor/{sensor_id}/rollup")
+async def get_sensor_rollup(sensor_id: int, start: datetime, end: datetime, points: int = 200):
+    '''
+    Aggregated history of a sensor between start and end, for charts.
+    The coarsest resolution (1d, 1h, 1m) that still gives at least the requested
+    number of points is used. Only buckets already compacted by the background
+    job are returned.
+    '''
+    if end <= start or points <= 0:
+        raise HTTPException(status_code=400, detail = "end must be after start and points must be positive")
+
+    resolution, rows = await call_repo(repo.get_rollup, sensor_id, start, end, points)
+    return {"sensor_id": sensor_id, "resolution": resolution, "points": rows}
+
+
+@app.get("/api/rooms/stats")
+async def get_rooms_stats(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    '''
+    Temperature and humidity statistics of every room over its sensors and the sensors of its plants,
+    optionally between start and end (rounded down to the hour). Served from the hourly room rollup,
+    only the minutes already refreshed by the background job are counted.
+    '''
+    rows = await call_repo(repo.get_room_stats, None, start, end)
+    return {"rooms": [row._asdict() for row in rows]}
+
+@app.get("/api/room/{room_name}/stats")
+async def get_room_stats(room_name: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    '''
+    Statistics of one room (case insensitive), see /api/rooms/stats
+    '''
+    rows = await call_repo(repo.get_room_stats, Room(name = room_name), start, end)
+    if not rows:
+        raise HTTPException(status_code=404, detail = f"No statistics for room {room_name}")
+    return rows[0]._asdict()
 
 #passing a room is optional. revisit exception Validation may be thrown for other reasons than just room being None
 @app.get("/api/average/")
@@ -196,7 +727,7 @@ async def get_average_temperature(room_name: Optional[str] = None):
         logger.warning("No room were specified, calculating the average over all entries")
         avg_room = None
 
-    average_temp = repo.get_average_temperature(avg_room)
+    average_temp = await call_repo(repo.get_average_temperature, avg_room)
     if average_temp:
         return { "average": round(average_temp, 2)}, 200
     else:
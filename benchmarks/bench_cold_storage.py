@@ -0,0 +1,70 @@
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from src.gorilla import encode_chunk, decode_chunk
+
+
+#Compression ratio and encode/decode throughput of the cold storage chunks (src/gorilla.py) on
+#synthetic daily windows: one reading every --interval seconds, temperature as a random walk rounded
+#to 0.1 degree and humidity rounded to 0.01, like the sensors report them.
+#usage: python benchmarks/bench_cold_storage.py [--chunks 30] [--interval 60] [--jitter 0] [--plant]
+#--jitter adds up to that many milliseconds to each timestamp, --plant adds the wetness column.
+#The ratio is against the raw payload (8 bytes per timestamp and per value), an entry table row
+#takes several times more with the tuple header and the primary key index.
+
+
+def window(readings, interval, jitter, plant, rng):
+    start = datetime(2024, 1, 1)
+    timestamps = [start + timedelta(seconds=i * interval, milliseconds=rng.randint(0, jitter)) for i in range(readings)]
+    temperature, humidity, wetness = [], [], []
+    current = 20.0
+    for _ in range(readings):
+        current += rng.choice((-0.1, 0, 0, 0, 0.1))
+        temperature.append(round(current, 1))
+        humidity.append(round(0.45 + rng.random() * 0.1, 2))
+        wetness.append(round(0.3 + rng.random() * 0.05, 2))
+    return timestamps, temperature, humidity, wetness if plant else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=30)
+    parser.add_argument("--interval", type=int, default=60)
+    parser.add_argument("--jitter", type=int, default=0)
+    parser.add_argument("--plant", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    readings = 24 * 3600 // args.interval
+    windows = [window(readings, args.interval, args.jitter, args.plant, rng) for _ in range(args.chunks)]
+    values_per_reading = 4 if args.plant else 3
+
+    start = time.perf_counter()
+    chunks = [encode_chunk(*columns) for columns in windows]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for chunk in chunks:
+        decode_chunk(chunk)
+    decode_time = time.perf_counter() - start
+
+    rows = readings * args.chunks
+    raw_size = rows * 8 * values_per_reading
+    compressed_size = sum(len(chunk) for chunk in chunks)
+    print(f"{args.chunks} chunks of {readings} readings")
+    print(f"raw payload: {raw_size:10d} bytes")
+    print(f"compressed:  {compressed_size:10d} bytes ({raw_size / compressed_size:.1f}x, "
+          f"{compressed_size * 8 / rows:.1f} bits/reading)")
+    print(f"encode:      {rows / encode_time:10.0f} readings/sec")
+    print(f"decode:      {rows / decode_time:10.0f} readings/sec")
+
+
+if __name__ == "__main__":
+    main()
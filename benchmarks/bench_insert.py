@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sqlmodel import SQLModel, Session, create_engine
+from src.models import SensorIn
+from src.orm import HumidityTemperatureEntry
+from src.repository.sqlmodel_repository import SQLModel_repository
+
+
+#Compare the rows/sec of a plain ORM insert (Session.add, commit and refresh, the baseline),
+#of add_data_entry reading the stored entry back (default) and through the lean path returning
+#the entry as passed in. The baseline skips the aggregates and rollups the repository maintains.
+#The readings are timestamped from the start of the run on, like live readings: older ones would
+#also be queued for the rollups as late entries.
+#usage: python benchmarks/bench_insert.py [--rows 2000] [--database-url postgresql+psycopg2://...]
+#without a database url a temporary sqlite file is used. The tables are created if needed
+#and the benchmark writes to the sensors 900001, 900002 and 900003.
+
+
+START = datetime.now(timezone.utc)
+
+
+def make_entry(sensor_id, i):
+    return HumidityTemperatureEntry(sensor_id = sensor_id, entry_timestamp = START + timedelta(milliseconds=i),
+                                    temperature = 20, humidity = 0.5)
+
+
+def run_orm(engine, sensor_id, rows):
+    start = time.perf_counter()
+    with Session(engine) as session:
+        for i in range(rows):
+            sensor_entry = make_entry(sensor_id, i)
+            session.add(sensor_entry)
+            session.commit()
+            session.refresh(sensor_entry)
+    return rows / (time.perf_counter() - start)
+
+
+def run(repo, sensor_id, rows):
+    start = time.perf_counter()
+    for i in range(rows):
+        repo.add_data_entry(make_entry(sensor_id, i))
+    return rows / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    engine = create_engine(database_url)
+    SQLModel.metadata.create_all(engine)
+
+    orm_repo = SQLModel_repository(engine)
+    lean_repo = SQLModel_repository(engine, lean_writes = True)
+    orm_repo.provision_sensors([SensorIn(serial_number = 900001, room = "benchmark"),
+                                SensorIn(serial_number = 900002, room = "benchmark"),
+                                SensorIn(serial_number = 900003, room = "benchmark")])
+
+    baseline_rate = run_orm(engine, 900003, args.rows)
+    orm_rate = run(orm_repo, 900001, args.rows)
+    lean_rate = run(lean_repo, 900002, args.rows)
+    print(f"ORM add:   {baseline_rate:10.0f} rows/sec")
+    print(f"read back: {orm_rate:10.0f} rows/sec ({orm_rate / baseline_rate:.2f}x)")
+    print(f"lean:      {lean_rate:10.0f} rows/sec ({lean_rate / baseline_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
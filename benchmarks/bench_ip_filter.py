@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import ipaddress
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi import FastAPI, HTTPException, Request, status
+from src.ip_filter import IPFilter, IPFilterMiddleware
+
+
+#Compare the requests/sec of a minimal endpoint behind the previous BaseHTTPMiddleware ip filter
+#(linear scan of the networks for every request) and behind the ASGI IPFilterMiddleware.
+#usage: python benchmarks/bench_ip_filter.py [--requests 20000] [--networks 2]
+#Requests are sent straight to the ASGI app, without a server, so only the app and middleware are measured.
+
+
+def allowed_networks(count):
+    networks = [ipaddress.ip_network("192.168.0.0/24"), ipaddress.ip_network("127.0.0.1/32")]
+    #extra /24 networks that do not match the benchmark client, listed first to show the cost of larger allow-lists
+    extra = [ipaddress.ip_network(f"10.{i // 256}.{i % 256}.0/24") for i in range(count - len(networks))]
+    return extra + networks
+
+
+def previous_app(networks):
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def ip_filter_middleware(request: Request, call_next):
+        client_ip = request.headers.get("x-forwarded-for")
+        if client_ip:
+            client_ip = client_ip.split(",")[0].strip()
+        else:
+            client_ip = request.client.host
+        client_ip_address = ipaddress.ip_address(client_ip)
+        if not any(client_ip_address in network for network in networks):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+        return await call_next(request)
+
+    @app.get("/")
+    def index():
+        return {"message": "ok"}
+
+    return app
+
+
+def current_app(networks):
+    app = FastAPI()
+    app.add_middleware(IPFilterMiddleware, ip_filter = IPFilter(networks))
+
+    @app.get("/")
+    def index():
+        return {"message": "ok"}
+
+    return app
+
+
+async def run(app, requests):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/", "raw_path": b"/", "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"x-forwarded-for", b"192.168.0.20")],
+        "client": ("192.168.0.20", 50000), "server": ("localhost", 8000),
+    }
+
+    def receiver():
+        messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            #the client stays connected until the response is sent
+            await asyncio.Event().wait()
+
+        return receive
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receiver(), send)
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--networks", type=int, default=2)
+    args = parser.parse_args()
+
+    networks = allowed_networks(max(args.networks, 2))
+    previous_rate = asyncio.run(run(previous_app(networks), args.requests))
+    current_rate = asyncio.run(run(current_app(networks), args.requests))
+    print(f"{len(networks)} allowed networks")
+    print(f"BaseHTTPMiddleware: {previous_rate:10.0f} requests/sec")
+    print(f"ASGI middleware:    {current_rate:10.0f} requests/sec ({current_rate / previous_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import inspect
+import sys
+from datetime import datetime
+from app import repo, call_repo
+from src import models
+from src.export import EXPORT_FORMATS, format_chunks, aformat_chunks
+from src.helper_functions import parse_sensor_rows, validate_items, merge_results
+
+
+#Command line tools to maintain the monitoring database, they use the same
+#configuration (.env) and repository as the server.
+#usage: python cli.py <command> [options]
+
+def provision(args):
+    '''
+    Register all the sensors listed in a csv or json file
+    '''
+    file_format = args.format or ("csv" if args.file.endswith(".csv") else "json")
+    with open(args.file) as sensor_file:
+        rows = parse_sensor_rows(sensor_file.read(), file_format)
+
+    valid, positions, results = validate_items(rows, models.SensorIn, "serial_number")
+    if valid:
+        merge_results(results, positions, asyncio.run(call_repo(repo.provision_sensors, valid)))
+
+    for result in results:
+        print(json.dumps(result.model_dump()))
+
+    created = sum(result.status == models.ENTRY_CREATED for result in results)
+    print(f"{created} of {len(results)} sensors created", file=sys.stderr)
+    return 0 if created == len(results) else 1
+
+
+def rebuild_aggregates(args):
+    '''
+    Recompute the running temperature aggregates from the raw and archived entries
+    '''
+    try:
+        asyncio.run(call_repo(repo.rebuild_aggregates))
+    except ValueError as e:
+        #the retention deleted readings the aggregates still count
+        print(f"aggregates not rebuilt: {e}", file=sys.stderr)
+        return 1
+    print("aggregates rebuilt", file=sys.stderr)
+    return 0
+
+
+def export(args):
+    '''
+    Stream the measurements to a file (or stdout) as NDJSON or CSV
+    '''
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    chunks = repo.stream_measurements(args.start, args.end, args.sensor_id)
+
+    async def write_async():
+        async for text in aformat_chunks(chunks, args.format):
+            output.write(text)
+
+    try:
+        if inspect.isasyncgen(chunks):
+            asyncio.run(write_async())
+        else:
+            for text in format_chunks(chunks, args.format):
+                output.write(text)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Home monitoring database tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    provision_parser = subparsers.add_parser("provision", help="register a fleet of sensors from a csv or json file")
+    provision_parser.add_argument("file", help="csv file with the columns serial_number, room, plant or a json list of sensors")
+    provision_parser.add_argument("--format", choices=["csv", "json"], help="file format, guessed from the extension by default")
+    provision_parser.set_defaults(handler=provision)
+
+    rebuild_parser = subparsers.add_parser("rebuild-aggregates", help="recompute the sensor and room temperature aggregates")
+    rebuild_parser.set_defaults(handler=rebuild_aggregates)
+
+    export_parser = subparsers.add_parser("export", help="export measurements as NDJSON or CSV")
+    export_parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson")
+    export_parser.add_argument("--start", type=datetime.fromisoformat, help="ISO timestamp, included")
+    export_parser.add_argument("--end", type=datetime.fromisoformat, help="ISO timestamp, excluded")
+    export_parser.add_argument("--sensor-id", type=int)
+    export_parser.add_argument("--output", help="file to write, stdout by default")
+    export_parser.set_defaults(handler=export)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+from functools import lru_cache
+from typing import Dict, Iterable, List
+from sqlalchemy import bindparam, case, delete, func, insert, select, text, union_all
+from src.orm import HumidityTemperatureEntry, Room, Sensor, SensorAggregate, RoomAggregate
+from src.helper_functions import dialect_insert, precompiled, to_naive_utc
+
+
+#Helpers to maintain the running temperature aggregates (see SensorAggregate and RoomAggregate).
+#The repositories use them in the same transaction as the entry inserts.
+
+AGGREGATE_COLUMNS = ("entry_count", "temperature_sum", "temperature_min", "temperature_max", "last_timestamp")
+
+
+def compute_deltas(rows: Iterable[dict], key: str = "sensor_id") -> Dict[int, dict]:
+    '''
+    Summarise inserted entries (dicts with sensor_id, entry_timestamp and temperature)
+    into one aggregate delta per key
+    '''
+    deltas = {}
+    for row in rows:
+        delta = deltas.get(row[key])
+        if delta is None:
+            deltas[row[key]] = {
+                "entry_count": 1,
+                "temperature_sum": row["temperature"],
+                "temperature_min": row["temperature"],
+                "temperature_max": row["temperature"],
+                "last_timestamp": to_naive_utc(row["entry_timestamp"]),
+            }
+        else:
+            delta["entry_count"] += 1
+            delta["temperature_sum"] += row["temperature"]
+            delta["temperature_min"] = min(delta["temperature_min"], row["temperature"])
+            delta["temperature_max"] = max(delta["temperature_max"], row["temperature"])
+            delta["last_timestamp"] = max(delta["last_timestamp"], to_naive_utc(row["entry_timestamp"]))
+    return deltas
+
+
+def upsert_statement(dialect_name: str, table):
+    '''
+    INSERT ... ON CONFLICT DO UPDATE adding a delta to the aggregate row of a sensor or room,
+    to be executed with a list of dicts holding the key and the AGGREGATE_COLUMNS
+    '''
+    if dialect_name not in ("postgresql", "sqlite"):
+        raise NotImplementedError(f"Aggregates are not supported on {dialect_name}")
+
+    #the Core table, the ORM bulk insert path is not needed for plain parameter dicts
+    statement = dialect_insert(dialect_name, table.__table__)
+    return _on_conflict_add(statement, table)
+
+
+def room_upsert_statement(dialect_name: str, sensors: int):
+    '''
+    INSERT ... SELECT ... ON CONFLICT DO UPDATE adding the deltas of a number of sensors to the
+    aggregates of their rooms, the rooms are resolved in the same statement (sensors without a
+    room are left out). To be executed with room_upsert_parameters.
+    '''
+    if dialect_name not in ("postgresql", "sqlite"):
+        raise NotImplementedError(f"Aggregates are not supported on {dialect_name}")
+
+    columns = SensorAggregate.__table__.c
+    selects = [select(*[bindparam(f"{column}_{index}", type_ = columns[column].type).label(column)
+                        for column in ("sensor_id", *AGGREGATE_COLUMNS)])
+               for index in range(sensors)]
+    delta = (selects[0] if sensors == 1 else union_all(*selects)).subquery("delta")
+
+    #several sensors of a room are added up first, a row cannot be updated twice by one statement.
+    #The WHERE clause also keeps sqlite from parsing ON CONFLICT as a join constraint
+    query = select(
+        Sensor.room_id, func.sum(delta.c.entry_count), func.sum(delta.c.temperature_sum),
+        func.min(delta.c.temperature_min), func.max(delta.c.temperature_max), func.max(delta.c.last_timestamp),
+    ).select_from(delta).join(Sensor, Sensor.serial_number == delta.c.sensor_id) \
+     .where(Sensor.room_id.is_not(None)) \
+     .group_by(Sensor.room_id).order_by(Sensor.room_id)
+
+    statement = dialect_insert(dialect_name, RoomAggregate.__table__).from_select(["room_id", *AGGREGATE_COLUMNS], query)
+    return _on_conflict_add(statement, RoomAggregate)
+
+
+@lru_cache(maxsize = 64)
+def add_statements(dialect_name: str, sensors: int) -> tuple:
+    '''
+    upsert_statement of the sensor aggregates and room_upsert_statement for a number of sensors,
+    compiled once (see precompiled)
+    '''
+    return (precompiled(upsert_statement(dialect_name, SensorAggregate), dialect_name),
+            precompiled(room_upsert_statement(dialect_name, sensors), dialect_name))
+
+
+def _on_conflict_add(statement, table):
+    columns = table.__table__.c
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements = [column.name for column in table.__table__.primary_key],
+        set_ = {
+            "entry_count": columns.entry_count + excluded.entry_count,
+            "temperature_sum": columns.temperature_sum + excluded.temperature_sum,
+            "temperature_min": case((excluded.temperature_min < columns.temperature_min, excluded.temperature_min),
+                                    else_ = columns.temperature_min),
+            "temperature_max": case((excluded.temperature_max > columns.temperature_max, excluded.temperature_max),
+                                    else_ = columns.temperature_max),
+            "last_timestamp": case((excluded.last_timestamp > columns.last_timestamp, excluded.last_timestamp),
+                                   else_ = columns.last_timestamp),
+        }
+    )
+
+
+def upsert_parameters(deltas: Dict[int, dict], key: str) -> List[dict]:
+    #rows are always updated in key order so concurrent transactions cannot deadlock
+    return [{key: key_value, **delta} for key_value, delta in sorted(deltas.items())]
+
+
+def room_upsert_parameters(deltas: Dict[int, dict]) -> dict:
+    '''
+    Parameters of room_upsert_statement(dialect_name, len(deltas)) for sensor deltas
+    '''
+    parameters = {}
+    for index, (sensor_id, delta) in enumerate(sorted(deltas.items())):
+        parameters[f"sensor_id_{index}"] = sensor_id
+        for column in AGGREGATE_COLUMNS:
+            parameters[f"{column}_{index}"] = delta[column]
+    return parameters
+
+
+def room_filter(room: Room):
+    '''
+    Match a room by id when it is known, by name otherwise (case insensitive like get_room)
+    '''
+    if room.id is not None:
+        return Room.id == room.id
+    return func.lower(Room.name) == str(room.name).lower()
+
+
+def aggregate_columns():
+    return (
+        func.count().label("entry_count"),
+        func.sum(HumidityTemperatureEntry.temperature).label("temperature_sum"),
+        func.min(HumidityTemperatureEntry.temperature).label("temperature_min"),
+        func.max(HumidityTemperatureEntry.temperature).label("temperature_max"),
+        func.max(HumidityTemperatureEntry.entry_timestamp).label("last_timestamp"),
+    )
+
+
+def rebuild_statements(dialect_name: str) -> list:
+    '''
+    Statements recomputing both aggregate tables from the raw entries, they must run in one transaction.
+    The archived entries are added by the repository afterwards.
+    '''
+    statements = []
+    if dialect_name == "postgresql":
+        #block concurrent inserts, archiving and retention so no entry is missed or counted twice while rebuilding
+        statements.append(text("LOCK TABLE humidity_temperature_entry, measurement_chunk IN SHARE MODE"))
+
+    sensor_select = select(HumidityTemperatureEntry.sensor_id, *aggregate_columns()) \
+        .group_by(HumidityTemperatureEntry.sensor_id)
+    room_select = select(Sensor.room_id, *aggregate_columns()) \
+        .select_from(HumidityTemperatureEntry) \
+        .join(Sensor, HumidityTemperatureEntry.sensor_id == Sensor.serial_number) \
+        .where(Sensor.room_id.is_not(None)) \
+        .group_by(Sensor.room_id)
+
+    statements += [
+        delete(SensorAggregate),
+        delete(RoomAggregate),
+        insert(SensorAggregate).from_select(["sensor_id", *AGGREGATE_COLUMNS], sensor_select),
+        insert(RoomAggregate).from_select(["room_id", *AGGREGATE_COLUMNS], room_select),
+    ]
+    return statements
@@ -0,0 +1,90 @@
+import math
+import struct
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple, Union
+from src.models import EntryResult, ENTRY_FAILED
+from src.orm import PlantSensorEntry, HumidityTemperatureEntry
+
+
+#Compact binary measurement frame for constrained devices, all values little endian:
+#   header  version (uint8), padding (1 byte), record count N (uint16)
+#   N records of 20 bytes:
+#       sensor_id        uint32
+#       entry_timestamp  uint32, epoch seconds in UTC, 0 to use the reception time
+#       temperature      float32
+#       humidity         float32
+#       wetness          float32, NaN for regular sensors
+#The range checks are the ones of models.Measurement.
+
+FRAME_VERSION = 1
+HEADER = struct.Struct("<BxH")
+RECORD = struct.Struct("<IIfff")
+
+TEMPERATURE_RANGE = (-40, 70)
+HUMIDITY_RANGE = (0, 1)
+WETNESS_RANGE = (0, 1)
+
+
+def encode_frame(records: List[Tuple[int, int, float, float, Optional[float]]]) -> bytes:
+    '''
+    Build a frame from (sensor_id, epoch timestamp, temperature, humidity, wetness or None) tuples
+    '''
+    body = b"".join(RECORD.pack(sensor_id, timestamp, temperature, humidity, math.nan if wetness is None else wetness)
+                    for sensor_id, timestamp, temperature, humidity, wetness in records)
+    return HEADER.pack(FRAME_VERSION, len(records)) + body
+
+
+def _in_range(values: tuple, bounds: Tuple[float, float]) -> List[bool]:
+    low, high = bounds
+    #NaN compares false and is rejected as out of range
+    return [low <= value <= high for value in values]
+
+
+def decode_frame(frame: bytes) -> Tuple[List[Union[PlantSensorEntry, HumidityTemperatureEntry]], List[int], List[Optional[EntryResult]]]:
+    '''
+    Decode and check all the records of a frame at once.
+    Returns the same as helper_functions.validate_items: the entries, their position in the
+    frame and a list of results with the invalid records already reported as failed.
+    Raises ValueError if the frame itself is malformed.
+    '''
+    if len(frame) < HEADER.size:
+        raise ValueError("Frame is shorter than its header")
+    version, count = HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    body = memoryview(frame)[HEADER.size:]
+    if len(body) != count * RECORD.size:
+        raise ValueError(f"Expected {count} records of {RECORD.size} bytes, got {len(body)} bytes")
+
+    results: List[Optional[EntryResult]] = [None] * count
+    if count == 0:
+        return [], [], results
+
+    #one tuple per field with the values of every record
+    sensor_ids, timestamps, temperatures, humidities, wetnesses = zip(*RECORD.iter_unpack(body))
+    plant = [not math.isnan(wetness) for wetness in wetnesses]
+    checks = (
+        ("temperature", _in_range(temperatures, TEMPERATURE_RANGE)),
+        ("humidity", _in_range(humidities, HUMIDITY_RANGE)),
+        ("wetness", [not is_plant or valid for is_plant, valid in zip(plant, _in_range(wetnesses, WETNESS_RANGE))]),
+    )
+
+    now = datetime.now(timezone.utc)
+    entries = []
+    positions = []
+    for index in range(count):
+        errors = [f"{field}: out of range" for field, valid in checks if not valid[index]]
+        if errors:
+            results[index] = EntryResult(index = index, sensor_id = sensor_ids[index], status = ENTRY_FAILED, detail = "; ".join(errors))
+            continue
+        timestamp = datetime.fromtimestamp(timestamps[index], tz = timezone.utc) if timestamps[index] else now
+        if plant[index]:
+            entry = PlantSensorEntry(sensor_id = sensor_ids[index], entry_timestamp = timestamp, temperature = temperatures[index],
+                                     humidity = humidities[index], wetness = wetnesses[index])
+        else:
+            entry = HumidityTemperatureEntry(sensor_id = sensor_ids[index], entry_timestamp = timestamp,
+                                             temperature = temperatures[index], humidity = humidities[index])
+        entries.append(entry)
+        positions.append(index)
+
+    return entries, positions, results
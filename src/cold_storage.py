@@ -0,0 +1,228 @@
+import logging
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Union
+from sqlalchemy import delete, func
+from sqlalchemy.orm import defer
+from sqlmodel import Session, select
+from src.orm import HumidityTemperatureEntry, PlantSensorEntry, MeasurementChunk, RollupWatermark
+from src.gorilla import EPOCH, encode_chunk, decode_chunk
+from src.retention import RAW, compacted_until
+from src.helper_functions import to_naive_utc, utc_now
+from src.history import HistoryCursor, cursor_bound
+
+
+logger = logging.getLogger(__name__)
+
+
+#Cold storage of the historical entries. Once a time window (a day by default) is older than
+#archive_after, the entries of each sensor in that window are moved out of the entry table into one
+#compressed chunk (see src/gorilla.py) of the measurement_chunk table. The history and export
+#queries decode the chunks overlapping their range and merge them with the live rows, a history page
+#stops decoding once it has its entries.
+#Entries are only archived once they are compacted into the minute and room rollups. A reading arriving late
+#for a window already archived is merged into its chunk by the next run, the repository rejects the
+#readings older than its write horizon so a resent reading is not counted twice.
+#Archiving leaves the running aggregates as they are, a rebuild adds the archived readings to the live rows.
+
+#(entry table, plant_sensor flag of its chunks)
+ARCHIVE_TABLES = ((HumidityTemperatureEntry, False), (PlantSensorEntry, True))
+
+#chunks decoded per batch of an export
+EXPORT_CHUNKS_PER_BATCH = 8
+
+
+def window_floor(timestamp: datetime, window: timedelta) -> datetime:
+    return EPOCH + (timestamp - EPOCH) // window * window
+
+
+def chunk_query(sensor_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                after: Union[HistoryCursor, datetime, None] = None, limit: int = 100):
+    '''
+    Chunks of a sensor holding readings of the next history page, every chunk selected holds at
+    least one reading in range so limit chunks are enough for a page of limit entries. The data of
+    a chunk is only loaded when archived_entries decodes it
+    '''
+    query = select(MeasurementChunk).options(defer(MeasurementChunk.data)).where(MeasurementChunk.sensor_id == sensor_id)
+    if start is not None:
+        query = query.where(MeasurementChunk.last_timestamp >= to_naive_utc(start))
+    if end is not None:
+        query = query.where(MeasurementChunk.first_timestamp < to_naive_utc(end))
+    if after is not None:
+        #the readings at the timestamp of the cursor may be after it (see cursor_bound), the chunk of each
+        #entry table ending there can hold none of the page, two more chunks make up for them
+        query = query.where(MeasurementChunk.last_timestamp >= to_naive_utc(after[0] if isinstance(after, HistoryCursor) else after))
+        limit += 2
+    return query.order_by(MeasurementChunk.window_start).limit(limit)
+
+
+def chunk_export_query(start: Optional[datetime] = None, end: Optional[datetime] = None, sensor_id: Optional[int] = None):
+    query = select(MeasurementChunk.sensor_id, MeasurementChunk.plant_sensor, MeasurementChunk.data)
+    if sensor_id is not None:
+        query = query.where(MeasurementChunk.sensor_id == sensor_id)
+    if start is not None:
+        query = query.where(MeasurementChunk.last_timestamp >= to_naive_utc(start))
+    if end is not None:
+        query = query.where(MeasurementChunk.first_timestamp < to_naive_utc(end))
+    return query
+
+
+def chunk_readings(data: bytes, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   after: Optional[datetime] = None, limit: Optional[int] = None) -> List[tuple]:
+    '''
+    (timestamp, temperature, humidity, wetness) of the first readings of a chunk in range, at most limit
+    '''
+    start, end, after = (to_naive_utc(bound) if bound is not None else None for bound in (start, end, after))
+    timestamps, temperature, humidity, wetness = decode_chunk(data)
+    #the timestamps of a chunk are sorted, the range is a slice
+    first = bisect_left(timestamps, start) if start is not None else 0
+    if after is not None:
+        first = max(first, bisect_right(timestamps, after))
+    last = bisect_left(timestamps, end) if end is not None else len(timestamps)
+    if limit is not None:
+        last = min(last, first + limit)
+    if wetness is None:
+        wetness = [None] * len(timestamps)
+    return list(zip(timestamps[first:last], temperature[first:last], humidity[first:last], wetness[first:last]))
+
+
+def archived_entries(chunks: List[MeasurementChunk], start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     after: Union[HistoryCursor, datetime, None] = None,
+                     limit: Optional[int] = None) -> List[Union[HumidityTemperatureEntry, PlantSensorEntry]]:
+    '''
+    First entries of the chunks (in window order) in range, as the objects read from the entry tables.
+    The chunks of a regular and a plant sensor sharing a serial number cover the same windows, up to
+    limit entries are decoded from each chunk of a window (merge_pages keeps the first ones). The
+    chunks of the windows after the ones holding the first limit entries are not decoded
+    '''
+    entries = []
+    window_start, decoded = None, 0
+    for chunk in chunks:
+        if chunk.window_start != window_start:
+            if limit is not None and len(entries) >= limit:
+                break
+            window_start, decoded = chunk.window_start, len(entries)
+        remaining = limit - decoded if limit is not None else None
+        chunk_start, chunk_after = start, None
+        if after is not None:
+            timestamp, inclusive = cursor_bound(after, chunk.plant_sensor, chunk.sensor_id)
+            if inclusive:
+                chunk_start = timestamp if start is None else max(to_naive_utc(start), timestamp)
+            else:
+                chunk_after = timestamp
+        for entry_timestamp, temperature, humidity, wetness in chunk_readings(chunk.data, chunk_start, end, chunk_after, remaining):
+            if chunk.plant_sensor:
+                entries.append(PlantSensorEntry(sensor_id = chunk.sensor_id, entry_timestamp = entry_timestamp,
+                                                temperature = temperature, humidity = humidity, wetness = wetness))
+            else:
+                entries.append(HumidityTemperatureEntry(sensor_id = chunk.sensor_id, entry_timestamp = entry_timestamp,
+                                                        temperature = temperature, humidity = humidity))
+    return entries
+
+
+def export_rows(chunks: List[tuple], start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[tuple]:
+    '''
+    Readings of the rows of chunk_export_query in range, as tuples following EXPORT_COLUMNS
+    '''
+    rows = []
+    for sensor_id, plant_sensor, data in chunks:
+        sensor_type = "plant_sensor" if plant_sensor else "sensor"
+        rows += [(sensor_type, sensor_id, *reading) for reading in chunk_readings(data, start, end)]
+    return rows
+
+
+class Archiver:
+    '''
+    Move the closed windows older than archive_after into chunks, the progress is kept for status()
+    '''
+
+    def __init__(self, archive_after: timedelta, window: timedelta = timedelta(days=1), max_windows: Optional[int] = None):
+        self.archive_after = archive_after
+        self.window = window
+        #windows archived per run at most, the next run carries on
+        self.max_windows = max_windows
+
+        #counters exposed through status()
+        self.cutoff: Optional[datetime] = None
+        self.archived_rows = 0
+        self.chunks_written = 0
+        self.done = True
+        self.last_run: Optional[datetime] = None
+
+    def run(self, session: Session, now: Optional[datetime] = None) -> dict:
+        '''
+        Archive the windows that are closed, one transaction per sensor and window.
+        Use AsyncSession.run_sync with the async engine. Returns the rows and chunks archived.
+        '''
+        now = to_naive_utc(now) if now is not None else utc_now()
+        self.last_run = datetime.now(timezone.utc)
+        watermark = compacted_until(dict(session.exec(select(RollupWatermark.resolution, RollupWatermark.watermark)).all()), RAW)
+        if watermark is None:
+            #nothing is compacted yet
+            return {"archived_rows": 0, "chunks": 0}
+        self.cutoff = window_floor(min(now - self.archive_after, watermark), self.window)
+        archived_rows = chunks = 0
+        self.done = False
+
+        for table, plant_sensor in ARCHIVE_TABLES:
+            sensors = session.exec(select(table.sensor_id, func.min(table.entry_timestamp))
+                                   .where(table.entry_timestamp < self.cutoff).group_by(table.sensor_id)).all()
+            for sensor_id, first_timestamp in sensors:
+                window_start = window_floor(first_timestamp, self.window)
+                while window_start < self.cutoff:
+                    if self.max_windows is not None and chunks >= self.max_windows:
+                        return {"archived_rows": archived_rows, "chunks": chunks}
+                    archived_rows += self._archive_window(session, table, plant_sensor, sensor_id, window_start)
+                    chunks += 1
+                    #jump over the windows without readings
+                    next_timestamp = session.exec(select(func.min(table.entry_timestamp)).where(
+                        table.sensor_id == sensor_id, table.entry_timestamp >= window_start + self.window,
+                        table.entry_timestamp < self.cutoff)).one()
+                    if next_timestamp is None:
+                        break
+                    window_start = window_floor(next_timestamp, self.window)
+
+        self.done = True
+        return {"archived_rows": archived_rows, "chunks": chunks}
+
+    def _archive_window(self, session: Session, table, plant_sensor: bool, sensor_id: int, window_start: datetime) -> int:
+        columns = [table.entry_timestamp, table.temperature, table.humidity]
+        if plant_sensor:
+            columns.append(table.wetness)
+        #the rows deleted are the rows archived, even if readings arrive meanwhile
+        rows = session.execute(delete(table).where(
+            table.sensor_id == sensor_id, table.entry_timestamp >= window_start,
+            table.entry_timestamp < window_start + self.window).returning(*columns)).all()
+        if not rows:
+            #the readings of the window were archived or deleted since the run selected it
+            session.rollback()
+            return 0
+
+        readings: Dict[datetime, tuple] = {row[0]: tuple(row) for row in rows}
+        chunk = session.get(MeasurementChunk, (sensor_id, plant_sensor, window_start))
+        if chunk is not None:
+            #late readings for a window already archived, the archived reading wins over a resent one
+            readings.update((reading[0], reading[:3] + ((reading[3],) if plant_sensor else ()))
+                            for reading in chunk_readings(chunk.data))
+        readings = [readings[timestamp] for timestamp in sorted(readings)]
+
+        timestamps, temperature, humidity, *wetness = (list(column) for column in zip(*readings))
+        data = encode_chunk(timestamps, temperature, humidity, wetness[0] if plant_sensor else None)
+        session.merge(MeasurementChunk(sensor_id = sensor_id, plant_sensor = plant_sensor, window_start = window_start,
+                                       first_timestamp = timestamps[0], last_timestamp = timestamps[-1],
+                                       entry_count = len(timestamps), data = data))
+        session.commit()
+        self.archived_rows += len(rows)
+        self.chunks_written += 1
+        return len(rows)
+
+    def status(self) -> dict:
+        return {
+            "archive_after_days": self.archive_after / timedelta(days=1),
+            "window_hours": self.window / timedelta(hours=1),
+            "cutoff": self.cutoff,
+            "done": self.done,
+            "archived_rows": self.archived_rows,
+            "chunks_written": self.chunks_written,
+            "last_run": self.last_run,
+        }
@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, Iterator, List, Optional, Sequence
+from sqlalchemy import literal, null, select, union_all
+from src.orm import HumidityTemperatureEntry, PlantSensorEntry
+from src.helper_functions import to_naive_utc
+
+
+#Export of the raw entries as NDJSON or CSV. Rows are read as plain tuples with a server side
+#cursor and formatted chunk by chunk, so memory use does not depend on the size of the export.
+
+EXPORT_COLUMNS = ["sensor_type", "sensor_id", "entry_timestamp", "temperature", "humidity", "wetness"]
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+#rows fetched from the cursor at a time
+EXPORT_CHUNK_SIZE = 5000
+
+
+def export_query(start: Optional[datetime] = None, end: Optional[datetime] = None, sensor_id: Optional[int] = None):
+    '''
+    Select the entries of both tables as tuples following EXPORT_COLUMNS
+    '''
+    queries = []
+    for table, sensor_type in ((HumidityTemperatureEntry, "sensor"), (PlantSensorEntry, "plant_sensor")):
+        wetness = table.wetness if table is PlantSensorEntry else null()
+        query = select(literal(sensor_type), table.sensor_id, table.entry_timestamp, table.temperature, table.humidity, wetness)
+        if sensor_id is not None:
+            query = query.where(table.sensor_id == sensor_id)
+        if start is not None:
+            query = query.where(table.entry_timestamp >= to_naive_utc(start))
+        if end is not None:
+            query = query.where(table.entry_timestamp < to_naive_utc(end))
+        queries.append(query)
+    return union_all(*queries)
+
+
+def format_chunk(rows: Sequence[tuple], export_format: str) -> str:
+    #entry_timestamp is the third column
+    rows = [(row[0], row[1], row[2].isoformat(), *row[3:]) for row in rows]
+
+    if export_format == "csv":
+        output = io.StringIO()
+        csv.writer(output, lineterminator="\n").writerows(rows)
+        return output.getvalue()
+
+    return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+
+
+def header(export_format: str) -> str:
+    return ",".join(EXPORT_COLUMNS) + "\n" if export_format == "csv" else ""
+
+
+def format_chunks(chunks: Iterator[List[tuple]], export_format: str) -> Iterator[str]:
+    '''
+    Format the chunks yielded by a synchronous repository
+    '''
+    yield header(export_format)
+    for rows in chunks:
+        yield format_chunk(rows, export_format)
+
+
+async def aformat_chunks(chunks: AsyncIterator[List[tuple]], export_format: str) -> AsyncIterator[str]:
+    '''
+    Format the chunks yielded by the async repository
+    '''
+    yield header(export_format)
+    async for rows in chunks:
+        yield format_chunk(rows, export_format)
@@ -0,0 +1,183 @@
+import struct
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+
+#Compression of a series of readings in the style of Facebook's Gorilla time series database.
+#Timestamps (microseconds) are stored as delta-of-deltas, a regular series costs one bit per reading.
+#Each value column is stored as the XOR of a value with the previous one, a repeated value costs one
+#bit and a small change only the bits that differ.
+#A chunk is a header (version, flags, reading count) followed by one bit stream holding the
+#timestamps then each column in turn.
+
+VERSION = 1
+HEADER = struct.Struct("<BBI")
+#flags
+HAS_WETNESS = 1
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+#delta-of-delta buckets: (control bits, control bit count, value bit count), tried in order
+TIMESTAMP_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b11110, 5, 32), (0b11111, 5, 64))
+
+
+class BitWriter:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        #bits not yet written to the buffer, fewer than 8 between writes
+        self._pending = 0
+        self._pending_bits = 0
+
+    def write(self, value: int, bits: int):
+        self._pending = (self._pending << bits) | (value & ((1 << bits) - 1))
+        self._pending_bits += bits
+        while self._pending_bits >= 8:
+            self._pending_bits -= 8
+            self.buffer.append((self._pending >> self._pending_bits) & 0xFF)
+        self._pending &= (1 << self._pending_bits) - 1
+
+    def getvalue(self) -> bytes:
+        if self._pending_bits:
+            return bytes(self.buffer) + bytes([(self._pending << (8 - self._pending_bits)) & 0xFF])
+        return bytes(self.buffer)
+
+
+class BitReader:
+
+    def __init__(self, data: bytes, offset: int = 0):
+        self.data = data
+        self.index = offset
+        self._pending = 0
+        self._pending_bits = 0
+
+    def read(self, bits: int) -> int:
+        while self._pending_bits < bits:
+            if self.index >= len(self.data):
+                raise ValueError("chunk is truncated")
+            self._pending = (self._pending << 8) | self.data[self.index]
+            self.index += 1
+            self._pending_bits += 8
+        self._pending_bits -= bits
+        value = self._pending >> self._pending_bits
+        self._pending &= (1 << self._pending_bits) - 1
+        return value
+
+    def read_bit(self) -> int:
+        return self.read(1)
+
+
+def _signed(value: int, bits: int) -> int:
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+
+def write_timestamps(writer: BitWriter, timestamps: List[int]):
+    previous, delta = timestamps[0], 0
+    writer.write(previous, 64)
+    for timestamp in timestamps[1:]:
+        new_delta = timestamp - previous
+        delta_of_delta = new_delta - delta
+        previous, delta = timestamp, new_delta
+        if delta_of_delta == 0:
+            writer.write(0, 1)
+            continue
+        for control, control_bits, bits in TIMESTAMP_BUCKETS:
+            if -(1 << (bits - 1)) <= delta_of_delta < 1 << (bits - 1):
+                writer.write(control, control_bits)
+                writer.write(delta_of_delta, bits)
+                break
+
+
+def read_timestamps(reader: BitReader, count: int) -> List[int]:
+    previous, delta = _signed(reader.read(64), 64), 0
+    timestamps = [previous]
+    for _ in range(count - 1):
+        if reader.read_bit():
+            control_bits = 1
+            while control_bits < 4 and reader.read_bit():
+                control_bits += 1
+            if control_bits == 4:
+                bits = 64 if reader.read_bit() else 32
+            else:
+                bits = TIMESTAMP_BUCKETS[control_bits - 1][2]
+            delta += _signed(reader.read(bits), bits)
+        previous += delta
+        timestamps.append(previous)
+    return timestamps
+
+
+def write_values(writer: BitWriter, values: List[float]):
+    words = struct.unpack(f"<{len(values)}Q", struct.pack(f"<{len(values)}d", *values))
+    previous = words[0]
+    writer.write(previous, 64)
+    #meaningful bits window of the previous value: leading zeros, trailing zeros
+    leading, trailing = -1, 0
+    for word in words[1:]:
+        xor = word ^ previous
+        previous = word
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if leading >= 0 and new_leading >= leading and new_trailing >= trailing:
+            #fits in the window of the previous value
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = new_leading, new_trailing
+            meaningful = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            #a length of 64 is stored as 0
+            writer.write(meaningful & 63, 6)
+            writer.write(xor >> trailing, meaningful)
+
+
+def read_values(reader: BitReader, count: int) -> List[float]:
+    previous = reader.read(64)
+    words = [previous]
+    leading = trailing = 0
+    for _ in range(count - 1):
+        if reader.read_bit():
+            if reader.read_bit():
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            previous ^= reader.read(64 - leading - trailing) << trailing
+        words.append(previous)
+    return list(struct.unpack(f"<{count}d", struct.pack(f"<{count}Q", *words)))
+
+
+def encode_chunk(timestamps: List[datetime], temperature: List[float], humidity: List[float],
+                 wetness: Optional[List[float]] = None) -> bytes:
+    '''
+    Compress the readings of one sensor, timestamps (naive UTC) in increasing order
+    '''
+    if not timestamps:
+        raise ValueError("a chunk holds at least one reading")
+    writer = BitWriter()
+    write_timestamps(writer, [(timestamp - EPOCH) // MICROSECOND for timestamp in timestamps])
+    for values in (temperature, humidity, wetness):
+        if values is not None:
+            write_values(writer, values)
+    return HEADER.pack(VERSION, HAS_WETNESS if wetness is not None else 0, len(timestamps)) + writer.getvalue()
+
+
+def decode_chunk(data: bytes) -> Tuple[List[datetime], List[float], List[float], Optional[List[float]]]:
+    '''
+    (timestamps, temperature, humidity, wetness) of a chunk, wetness is None for regular sensors.
+    Raises ValueError if the chunk is malformed.
+    '''
+    if len(data) < HEADER.size:
+        raise ValueError("chunk is truncated")
+    version, flags, count = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"unsupported chunk version {version}")
+    reader = BitReader(data, HEADER.size)
+    timestamps = [EPOCH + timestamp * MICROSECOND for timestamp in read_timestamps(reader, count)]
+    temperature = read_values(reader, count)
+    humidity = read_values(reader, count)
+    wetness = read_values(reader, count) if flags & HAS_WETNESS else None
+    return timestamps, temperature, humidity, wetness
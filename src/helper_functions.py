@@ -1,6 +1,16 @@
 from src.models import *
 from src.orm import *
-from typing import Union
+from typing import Union, List, Optional, Tuple
+from pydantic import ValidationError
+from sqlalchemy import bindparam, insert, text
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from functools import lru_cache
+import csv
+import io
+import json
 import logging
 from datetime import datetime, timezone
 import pytz
@@ -47,4 +57,152 @@ def create_db_sensor_entry_from_measurement(measurement: Measurement) -> Union[P
         )
 
     return db_sensor_entry
-    
\ No newline at end of file
+    
+
+def validate_items(items: List[dict], model, id_field: str) -> Tuple[list, List[int], List[Optional[EntryResult]]]:
+    '''
+    Validate every item of a batch on its own so one invalid item does not reject the batch.
+    Returns the validated objects, their position in the batch and a list of results
+    with the invalid items already reported as failed (None for the valid ones)
+    '''
+    valid = []
+    positions = []
+    results = [None] * len(items)
+
+    for index, item in enumerate(items):
+        try:
+            valid.append(model(**item))
+        except ValidationError as e:
+            detail = "; ".join(f"{error['loc'][0]}: {error['msg']}" for error in e.errors())
+            #the id is only echoed back when it is a valid integer
+            sensor_id = item.get(id_field)
+            sensor_id = sensor_id if str(sensor_id).isdigit() else None
+            results[index] = EntryResult(index = index, sensor_id = sensor_id, status = ENTRY_FAILED, detail = detail)
+        except TypeError:
+            results[index] = EntryResult(index = index, status = ENTRY_FAILED, detail = "item must be an object")
+        else:
+            positions.append(index)
+
+    return valid, positions, results
+
+
+def merge_results(results: List[Optional[EntryResult]], positions: List[int], entry_results: List[EntryResult]) -> List[EntryResult]:
+    '''
+    Put the results returned by the repository for the valid items back at their position in the batch
+    '''
+    for position, entry_result in zip(positions, entry_results):
+        entry_result.index = position
+        results[position] = entry_result
+    return results
+
+
+def parse_sensor_rows(content: str, file_format: str) -> List[dict]:
+    '''
+    Parse a fleet of sensors from a csv file (columns serial_number, room, plant) or a json list
+    '''
+    if file_format == "csv":
+        rows = []
+        for row in csv.DictReader(io.StringIO(content)):
+            #an empty plant column means a regular sensor
+            if not row.get("plant"):
+                row["plant"] = None
+            rows.append(row)
+        return rows
+
+    rows = json.loads(content)
+    if not isinstance(rows, list):
+        raise ValueError("Expected a list of sensors")
+    return rows
+
+
+def dialect_insert(dialect_name: str, table):
+    '''
+    Return an insert construct for the table that supports ON CONFLICT clauses
+    on the dialects that have them (postgresql and sqlite)
+    '''
+    if dialect_name == "postgresql":
+        return postgresql_insert(table)
+    if dialect_name == "sqlite":
+        return sqlite_insert(table)
+    return insert(table)
+
+
+def entry_insert(dialect_name: str, table):
+    '''
+    Insert into an entry table that skips readings already recorded (same sensor_id and
+    entry_timestamp) instead of failing, on the dialects that support ON CONFLICT
+    '''
+    statement = dialect_insert(dialect_name, table)
+    if dialect_name in ("postgresql", "sqlite"):
+        statement = statement.on_conflict_do_nothing(index_elements = ["sensor_id", "entry_timestamp"])
+    return statement
+
+
+@lru_cache(maxsize = None)
+def single_entry_insert(dialect_name: str, table):
+    '''
+    entry_insert compiled once per table (see precompiled), for the inserts of a single reading
+    '''
+    return precompiled(entry_insert(dialect_name, table), dialect_name)
+
+
+def precompiled(statement, dialect_name: str):
+    '''
+    The statement compiled once into a textual statement with typed parameters, on postgresql and sqlite.
+    SQLAlchemy does not cache the ON CONFLICT inserts of these dialects, executed for every reading they
+    would be compiled again each time. The statement must not depend on the parameters it is executed with
+    '''
+    dialects = {"postgresql": postgresql, "sqlite": sqlite}
+    if dialect_name not in dialects:
+        return statement
+    compiled = statement.compile(dialect = dialects[dialect_name].dialect(paramstyle = "named"))
+    return text(compiled.string).bindparams(*[bindparam(key, type_ = parameter.type) for key, parameter in compiled.binds.items()])
+
+
+def entry_key(sensor_id: int, entry_timestamp: datetime) -> Tuple[int, datetime]:
+    #primary key of an entry, in the form the database returns it
+    return sensor_id, to_naive_utc(entry_timestamp)
+
+
+def mark_duplicates(results: List[EntryResult], rows: List[Tuple[int, dict]], inserted_keys) -> List[dict]:
+    '''
+    Flag the rows of a batch whose key was not returned by the insert as duplicates.
+    rows are (index in the batch, row) tuples, a key repeated in the batch is only
+    counted as inserted once. Returns the rows that were inserted.
+    '''
+    inserted_keys = set(inserted_keys)
+    inserted = []
+    for index, row in rows:
+        key = entry_key(row["sensor_id"], row["entry_timestamp"])
+        if key in inserted_keys:
+            inserted_keys.discard(key)
+            inserted.append(row)
+        else:
+            results[index].status = ENTRY_DUPLICATE
+            results[index].detail = "Reading already recorded"
+    return inserted
+
+
+def database_unavailable(error: BaseException) -> bool:
+    '''
+    Whether an error raised by a repository write means the database cannot be reached, so the
+    readings can be spooled and written later, rather than a write the database rejected.
+    asyncpg raises the socket errors (ConnectionRefusedError...) as they are.
+    '''
+    if isinstance(error, (OperationalError, OSError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def utc_now() -> datetime:
+    #timestamps are stored without time zone, in UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_naive_utc(timestamp: datetime) -> datetime:
+    '''
+    Convert a timestamp to the naive UTC form the database stores
+    '''
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
@@ -0,0 +1,89 @@
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple, Union
+from pydantic import TypeAdapter
+from sqlmodel import select
+from src.orm import HumidityTemperatureEntry, PlantSensorEntry
+from src.helper_functions import to_naive_utc
+
+
+#Reading measurements back. Both entry tables have the primary key (sensor_id, entry_timestamp),
+#pages are selected with a keyset cursor so every page is an index range scan, however deep in the
+#history it is. A regular and a plant sensor can share a serial number, the entries of a page are
+#ordered by (entry_timestamp, plant_sensor, sensor_id) and the cursor is the key of the last one:
+#entries with the same timestamp are not lost at a page boundary.
+
+MAX_PAGE_SIZE = 1000
+
+ENTRY_TABLES = (HumidityTemperatureEntry, PlantSensorEntry)
+
+
+class HistoryCursor(NamedTuple):
+    entry_timestamp: datetime
+    plant_sensor: bool
+    sensor_id: int
+
+
+def entry_cursor(entry: Union[HumidityTemperatureEntry, PlantSensorEntry]) -> HistoryCursor:
+    '''
+    Position of an entry in the history, the cursor of the next page when it is the last one of a page
+    '''
+    return HistoryCursor(to_naive_utc(entry.entry_timestamp), isinstance(entry, PlantSensorEntry), entry.sensor_id)
+
+
+def format_cursor(cursor: HistoryCursor) -> str:
+    return f"{cursor.entry_timestamp.isoformat()},{int(cursor.plant_sensor)},{cursor.sensor_id}"
+
+
+def parse_cursor(value: str) -> Union[HistoryCursor, datetime]:
+    '''
+    Cursor formatted by format_cursor, a timestamp alone is accepted as the cursor of the pages served
+    before and skips every entry at that timestamp. Raises ValueError if the cursor is malformed
+    '''
+    timestamp, *key = value.split(",")
+    try:
+        timestamp = TypeAdapter(datetime).validate_python(timestamp)
+    except ValueError:
+        raise ValueError(f"invalid cursor timestamp '{timestamp}'")
+    if not key:
+        return timestamp
+    if len(key) != 2 or key[0] not in ("0", "1") or not key[1].lstrip("-").isdigit():
+        raise ValueError(f"invalid cursor '{value}', expected <timestamp>,<0|1>,<sensor_id>")
+    return HistoryCursor(to_naive_utc(timestamp), key[0] == "1", int(key[1]))
+
+
+def cursor_bound(after: Union[HistoryCursor, datetime], plant_sensor: bool, sensor_id: int) -> Tuple[datetime, bool]:
+    '''
+    (timestamp, inclusive) lower bound of the entries of a sensor after the cursor, in one entry table
+    or chunk. The entries at the timestamp of the cursor are after it when their key is greater
+    '''
+    if isinstance(after, datetime):
+        return to_naive_utc(after), False
+    return to_naive_utc(after.entry_timestamp), (plant_sensor, sensor_id) > (after.plant_sensor, after.sensor_id)
+
+
+def history_queries(sensor_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    after: Union[HistoryCursor, datetime, None] = None, limit: int = 100) -> list:
+    '''
+    One query per entry table returning the next page of entries of a sensor, in timestamp order
+    '''
+    queries = []
+    for table in ENTRY_TABLES:
+        query = select(table).where(table.sensor_id == sensor_id)
+        if start is not None:
+            query = query.where(table.entry_timestamp >= to_naive_utc(start))
+        if end is not None:
+            query = query.where(table.entry_timestamp < to_naive_utc(end))
+        if after is not None:
+            timestamp, inclusive = cursor_bound(after, table is PlantSensorEntry, sensor_id)
+            query = query.where(table.entry_timestamp >= timestamp if inclusive else table.entry_timestamp > timestamp)
+        queries.append(query.order_by(table.entry_timestamp).limit(limit))
+    return queries
+
+
+def merge_pages(pages: List[list], limit: int) -> List[Union[HumidityTemperatureEntry, PlantSensorEntry]]:
+    '''
+    Merge the pages read from each entry table and keep the first entries
+    '''
+    entries = [entry for page in pages for entry in page]
+    entries.sort(key = entry_cursor)
+    return entries[:limit]
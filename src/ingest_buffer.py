@@ -0,0 +1,200 @@
+import asyncio
+import inspect
+import logging
+import time
+from typing import Callable, List, Optional, Union
+from src.orm import PlantSensorEntry, HumidityTemperatureEntry
+from src.models import ENTRY_CREATED, ENTRY_FAILED, ENTRY_DUPLICATE
+from src.spool import Spool
+from src.helper_functions import database_unavailable
+
+
+logger = logging.getLogger(__name__)
+
+
+class IngestBuffer:
+    '''
+    Write-behind buffer for sensor entries.
+    Entries are pushed on a bounded in-process queue and a background task writes
+    them to the repository in batches, as soon as flush_rows entries are waiting or
+    flush_interval_ms milliseconds have passed since the first entry of the batch
+    was received. When the queue is full, put raises asyncio.QueueFull so the caller
+    can apply backpressure.
+    If a spool is given, batches that cannot be written because the database is
+    unavailable are appended to it instead of being lost.
+    on_flushed is called with the entries of each batch once they are stored: the ones
+    created by the repository, or spooled.
+    '''
+
+    def __init__(self, repository, max_size: int = 10000, flush_rows: int = 500, flush_interval_ms: int = 200,
+                 spool: Optional[Spool] = None, on_flushed: Optional[Callable[[list], None]] = None):
+        self.repository = repository
+        self.spool = spool
+        self.on_flushed = on_flushed
+        self.max_size = max_size
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        #counters exposed through stats()
+        self.received_rows = 0
+        self.rejected_rows = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.duplicate_rows = 0
+        self.spooled_rows = 0
+        self.flush_count = 0
+        self.total_flush_latency = 0.0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def start(self):
+        '''
+        Start the background flusher, must be called from the running event loop
+        '''
+        #the queue is created here so it is bound to the loop serving the app
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        '''
+        Stop accepting entries and wait until everything queued has been written
+        '''
+        self._stopping = True
+        if self._task is not None:
+            #wake the flusher up if it is waiting on an empty queue
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+            await self._task
+            self._task = None
+
+    def put(self, sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry]):
+        '''
+        Queue an entry without waiting, raises asyncio.QueueFull if the buffer is full
+        or is shutting down
+        '''
+        if self.queue is None or self._stopping:
+            raise asyncio.QueueFull
+        try:
+            self.queue.put_nowait(sensor_entry)
+        except asyncio.QueueFull:
+            self.rejected_rows += 1
+            raise
+        self.received_rows += 1
+
+    async def _run(self):
+        while not (self._stopping and self.queue.empty()):
+            batch = await self._collect()
+            if batch:
+                await self._flush(batch)
+
+    async def _collect(self) -> List[Union[PlantSensorEntry, HumidityTemperatureEntry]]:
+        '''
+        Wait for the next batch, it is complete when it reaches flush_rows entries or
+        when the flush interval has elapsed since its first entry arrived
+        '''
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+
+        while len(batch) < self.flush_rows:
+            if self._stopping and self.queue.empty():
+                break
+            if deadline is None:
+                #nothing waiting yet, wake up regularly to notice a shutdown
+                timeout = self.flush_interval
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+            try:
+                sensor_entry = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if deadline is not None or self._stopping:
+                    break
+                continue
+
+            if sensor_entry is None:
+                #shutdown signal sent by stop
+                continue
+            batch.append(sensor_entry)
+            if deadline is None:
+                deadline = loop.time() + self.flush_interval
+
+        return batch
+
+    async def _flush(self, batch: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]):
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(self.repository.add_data_entries):
+                results = await self.repository.add_data_entries(batch)
+            else:
+                #the repository is synchronous, run it in a worker thread to keep the loop free
+                results = await asyncio.to_thread(self.repository.add_data_entries, batch)
+        except Exception as e:
+            if database_unavailable(e):
+                logger.error(f'database unavailable, could not flush {len(batch)} buffered entries')
+                logger.error(e)
+                await self._spool(batch)
+            else:
+                logger.error(f'could not flush {len(batch)} buffered entries to the database')
+                logger.error(e)
+                self.failed_rows += len(batch)
+        else:
+            failed = sum(result.status == ENTRY_FAILED for result in results)
+            duplicates = sum(result.status == ENTRY_DUPLICATE for result in results)
+            self.failed_rows += failed
+            self.duplicate_rows += duplicates
+            self.flushed_rows += len(batch) - failed - duplicates
+            self._flushed([sensor_entry for sensor_entry, result in zip(batch, results) if result.status == ENTRY_CREATED])
+
+        latency = time.perf_counter() - start
+        self.flush_count += 1
+        self.total_flush_latency += latency
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    async def _spool(self, batch: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]):
+        if self.spool is None:
+            self.failed_rows += len(batch)
+            return
+        try:
+            await asyncio.to_thread(self.spool.append, batch)
+        except OSError as e:
+            logger.error(f'could not spool {len(batch)} buffered entries')
+            logger.error(e)
+            self.failed_rows += len(batch)
+        else:
+            self.spooled_rows += len(batch)
+            self._flushed(batch)
+
+    def _flushed(self, sensor_entries: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]):
+        if not sensor_entries or self.on_flushed is None:
+            return
+        try:
+            self.on_flushed(sensor_entries)
+        except Exception as e:
+            #the entries are stored, a failing callback must not stop the flusher
+            logger.error(f'on_flushed failed for {len(sensor_entries)} entries')
+            logger.error(e)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "queue_capacity": self.max_size,
+            "received_rows": self.received_rows,
+            "rejected_rows": self.rejected_rows,
+            "flushed_rows": self.flushed_rows,
+            "failed_rows": self.failed_rows,
+            "duplicate_rows": self.duplicate_rows,
+            "spooled_rows": self.spooled_rows,
+            "flush_count": self.flush_count,
+            "last_flush_latency_ms": round(self.last_flush_latency * 1000, 3),
+            "max_flush_latency_ms": round(self.max_flush_latency * 1000, 3),
+            "avg_flush_latency_ms": round(self.total_flush_latency * 1000 / self.flush_count, 3) if self.flush_count else 0.0,
+        }
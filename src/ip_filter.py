@@ -0,0 +1,97 @@
+import ipaddress
+import json
+from functools import lru_cache
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+
+#Client IP allow-list checked for every http request and websocket before it reaches the app.
+#Networks are indexed by prefix length: an address is allowed if its first prefixlen bits are
+#the ones of an allowed network of that length, so a lookup costs one set membership test per
+#distinct prefix length whatever the number of networks. Decisions are cached per client IP.
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class NetworkSet:
+
+    def __init__(self, networks: Iterable[Network]):
+        #(ip version, shift) -> network addresses shifted to their prefix
+        prefixes: Dict[Tuple[int, int], Set[int]] = {}
+        for network in networks:
+            shift = network.max_prefixlen - network.prefixlen
+            prefixes.setdefault((network.version, shift), set()).add(int(network.network_address) >> shift)
+        #(prefix set, shift) to test for each ip version, longest prefix first
+        self._lookups: Dict[int, List[Tuple[Set[int], int]]] = {4: [], 6: []}
+        for (version, shift), values in sorted(prefixes.items(), key = lambda item: item[0][1]):
+            self._lookups[version].append((values, shift))
+
+    def __contains__(self, address: Union[ipaddress.IPv4Address, ipaddress.IPv6Address]) -> bool:
+        value = int(address)
+        return any(value >> shift in prefixes for prefixes, shift in self._lookups[address.version])
+
+
+class IPFilter:
+    '''
+    Allow or deny client IPs (as strings), with an LRU cache of the decisions
+    '''
+
+    def __init__(self, networks: Iterable[Network], cache_size: int = 4096):
+        self.networks = NetworkSet(networks)
+        self.allowed = lru_cache(maxsize = cache_size)(self._lookup)
+
+    def _lookup(self, client_ip: str) -> bool:
+        try:
+            return ipaddress.ip_address(client_ip) in self.networks
+        except ValueError:
+            #not an ip address (malformed forwarded header)
+            return False
+
+    def cache_info(self):
+        return self.allowed.cache_info()
+
+
+def client_ip(scope: dict) -> str:
+    '''
+    Original client IP of an ASGI connection, the first address of x-forwarded-for
+    when the app runs behind a reverse proxy, the peer address otherwise
+    '''
+    for name, value in scope["headers"]:
+        if name == b"x-forwarded-for":
+            # The header can contain multiple IP addresses delimited by commas
+            # due to successive proxies. The first one is the original IP.
+            return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else ""
+
+
+class IPFilterMiddleware:
+    '''
+    Pure ASGI middleware rejecting the http requests (403) and websockets (close 1008)
+    of clients outside the allow-list, without building a Request object
+    '''
+
+    def __init__(self, app, ip_filter: IPFilter):
+        self.app = app
+        self.ip_filter = ip_filter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        address = client_ip(scope)
+        if self.ip_filter.allowed(address):
+            await self.app(scope, receive, send)
+            return
+
+        if scope["type"] == "websocket":
+            await send({"type": "websocket.close", "code": 1008})
+            return
+
+        body = json.dumps({"detail": {"message": f"IP {address} is not allowed to access this resource."}}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 403,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
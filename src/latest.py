@@ -0,0 +1,109 @@
+from typing import Dict, Iterable, List, Optional, Union
+from sqlalchemy import func, literal, null, select, union_all
+from src.orm import HumidityTemperatureEntry, PlantSensorEntry, Room, Sensor, PlantSensor, Plant
+from src.helper_functions import to_naive_utc
+
+
+#In-process table of the last reading of every sensor, for the displays polling the current values.
+#It is filled once at startup from the database and then kept up to date by the ingest endpoints,
+#the latest endpoints are served from it without any query.
+
+LATEST_COLUMNS = ["sensor_type", "sensor_id", "entry_timestamp", "temperature", "humidity", "wetness"]
+
+
+def latest_query():
+    '''
+    Last entry of every sensor of both tables, in one query.
+    A window function is used rather than DISTINCT ON so it also runs on sqlite.
+    '''
+    queries = []
+    for table, sensor_type in ((HumidityTemperatureEntry, "sensor"), (PlantSensorEntry, "plant_sensor")):
+        wetness = table.wetness if table is PlantSensorEntry else null()
+        rank = func.row_number().over(partition_by = table.sensor_id, order_by = table.entry_timestamp.desc())
+        ranked = select(literal(sensor_type).label("sensor_type"), table.sensor_id, table.entry_timestamp,
+                        table.temperature, table.humidity, wetness.label("wetness"), rank.label("rank")).subquery()
+        queries.append(select(*[ranked.c[column] for column in LATEST_COLUMNS]).where(ranked.c.rank == 1))
+    return union_all(*queries)
+
+
+def room_sensors_query():
+    '''
+    (room name, serial number, plant name) of the regular and plant sensors of every room,
+    rooms without sensors are returned once with a null serial number
+    '''
+    regular = select(Room.name, Sensor.serial_number, null()).select_from(Room).outerjoin(Sensor, Sensor.room_id == Room.id)
+    plant = select(Room.name, PlantSensor.serial_number, Plant.name) \
+        .join(Plant, Plant.room_id == Room.id) \
+        .join(PlantSensor, PlantSensor.plant_id == Plant.id)
+    return union_all(regular, plant)
+
+
+def reading_from_entry(sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry]) -> dict:
+    plant_sensor = isinstance(sensor_entry, PlantSensorEntry)
+    return {
+        "sensor_type": "plant_sensor" if plant_sensor else "sensor",
+        "sensor_id": sensor_entry.sensor_id,
+        "entry_timestamp": to_naive_utc(sensor_entry.entry_timestamp),
+        "temperature": sensor_entry.temperature,
+        "humidity": sensor_entry.humidity,
+        "wetness": sensor_entry.wetness if plant_sensor else None,
+    }
+
+
+class LatestReadings:
+    '''
+    Last reading per sensor and the room and plant of every sensor (names are case insensitive).
+    It is only used from the event loop so it needs no locking.
+    '''
+
+    def __init__(self):
+        self.readings: Dict[int, dict] = {}
+        #lower case room name -> {"name": room name, "sensors": serial numbers}
+        self.rooms: Dict[str, dict] = {}
+        #serial number -> lower case room and plant names
+        self.sensor_rooms: Dict[int, str] = {}
+        self.sensor_plants: Dict[int, str] = {}
+
+    def warm(self, readings: Iterable[tuple], room_sensors: Iterable[tuple]):
+        '''
+        Fill the cache from the rows of latest_query and room_sensors_query
+        '''
+        for row in readings:
+            reading = dict(zip(LATEST_COLUMNS, row))
+            reading["entry_timestamp"] = to_naive_utc(reading["entry_timestamp"])
+            self.store(reading)
+        for room_name, serial_number, plant_name in room_sensors:
+            self.assign(room_name, serial_number, plant_name)
+
+    def update(self, sensor_entries: Iterable[Union[PlantSensorEntry, HumidityTemperatureEntry]]):
+        for sensor_entry in sensor_entries:
+            self.store(reading_from_entry(sensor_entry))
+
+    def store(self, reading: dict):
+        #readings can arrive out of order (retransmissions), an older one never replaces a newer one
+        current = self.readings.get(reading["sensor_id"])
+        if current is None or reading["entry_timestamp"] >= current["entry_timestamp"]:
+            self.readings[reading["sensor_id"]] = reading
+
+    def assign(self, room_name: str, serial_number: Optional[int] = None, plant_name: Optional[str] = None):
+        '''
+        Register a room, and a sensor in it when a serial number is given
+        '''
+        room = self.rooms.setdefault(room_name.lower(), {"name": room_name, "sensors": set()})
+        if serial_number is not None:
+            room["sensors"].add(serial_number)
+            self.sensor_rooms[serial_number] = room_name.lower()
+            if plant_name is not None:
+                self.sensor_plants[serial_number] = plant_name.lower()
+
+    def sensor(self, sensor_id: int) -> Optional[dict]:
+        return self.readings.get(sensor_id)
+
+    def room(self, room_name: str) -> Optional[List[dict]]:
+        '''
+        Last readings of the sensors of a room, None if the room is unknown
+        '''
+        room = self.rooms.get(room_name.lower())
+        if room is None:
+            return None
+        return [self.readings[sensor_id] for sensor_id in sorted(room["sensors"]) if sensor_id in self.readings]
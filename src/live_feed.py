@@ -0,0 +1,90 @@
+import asyncio
+import json
+from typing import Iterable, Optional, Set
+
+
+#In-process publish/subscribe of the new readings for the live feed endpoint.
+#The ingest endpoints publish every stored reading, each subscriber has its own bounded queue:
+#when a client reads slower than the readings arrive, its oldest readings are dropped so a
+#slow consumer never blocks ingestion or the other subscribers.
+
+
+class Subscriber:
+
+    def __init__(self, max_size: int, sensor_id: Optional[int] = None, room: Optional[str] = None,
+                 plant: Optional[str] = None):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize = max_size)
+        self.sensor_id = sensor_id
+        #room and plant names are matched case insensitively
+        self.room = room.lower() if room is not None else None
+        self.plant = plant.lower() if plant is not None else None
+        self.dropped = 0
+
+    def matches(self, message: dict) -> bool:
+        if self.sensor_id is not None and message["sensor_id"] != self.sensor_id:
+            return False
+        if self.room is not None and message["room"] != self.room:
+            return False
+        if self.plant is not None and message["plant"] != self.plant:
+            return False
+        return True
+
+    def push(self, message: dict):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        '''
+        Next message, None if nothing was published within the timeout
+        '''
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LiveFeed:
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.subscribers: Set[Subscriber] = set()
+        self.published = 0
+
+    def subscribe(self, sensor_id: Optional[int] = None, room: Optional[str] = None,
+                  plant: Optional[str] = None) -> Subscriber:
+        subscriber = Subscriber(self.queue_size, sensor_id, room, plant)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, messages: Iterable[dict]):
+        '''
+        Hand the messages to the matching subscribers, never waits
+        '''
+        for message in messages:
+            self.published += 1
+            for subscriber in self.subscribers:
+                if subscriber.matches(message):
+                    subscriber.push(message)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": sum(subscriber.dropped for subscriber in self.subscribers),
+        }
+
+
+def format_event(message: dict) -> str:
+    '''
+    Server-sent event carrying a reading as json
+    '''
+    return f"data: {json.dumps(message, default = lambda value: value.isoformat())}\n\n"
+
+
+#comment line sent when nothing happened for a while so proxies do not close the connection
+KEEPALIVE_EVENT = ": keepalive\n\n"
@@ -0,0 +1,210 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import event
+
+
+#Metrics exposed in the Prometheus text format on /metrics.
+#Everything is recorded in process with plain counters, an observation is a bisect and a few
+#additions under a lock, so instrumenting the ingest hot path costs a few microseconds.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+
+def _labels(names: Tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    '''
+    Cumulative histogram per label values, as Prometheus defines it
+    '''
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        #label values -> [count per bucket (last one is +Inf), sum]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self._series.items()]
+        for label_values, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels((*self.label_names, 'le'), (*label_values, le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, label_values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, label_values)} {cumulative}")
+        return lines
+
+
+def gauge(name: str, documentation: str, samples: Iterable[Tuple[tuple, float]], label_names: Tuple[str, ...] = (),
+          metric_type: str = "gauge") -> List[str]:
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    lines += [f"{name}{_labels(label_names, label_values)} {_number(value)}" for label_values, value in samples]
+    return lines
+
+
+class RateMeter:
+    '''
+    Events per second over a sliding window, kept in one second slots
+    '''
+
+    def __init__(self, window_seconds: int = 60):
+        self.window = window_seconds
+        self._slots = [0] * window_seconds
+        self._seconds = [0] * window_seconds
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def add(self, count: int):
+        second = int(time.monotonic())
+        slot = second % self.window
+        with self._lock:
+            if self._seconds[slot] != second:
+                self._seconds[slot] = second
+                self._slots[slot] = 0
+            self._slots[slot] += count
+            self.total += count
+
+    def rate(self) -> float:
+        now = int(time.monotonic())
+        with self._lock:
+            recent = sum(count for second, count in zip(self._seconds, self._slots) if now - second < self.window)
+        return recent / self.window
+
+
+#first keyword of a statement, and the table it reads or writes
+OPERATION_PATTERN = re.compile(r'^\s*(\w+)(?:\s+"?(\w+))?')
+TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|TABLE)\s+"?(\w+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize = 1024)
+def statement_labels(statement: str) -> Tuple[str, str]:
+    '''
+    (operation, table) labels of a statement, cached as the same statements run again and again
+    '''
+    match = OPERATION_PATTERN.match(statement)
+    if match is None:
+        return "other", ""
+    operation = match.group(1).upper()
+    if operation == "UPDATE":
+        return operation, (match.group(2) or "").lower()
+    table = TABLE_PATTERN.search(statement)
+    return operation, table.group(1).lower() if table is not None else ""
+
+
+class Metrics:
+
+    def __init__(self):
+        self.request_latency = Histogram("http_request_duration_seconds", "Latency of the http requests by route",
+                                         ("method", "route", "status"), LATENCY_BUCKETS)
+        self.statement_latency = Histogram("db_statement_duration_seconds", "Duration of the database statements",
+                                           ("operation", "table"), STATEMENT_BUCKETS)
+        self.in_flight = 0
+        self.ingest_rows = RateMeter()
+        #name -> engine whose pool is reported
+        self.engines: Dict[str, object] = {}
+
+    def observe_request(self, method: str, route: str, status: int, duration: float):
+        self.request_latency.observe(duration, method, route, status)
+
+    def instrument_engine(self, name: str, engine):
+        '''
+        Time every statement of an engine with its cursor events and report its connection pool.
+        For an async engine pass its sync_engine.
+        '''
+        self.engines[name] = engine
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            connection.info.setdefault("statement_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            start = connection.info["statement_start"].pop()
+            self.statement_latency.observe(time.perf_counter() - start, *statement_labels(statement))
+
+    def _pool_samples(self, method: str) -> List[Tuple[tuple, float]]:
+        samples = []
+        for name, engine in self.engines.items():
+            pool_method = getattr(engine.pool, method, None)
+            #pools without a fixed size (sqlite StaticPool, NullPool) do not report these
+            if callable(pool_method):
+                #QueuePool counts its overflow from -pool_size, only the connections over the size are reported
+                samples.append(((name,), max(0, pool_method()) if method == "overflow" else pool_method()))
+        return samples
+
+    def expose(self) -> str:
+        lines = self.request_latency.expose()
+        lines += gauge("http_requests_in_flight", "Requests being served", [((), self.in_flight)])
+        lines += gauge("ingest_rows_total", "Readings accepted by the ingest endpoints", [((), self.ingest_rows.total)],
+                       metric_type = "counter")
+        lines += gauge("ingest_rows_per_second", "Readings accepted per second over the last minute",
+                       [((), self.ingest_rows.rate())])
+        lines += gauge("db_pool_size", "Size of the connection pool", self._pool_samples("size"), ("engine",))
+        lines += gauge("db_pool_checked_out", "Connections in use", self._pool_samples("checkedout"), ("engine",))
+        lines += gauge("db_pool_overflow", "Connections opened over the pool size", self._pool_samples("overflow"), ("engine",))
+        lines += self.statement_latency.expose()
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    '''
+    Pure ASGI middleware timing the http requests, labelled with the route template
+    (e.g. /api/sensor/{sensor_id}/latest) so the label values stay bounded
+    '''
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        self.metrics.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            self.metrics.in_flight -= 1
+            #the router stores the matched route in the scope
+            route = scope.get("route")
+            self.metrics.observe_request(scope["method"], route.path if route is not None else "unmatched", status_code,
+                                         time.perf_counter() - start)
@@ -17,4 +17,19 @@ class Measurement(BaseModel):
 class SensorIn(BaseModel):
     serial_number: int
     room: str
-    plant: Optional[str] = None
\ No newline at end of file
+    plant: Optional[str] = None
+
+#status reported for each reading of a batch write
+ENTRY_CREATED = "created"
+ENTRY_FAILED = "failed"
+#the reading was already recorded (same sensor and timestamp), typically a retransmission
+ENTRY_DUPLICATE = "duplicate"
+#the database was unavailable, the reading was saved to the local spool and will be written later
+ENTRY_SPOOLED = "spooled"
+
+#outcome of a single reading in a batch write, index refers to the position in the submitted batch
+class EntryResult(BaseModel):
+    index: int
+    sensor_id: Optional[int] = None
+    status: str
+    detail: Optional[str] = None
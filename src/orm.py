@@ -1,6 +1,8 @@
 from datetime import datetime
 from typing import Optional, List
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index, event, func
+import sqlalchemy as sa
 
 
 #This file stores all orm models that are used to interact with the database
@@ -17,28 +19,37 @@ class Room(SQLModel, table = True):
 class Plant(SQLModel, table=True):
     __tablename__ = "plant"
     id: Optional[int] = Field (default = None, primary_key=True)
-    room_id: Optional[int] = Field(default=None, foreign_key="room.id")
+    room_id: Optional[int] = Field(default=None, foreign_key="room.id", index=True)
     room: Optional[Room] = Relationship(back_populates="plant")
     name: str = Field(unique=True)
     sensor: List[Optional["PlantSensor"]] = Relationship(back_populates="plant")
 
 class Sensor(SQLModel, table = True):
     __tablename__ = "sensor"
-    room_id: Optional[int] = Field(default=None, foreign_key="room.id")
+    room_id: Optional[int] = Field(default=None, foreign_key="room.id", index=True)
     room: Optional[Room] = Relationship(back_populates="sensor")
     serial_number: int = Field(default = 0, primary_key=True)
     humidity_temperature_entry: Optional[List["HumidityTemperatureEntry"]]= Relationship(back_populates = "sensor")
 
 class PlantSensor(SQLModel, table = True):
     __tablename__ = "plant_sensor"
-    plant_id: Optional[int] = Field(default=None, foreign_key="plant.id")
+    plant_id: Optional[int] = Field(default=None, foreign_key="plant.id", index=True)
     plant: Plant = Relationship(back_populates="sensor")
     serial_number: int = Field(default = 0, primary_key=True)
     plant_sensor_entry: Optional[List["PlantSensorEntry"]]= Relationship(back_populates = "sensor")
-  
 
+
+#rooms and plants are looked up by name case insensitively (get_room, get_plant, sensor provisioning),
+#the unique constraints on the names cannot serve a filter on lower(name). The indexes are unique so
+#"Bedroom" and "bedroom" cannot both be inserted, they are the conflict target of the provisioning inserts
+Index("ix_room_lower_name", func.lower(Room.name), unique = True)
+Index("ix_plant_lower_name", func.lower(Plant.name), unique = True)
+
+
+#Both entry tables are partitioned by month on postgres, see src/partitions.py
 class HumidityTemperatureEntry(SQLModel, table = True):
     __tablename__ = "humidity_temperature_entry"
+    __table_args__ = {"postgresql_partition_by": "RANGE (entry_timestamp)"}
     sensor_id: int = Field(default=0, foreign_key="sensor.serial_number", primary_key=True)
     sensor: Optional[Sensor] = Relationship(back_populates="humidity_temperature_entry")
     entry_timestamp : datetime = Field (primary_key=True)
@@ -48,9 +59,146 @@ class HumidityTemperatureEntry(SQLModel, table = True):
 #The plant sensors report wetness of the soil in addition to humidity and temperature
 class PlantSensorEntry(SQLModel, table = True):
     __tablename__ = "plant_sensor_entry"
+    __table_args__ = {"postgresql_partition_by": "RANGE (entry_timestamp)"}
     sensor_id: int = Field(default=0, foreign_key="plant_sensor.serial_number", primary_key=True)
     sensor: Optional[PlantSensor] = Relationship(back_populates="plant_sensor_entry")
     entry_timestamp : datetime = Field (primary_key=True)
     temperature: float = Field (ge = -40, le = 70)
     humidity: float = Field (ge = 0, le = 1)
-    wetness: float = Field (ge = 0, le = 1)
\ No newline at end of file
+    wetness: float = Field (ge = 0, le = 1)
+
+#the compaction, the archiving and the exports read the entries of a time range for all sensors. The entries
+#are written in time order, a BRIN index on postgres stays small and is barely updated by the inserts
+Index("ix_humidity_temperature_entry_entry_timestamp", HumidityTemperatureEntry.entry_timestamp, postgresql_using = "brin")
+Index("ix_plant_sensor_entry_entry_timestamp", PlantSensorEntry.entry_timestamp, postgresql_using = "brin")
+
+#Closed time windows of the entries of one sensor, archived as compressed chunks (see src/cold_storage.py)
+#and removed from the entry tables. wetness is only stored for plant sensors
+class MeasurementChunk(SQLModel, table = True):
+    __tablename__ = "measurement_chunk"
+    sensor_id: int = Field(primary_key=True)
+    plant_sensor: bool = Field(default = False, primary_key=True)
+    window_start: datetime = Field(primary_key=True)
+    first_timestamp: datetime
+    last_timestamp: datetime
+    entry_count: int
+    data: bytes
+
+#Running aggregates of the regular sensor temperatures, maintained by the repository on every insert
+#so averages can be read without scanning the whole history. They can be recomputed from the raw
+#and archived entries with the rebuild-aggregates command, unless the retention deleted readings
+class SensorAggregate(SQLModel, table = True):
+    __tablename__ = "sensor_aggregate"
+    sensor_id: int = Field(foreign_key="sensor.serial_number", primary_key=True)
+    entry_count: int = Field(default = 0)
+    temperature_sum: float = Field(default = 0)
+    temperature_min: Optional[float] = None
+    temperature_max: Optional[float] = None
+    last_timestamp: Optional[datetime] = None
+
+class RoomAggregate(SQLModel, table = True):
+    __tablename__ = "room_aggregate"
+    room_id: int = Field(foreign_key="room.id", primary_key=True)
+    entry_count: int = Field(default = 0)
+    temperature_sum: float = Field(default = 0)
+    temperature_min: Optional[float] = None
+    temperature_max: Optional[float] = None
+    last_timestamp: Optional[datetime] = None
+
+
+#Rollups of the sensor entries at several resolutions, filled in the background from a watermark
+#(see src/rollups.py). wetness is only set for plant sensors
+class RollupBase(SQLModel):
+    sensor_id: int = Field(primary_key=True)
+    plant_sensor: bool = Field(default = False, primary_key=True)
+    #the compaction of the next resolution and the retention select the buckets by time, for all sensors
+    bucket: datetime = Field(primary_key=True, index=True)
+    entry_count: int = Field(default = 0)
+    temperature_avg: float
+    temperature_min: float
+    temperature_max: float
+    humidity_avg: float
+    humidity_min: float
+    humidity_max: float
+    wetness_avg: Optional[float] = None
+    wetness_min: Optional[float] = None
+    wetness_max: Optional[float] = None
+
+class MinuteRollup(RollupBase, table = True):
+    __tablename__ = "rollup_1m"
+
+class HourRollup(RollupBase, table = True):
+    __tablename__ = "rollup_1h"
+
+class DayRollup(RollupBase, table = True):
+    __tablename__ = "rollup_1d"
+
+#end (exclusive) of the period already compacted for each resolution, and time before which the
+#retention deleted readings (see src/retention.py)
+class RollupWatermark(SQLModel, table = True):
+    __tablename__ = "rollup_watermark"
+    resolution: str = Field(primary_key=True)
+    watermark: datetime
+
+#Entries written late, in a minute the compaction may already have read (spool replay, gateway batches,
+#device timestamps). The insert queues them, one row per rollup fed from the raw entries, and the
+#compaction merges them into the buckets already compacted (see src/rollups.py)
+class LateEntry(SQLModel, table = True):
+    __tablename__ = "late_entry"
+    rollup: str = Field(primary_key=True)
+    #the compaction consumes the queue by time range
+    entry_timestamp: datetime = Field(primary_key=True)
+    plant_sensor: bool = Field(default = False, primary_key=True)
+    sensor_id: int = Field(primary_key=True)
+    temperature: float
+    humidity: float
+    wetness: Optional[float] = None
+
+#Hourly statistics of every room over the measurements of both its sensors and the sensors of its plants,
+#filled incrementally from the room_measurement view (see src/room_stats.py)
+class RoomRollup(SQLModel, table = True):
+    __tablename__ = "room_rollup_1h"
+    room_id: int = Field(foreign_key="room.id", primary_key=True)
+    bucket: datetime = Field(primary_key=True)
+    entry_count: int = Field(default = 0)
+    temperature_sum: float = Field(default = 0)
+    temperature_min: float
+    temperature_max: float
+    humidity_sum: float = Field(default = 0)
+    humidity_min: float
+    humidity_max: float
+    last_timestamp: datetime
+
+
+#Measurements of both entry tables resolved to their room, through sensor.room_id for the regular sensors
+#and plant.room_id for the plant sensors. Sensors without a room are left out.
+#The view is created with the tables (and by the alembic migration)
+def room_measurement_select():
+    return sa.union_all(
+        sa.select(Sensor.room_id, HumidityTemperatureEntry.sensor_id, sa.literal(False).label("plant_sensor"),
+                  HumidityTemperatureEntry.entry_timestamp, HumidityTemperatureEntry.temperature,
+                  HumidityTemperatureEntry.humidity, sa.null().label("wetness"))
+            .join(Sensor, HumidityTemperatureEntry.sensor_id == Sensor.serial_number)
+            .where(Sensor.room_id.is_not(None)),
+        sa.select(Plant.room_id, PlantSensorEntry.sensor_id, sa.literal(True).label("plant_sensor"),
+                  PlantSensorEntry.entry_timestamp, PlantSensorEntry.temperature,
+                  PlantSensorEntry.humidity, PlantSensorEntry.wetness)
+            .join(PlantSensor, PlantSensorEntry.sensor_id == PlantSensor.serial_number)
+            .join(Plant, PlantSensor.plant_id == Plant.id)
+            .where(Plant.room_id.is_not(None)),
+    )
+
+room_measurement = sa.table("room_measurement",
+    sa.column("room_id", sa.Integer), sa.column("sensor_id", sa.Integer), sa.column("plant_sensor", sa.Boolean),
+    sa.column("entry_timestamp", sa.DateTime), sa.column("temperature", sa.Float), sa.column("humidity", sa.Float),
+    sa.column("wetness", sa.Float))
+
+@event.listens_for(SQLModel.metadata, "after_create")
+def _create_room_measurement(target, connection, **kw):
+    definition = room_measurement_select().compile(connection, compile_kwargs = {"literal_binds": True})
+    create = "CREATE OR REPLACE VIEW" if connection.dialect.name == "postgresql" else "CREATE VIEW IF NOT EXISTS"
+    connection.execute(sa.text(f"{create} room_measurement AS {definition}"))
+
+@event.listens_for(SQLModel.metadata, "before_drop")
+def _drop_room_measurement(target, connection, **kw):
+    connection.execute(sa.text("DROP VIEW IF EXISTS room_measurement"))
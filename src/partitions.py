@@ -0,0 +1,99 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy import text
+from src.orm import HumidityTemperatureEntry, PlantSensorEntry
+from src.helper_functions import to_naive_utc, utc_now
+
+
+#Monthly range partitioning of the entry tables on postgres (see the partition migration).
+#Both tables are partitioned by entry_timestamp, one partition per month named <table>_yYYYYmMM,
+#plus a default partition catching the readings of months that have no partition. Partitions are
+#created ahead of time by the maintenance job. The repository filters on the bare entry_timestamp
+#column, so postgres prunes the partitions outside the bounds of time-bounded queries.
+
+PARTITIONED_TABLES = (HumidityTemperatureEntry.__tablename__, PlantSensorEntry.__tablename__)
+DEFAULT_SUFFIX = "_default"
+
+
+def month_floor(timestamp: datetime) -> datetime:
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+
+def partitioned_tables(connection) -> List[str]:
+    '''
+    Entry tables that are partitioned, none before the partition migration
+    '''
+    rows = connection.execute(text(
+        "SELECT pg_class.relname FROM pg_partitioned_table JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid "
+        "WHERE pg_class.relname = ANY(:tables)"), {"tables": list(PARTITIONED_TABLES)})
+    return [row[0] for row in rows]
+
+
+def existing_partitions(connection, table: str) -> set:
+    rows = connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = :table"), {"table": table})
+    return {row[0] for row in rows}
+
+
+def partition_statements(table: str, month: datetime, default_has_rows: bool) -> List[str]:
+    '''
+    DDL creating the partition of a month. Postgres refuses to create a partition while the default
+    partition holds rows of its range, they are then moved to the new partition with the default
+    one detached.
+    '''
+    name = partition_name(table, month)
+    start, end = month.isoformat(sep = " "), add_months(month, 1).isoformat(sep = " ")
+    create = f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}')"
+    if not default_has_rows:
+        return [create]
+    default = table + DEFAULT_SUFFIX
+    in_range = f"entry_timestamp >= '{start}' AND entry_timestamp < '{end}'"
+    return [
+        f"ALTER TABLE {table} DETACH PARTITION {default}",
+        create,
+        f"INSERT INTO {name} SELECT * FROM {default} WHERE {in_range}",
+        f"DELETE FROM {default} WHERE {in_range}",
+        f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT",
+    ]
+
+
+def maintain_partitions(connection, now: Optional[datetime] = None, months_ahead: int = 3) -> Dict[str, List[str]]:
+    '''
+    Create the partitions of the current month and of the next months_ahead months that are missing,
+    and the default partition. Takes a sync connection in a transaction. Returns the partitions created
+    per table, nothing is done if the database is not postgres or the tables are not partitioned.
+    '''
+    if connection.dialect.name != "postgresql":
+        return {}
+    now = to_naive_utc(now) if now is not None else utc_now()
+    created = {}
+    for table in partitioned_tables(connection):
+        existing = existing_partitions(connection, table)
+        created[table] = []
+        default = table + DEFAULT_SUFFIX
+        if default not in existing:
+            connection.execute(text(f"CREATE TABLE {default} PARTITION OF {table} DEFAULT"))
+            created[table].append(default)
+        for months in range(months_ahead + 1):
+            month = add_months(month_floor(now), months)
+            if partition_name(table, month) in existing:
+                continue
+            default_has_rows = connection.execute(text(
+                f"SELECT EXISTS (SELECT 1 FROM {default} WHERE entry_timestamp >= :start AND entry_timestamp < :end)"),
+                {"start": month, "end": add_months(month, 1)}).scalar()
+            for statement in partition_statements(table, month, default_has_rows):
+                connection.execute(text(statement))
+            created[table].append(partition_name(table, month))
+    return created
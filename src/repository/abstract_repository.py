@@ -1,7 +1,7 @@
 import abc
 from src.models import *
 from src.orm import *
-from typing import Union
+from typing import Union, List
 
 class AbstractRepository(abc.ABC):
 
@@ -33,6 +33,62 @@ class AbstractRepository(abc.ABC):
     def add_data_entry(self, sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry]):
         raise NotImplementedError
     
+    @abc.abstractmethod
+    def add_data_entries(self, sensor_entries: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def provision_sensor(self, sensor_in: SensorIn):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def provision_sensors(self, sensors_in: List[SensorIn]):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def rebuild_aggregates(self):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def get_measurements(self, sensor_id: int, start = None, end = None, after = None, limit: int = 100):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def stream_measurements(self, start = None, end = None, sensor_id: Optional[int] = None, chunk_size: int = 5000):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def compact_rollups(self, now = None):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def get_rollup(self, sensor_id: int, start, end, points: int):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def get_room_stats(self, room = None, start = None, end = None):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def get_latest_readings(self):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def get_room_sensors(self):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def maintain_partitions(self, months_ahead: int = 3):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def apply_retention(self, retention):
+        raise NotImplementedError
+    
+    @abc.abstractmethod
+    def archive_measurements(self, archiver):
+        raise NotImplementedError
+    
     @abc.abstractmethod
     def get_average_temperature(avg_room):
         raise NotImplementedError
@@ -0,0 +1,267 @@
+from sqlmodel import select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..orm import *
+from ..models import EntryResult, SensorIn
+from ..export import export_query, EXPORT_CHUNK_SIZE
+from ..latest import latest_query, room_sensors_query
+from ..rollups import pick_resolution, rollup_query, ROLLUP_GRACE
+from ..partitions import maintain_partitions
+from ..retention import RetentionEngine
+from ..room_stats import room_stats_query
+from ..cold_storage import Archiver, chunk_export_query, export_rows, EXPORT_CHUNKS_PER_BATCH
+from ..history import HistoryCursor
+from . import operations
+import logging
+from .abstract_repository import AbstractRepository
+from typing import Union, List
+from datetime import timedelta
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSQLModelRepository(AbstractRepository):
+    '''
+    Same contract as SQLModel_repository but built on an async engine, every method
+    is a coroutine so database round trips do not block the event loop
+    '''
+
+    def __init__(self, engine, lean_writes: bool = False, rollup_grace: timedelta = ROLLUP_GRACE,
+                 write_horizon: Optional[timedelta] = None):
+        self.engine = engine
+        #when set, single entries are returned without being read back, see SQLModel_repository
+        self.lean_writes = lean_writes
+        self.rollup_grace = rollup_grace
+        self.write_horizon = write_horizon
+
+    def _session(self) -> AsyncSession:
+        #objects are returned to the endpoints after the session is closed,
+        #they must not expire on commit as they cannot be lazily reloaded in async mode
+        return AsyncSession(self.engine, expire_on_commit=False)
+
+    async def get_room(self, room: Room):
+        '''
+        Method to check if a room exists in the database
+        '''
+
+        async with self._session() as session:
+            #this method is case insensitive
+            if isinstance(room.name, str):
+                room = (await session.exec(operations.name_query(Room, room.name))).first()
+            else:
+                room = None
+        return room
+
+    async def add_room(self, room: Room):
+        '''
+        Add a room to the database table is it does not exist
+        This method is not case sensitive (if Living-Room is saved in the database,
+        living-room would not be save)
+        '''
+
+        #Check if room is already in database (not case sensitive)
+        if await self.get_room(room):
+            raise ValueError(f"Room with name {room.name} already exists.")
+
+        #Validation is not performed by pydantic when the SQLmodel as Table set to True, so this method
+        #makes sure the room name is a string
+        if not isinstance(room.name, str):
+            raise TypeError('Room name must be a string')
+
+        async with self._session() as session:
+            session.add(room)
+            await session.commit()
+            await session.refresh(room)
+        return room
+
+    async def add_plant(self, plant):
+        '''
+        Add a new plant in the database, plant name is unique.
+        This method is only be called when adding a plant sensor to the database currently
+        '''
+        if isinstance(plant.name, str):
+            plant.name = plant.name.lower()
+
+        async with self._session() as session:
+            session.add(plant)
+            await session.commit()
+            await session.refresh(plant)
+
+        return plant
+
+    async def get_plant(self, plant: Plant):
+        '''
+        Method to check if a plant already exists in the database (not case sensitive)
+        '''
+        async with self._session() as session:
+            if isinstance(plant.name, str):
+                plant = (await session.exec(operations.name_query(Plant, plant.name))).first()
+            else:
+                plant = None
+        return plant
+
+    async def add_sensor(self, sensor: Union[Sensor, PlantSensor]):
+        '''
+        Add sensor to the database, depending on the class that is passed in,
+        it will save a plant or regular sensor
+        '''
+        async with self._session() as session:
+            session.add(sensor)
+            await session.commit()
+            await session.refresh(sensor)
+
+        return sensor
+
+    async def get_sensor(self, sensor: Union[PlantSensor, Sensor]):
+        '''
+        Get sensor, depending on the class of sensor it will find the plant or regular sensor
+        '''
+        async with self._session() as session:
+            if isinstance(sensor, (Sensor, PlantSensor)):
+                sensor = (await session.exec(operations.sensor_query(sensor))).first()
+
+        return sensor
+
+    async def add_data_entry(self, sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry]):
+        '''
+        Add measurements to the database, depending on the type of data,
+        it will be added to the relevent table.
+        Returns None if the reading is already recorded, see SQLModel_repository.add_data_entry
+        '''
+        if self.lean_writes:
+            async with self.engine.begin() as connection:
+                return await connection.run_sync(operations.add_entry_lean, self.engine.dialect.name, sensor_entry,
+                                                 self.rollup_grace, self.write_horizon)
+        async with self._session() as session:
+            return await session.run_sync(operations.add_entry, self.engine.dialect.name, sensor_entry,
+                                          self.rollup_grace, self.write_horizon)
+
+    async def add_data_entries(self, sensor_entries: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]) -> List[EntryResult]:
+        '''
+        Add a batch of measurements in a single transaction, see SQLModel_repository.add_data_entries
+        '''
+        async with self._session() as session:
+            return await session.run_sync(operations.add_entries, self.engine.dialect.name, sensor_entries,
+                                          self.rollup_grace, self.write_horizon)
+
+    async def rebuild_aggregates(self):
+        '''
+        Recompute the sensor and room aggregates from the raw entries, in a single transaction
+        '''
+        async with self._session() as session:
+            await session.run_sync(operations.rebuild_aggregates, self.engine.dialect.name)
+
+    async def get_measurements(self, sensor_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                               after: Union[HistoryCursor, datetime, None] = None, limit: int = 100) -> List[Union[HumidityTemperatureEntry, PlantSensorEntry]]:
+        '''
+        Return a page of the measurements of a sensor, see SQLModel_repository.get_measurements
+        '''
+        async with self._session() as session:
+            return await session.run_sync(operations.get_measurements, sensor_id, start, end, after, limit)
+
+    async def stream_measurements(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                  sensor_id: Optional[int] = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+        '''
+        Async generator yielding the entries as lists of plain tuples, see SQLModel_repository.stream_measurements
+        '''
+        async with self.engine.connect() as connection:
+            result = await connection.stream(export_query(start, end, sensor_id).execution_options(yield_per=chunk_size))
+            async for rows in result.partitions():
+                yield rows
+            result = await connection.stream(chunk_export_query(start, end, sensor_id).execution_options(yield_per=EXPORT_CHUNKS_PER_BATCH))
+            async for chunks in result.partitions():
+                yield export_rows(chunks, start, end)
+
+    async def compact_rollups(self, now: Optional[datetime] = None) -> dict:
+        '''
+        Fill the rollups up to the last closed bucket, see SQLModel_repository.compact_rollups
+        '''
+        async with self._session() as session:
+            return await session.run_sync(operations.compact, self.engine.dialect.name, now, self.rollup_grace)
+
+    async def get_room_stats(self, room: Optional[Room] = None, start: Optional[datetime] = None,
+                             end: Optional[datetime] = None) -> List[tuple]:
+        '''
+        Statistics of every room (or of one room), see SQLModel_repository.get_room_stats
+        '''
+        async with self._session() as session:
+            return (await session.exec(room_stats_query(room, start, end))).all()
+
+    async def maintain_partitions(self, months_ahead: int = 3) -> dict:
+        '''
+        Create the missing monthly partitions of the entry tables, see SQLModel_repository.maintain_partitions
+        '''
+        async with self.engine.begin() as connection:
+            return await connection.run_sync(maintain_partitions, months_ahead = months_ahead)
+
+    async def apply_retention(self, retention: RetentionEngine) -> dict:
+        '''
+        Delete the rows expired under the retention policy, see SQLModel_repository.apply_retention
+        '''
+        async with self.engine.connect() as connection:
+            return await connection.run_sync(retention.run)
+
+    async def archive_measurements(self, archiver: Archiver) -> dict:
+        '''
+        Move the closed windows of old entries into compressed chunks, see SQLModel_repository.archive_measurements
+        '''
+        async with self._session() as session:
+            return await session.run_sync(archiver.run)
+
+    async def get_rollup(self, sensor_id: int, start: datetime, end: datetime, points: int):
+        '''
+        Return the rollup of a sensor at the coarsest resolution giving at least the requested
+        number of points, see SQLModel_repository.get_rollup
+        '''
+        resolution = pick_resolution(start, end, points)
+        async with self._session() as session:
+            rows = (await session.exec(rollup_query(resolution, sensor_id, start, end))).all()
+        return resolution.name, rows
+
+    async def get_latest_readings(self) -> List[tuple]:
+        '''
+        Last entry of every sensor, see SQLModel_repository.get_latest_readings
+        '''
+        async with self._session() as session:
+            return (await session.exec(latest_query())).all()
+
+    async def get_room_sensors(self) -> List[tuple]:
+        '''
+        (room name, serial number) of every sensor, see SQLModel_repository.get_room_sensors
+        '''
+        async with self._session() as session:
+            return (await session.exec(room_sensors_query())).all()
+
+    async def provision_sensor(self, sensor_in: SensorIn) -> Union[Sensor, PlantSensor]:
+        '''
+        Register a sensor in a single transaction, see SQLModel_repository.provision_sensor
+        '''
+        async with self._session() as session:
+            return await session.run_sync(operations.provision_sensor, self.engine.dialect.name, sensor_in)
+
+    async def provision_sensors(self, sensors_in: List[SensorIn]) -> List[EntryResult]:
+        '''
+        Register a fleet of sensors in a single transaction, see SQLModel_repository.provision_sensors
+        '''
+        async with self._session() as session:
+            return await session.run_sync(operations.provision_sensors, self.engine.dialect.name, sensors_in)
+
+    async def get_average_temperature(self, room : Optional[Room] = None):
+        '''
+        This method returns the average temperature of a room (or of all sensors if no
+        room is given), read from the running aggregates.
+        For now it only considers temperature from regular sensor
+        '''
+
+        average_temperature = None
+
+        async with self._session() as session:
+            try:
+                aggregate = (await session.exec(operations.average_temperature_query(room))).first()
+            except Exception as e:
+                logger.error("could not calculate average temperature")
+                logger.error(e)
+            else:
+                average_temperature = operations.average_temperature(aggregate)
+
+        return average_temperature
@@ -0,0 +1,372 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Union
+from sqlmodel import Session, select, func
+from sqlalchemy import Connection, insert
+from sqlalchemy.exc import IntegrityError, DataError
+from ..orm import *
+from ..models import EntryResult, SensorIn, ENTRY_CREATED, ENTRY_FAILED, ENTRY_DUPLICATE
+from ..helper_functions import dialect_insert, entry_insert, single_entry_insert, entry_key, mark_duplicates, to_naive_utc, utc_now
+from ..history import HistoryCursor, history_queries, merge_pages
+from ..rollups import compact_rollups, late_cutoff, ROLLUP_GRACE
+from ..room_stats import ROOM_ROLLUP, refresh_room_rollup, queue_late_measurements
+from ..retention import readings_expired_before
+from ..cold_storage import chunk_query, archived_entries, chunk_readings
+from ..aggregates import compute_deltas, add_statements, upsert_parameters, room_upsert_parameters, rebuild_statements, room_filter
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+#Statements and transactions shared by SQLModel_repository and AsyncSQLModelRepository.
+#Every function takes a sync Session, the async repository runs them with AsyncSession.run_sync
+#so both backends build the same statements and handle their results the same way, only the
+#execution differs. The queries read with a single statement are built here and executed by
+#the repositories directly.
+
+def name_query(table, name: str):
+    '''
+    Room or plant with this name (case insensitive)
+    '''
+    return select(table).where(func.lower(table.name) == name.lower())
+
+
+def sensor_query(sensor: Union[Sensor, PlantSensor]):
+    '''
+    Regular or plant sensor with the serial number of the one passed in, depending on its class
+    '''
+    table = type(sensor)
+    return select(table).where(table.serial_number == sensor.serial_number)
+
+
+def beyond_horizon(entry_timestamp: datetime, horizon: Optional[timedelta]) -> bool:
+    '''
+    Whether a reading is older than the write horizon of the repository: its window may already be
+    archived or deleted by the retention, written again it would be counted twice
+    '''
+    return horizon is not None and to_naive_utc(entry_timestamp) < utc_now() - horizon
+
+
+def horizon_error(horizon: timedelta) -> str:
+    return f"Reading older than the write horizon of {horizon}, it may already be archived or deleted"
+
+
+def check_horizon(sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry], horizon: Optional[timedelta]):
+    if beyond_horizon(sensor_entry.entry_timestamp, horizon):
+        raise ValueError(horizon_error(horizon))
+
+
+def add_entry(session: Session, dialect_name: str, sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry],
+              grace: timedelta = ROLLUP_GRACE, horizon: Optional[timedelta] = None):
+    '''
+    Insert one entry and add it to the aggregates and rollups in one transaction. Returns None if
+    the reading is already recorded, the stored entry read back otherwise. Raises ValueError if the
+    reading is older than the horizon
+    '''
+    check_horizon(sensor_entry, horizon)
+    table = type(sensor_entry)
+    if not insert_entry(session, dialect_name, table, sensor_entry.model_dump(), grace):
+        return None
+    session.commit()
+    return session.get(table, (sensor_entry.sensor_id, sensor_entry.entry_timestamp))
+
+
+def add_entry_lean(connection: Connection, dialect_name: str, sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry],
+                   grace: timedelta = ROLLUP_GRACE, horizon: Optional[timedelta] = None):
+    '''
+    Insert one entry like add_entry, on a connection in the transaction begun by the caller: no session
+    and no read back, all the fields of the entry are already known. Returns None if the reading is
+    already recorded, the entry as passed in otherwise
+    '''
+    check_horizon(sensor_entry, horizon)
+    if not insert_entry(connection, dialect_name, type(sensor_entry), sensor_entry.model_dump(), grace):
+        return None
+    return sensor_entry
+
+
+def insert_entry(session: Union[Session, Connection], dialect_name: str, table, row: dict, grace: timedelta = ROLLUP_GRACE) -> bool:
+    '''
+    Insert one entry and add it to the aggregates, returns False if it was already recorded.
+    grace is the one of the rollup compaction, see src/rollups.py. The statements are compiled once,
+    see precompiled
+    '''
+    result = session.execute(single_entry_insert(dialect_name, table.__table__), row)
+    if result.rowcount == 0:
+        return False
+    if table is HumidityTemperatureEntry:
+        update_aggregates(session, dialect_name, [row])
+    queue_late_measurements(session, dialect_name, {table: [row]}, late_cutoff(grace))
+    return True
+
+
+def add_entries(session: Session, dialect_name: str, sensor_entries: List[Union[PlantSensorEntry, HumidityTemperatureEntry]],
+                grace: timedelta = ROLLUP_GRACE, horizon: Optional[timedelta] = None) -> List[EntryResult]:
+    '''
+    Add a batch of measurements in a single transaction, see SQLModel_repository.add_data_entries
+    '''
+    results = [EntryResult(index = index, sensor_id = sensor_entry.sensor_id, status = ENTRY_CREATED)
+               for index, sensor_entry in enumerate(sensor_entries)]
+
+    tables = {HumidityTemperatureEntry: [], PlantSensorEntry: []}
+    for index, sensor_entry in enumerate(sensor_entries):
+        if beyond_horizon(sensor_entry.entry_timestamp, horizon):
+            results[index].status = ENTRY_FAILED
+            results[index].detail = horizon_error(horizon)
+        else:
+            tables[type(sensor_entry)].append((index, sensor_entry.model_dump()))
+
+    try:
+        inserted = {}
+        for table, rows in tables.items():
+            if rows:
+                inserted[table] = insert_rows(session, dialect_name, table, rows, results)
+        update_aggregates(session, dialect_name, inserted.get(HumidityTemperatureEntry, []))
+        queue_late_measurements(session, dialect_name, inserted, late_cutoff(grace))
+        session.commit()
+    except (IntegrityError, DataError) as e:
+        session.rollback()
+        logger.warning(f'batch insert rejected, retrying {len(sensor_entries)} entries one by one')
+        logger.debug(e)
+    else:
+        return results
+
+    #slow path, each row gets its own savepoint so one bad reading does not cancel the batch
+    for table, rows in tables.items():
+        statement = entry_insert(dialect_name, table.__table__)
+        for index, row in rows:
+            results[index].status, results[index].detail = ENTRY_CREATED, None
+            try:
+                with session.begin_nested():
+                    if session.execute(statement, row).rowcount == 0:
+                        results[index].status = ENTRY_DUPLICATE
+                        results[index].detail = "Reading already recorded"
+            except (IntegrityError, DataError) as e:
+                logger.error(f'could not save the sensor entry {index} of the batch in the database')
+                results[index].status = ENTRY_FAILED
+                results[index].detail = str(e.orig)
+    inserted = {table: [row for index, row in rows if results[index].status == ENTRY_CREATED]
+                for table, rows in tables.items()}
+    update_aggregates(session, dialect_name, inserted[HumidityTemperatureEntry])
+    queue_late_measurements(session, dialect_name, inserted, late_cutoff(grace))
+    session.commit()
+
+    return results
+
+
+def insert_rows(session: Session, dialect_name: str, table, rows: List[tuple], results: List[EntryResult]) -> List[dict]:
+    '''
+    Insert the (index, row) tuples of a batch in one entry table, flag the readings
+    already recorded as duplicates and return the rows that were inserted
+    '''
+    statement = entry_insert(dialect_name, table.__table__)
+    if dialect_name not in ("postgresql", "sqlite"):
+        session.execute(statement, [row for _, row in rows])
+        return [row for _, row in rows]
+
+    columns = table.__table__.c
+    returned = session.execute(statement.returning(columns.sensor_id, columns.entry_timestamp), [row for _, row in rows])
+    return mark_duplicates(results, rows, [entry_key(*key) for key in returned])
+
+
+def update_aggregates(session: Session, dialect_name: str, rows: List[dict]):
+    '''
+    Add the regular sensor entries that were just inserted to the running aggregates
+    of their sensor and room, in the same transaction as the insert
+    '''
+    if rows:
+        add_deltas(session, dialect_name, compute_deltas(rows))
+
+
+def add_deltas(session: Session, dialect_name: str, deltas: Dict[int, dict]):
+    '''
+    Add sensor deltas (see compute_deltas) to the aggregates of the sensors and of their rooms,
+    one statement each
+    '''
+    if not deltas:
+        return
+    sensor_upsert, room_upsert = add_statements(dialect_name, len(deltas))
+    session.execute(sensor_upsert, upsert_parameters(deltas, "sensor_id"))
+    session.execute(room_upsert, room_upsert_parameters(deltas))
+
+
+def rebuild_aggregates(session: Session, dialect_name: str):
+    '''
+    Recompute the sensor and room aggregates from the raw entries and the archived ones, in a
+    single transaction. Raises ValueError once the retention has deleted readings, the aggregates
+    still count them and they cannot be recomputed.
+    '''
+    for statement in rebuild_statements(dialect_name):
+        session.execute(statement)
+    #checked once the tables are locked, so the retention cannot delete readings meanwhile
+    expired = readings_expired_before(session)
+    if expired is not None:
+        session.rollback()
+        raise ValueError(f"the readings before {expired} were deleted by the retention, the aggregates cannot be rebuilt")
+
+    chunks = session.execute(select(MeasurementChunk.sensor_id, MeasurementChunk.data).where(MeasurementChunk.plant_sensor == False))
+    add_deltas(session, dialect_name, compute_deltas(
+        {"sensor_id": sensor_id, "entry_timestamp": reading[0], "temperature": reading[1]}
+        for sensor_id, data in chunks for reading in chunk_readings(data)))
+    session.commit()
+
+
+def get_measurements(session: Session, sensor_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     after: Union[HistoryCursor, datetime, None] = None, limit: int = 100) -> List[Union[HumidityTemperatureEntry, PlantSensorEntry]]:
+    '''
+    A page of the measurements of a sensor, the live rows of both entry tables merged with the archived ones
+    '''
+    pages = [session.execute(query).scalars().all() for query in history_queries(sensor_id, start, end, after, limit)]
+    chunks = session.execute(chunk_query(sensor_id, start, end, after, limit)).scalars().all()
+    return merge_pages(pages + [archived_entries(chunks, start, end, after, limit)], limit)
+
+
+def compact(session: Session, dialect_name: str, now: Optional[datetime] = None, grace: timedelta = ROLLUP_GRACE) -> dict:
+    '''
+    Compact the sensor rollups and refresh the room rollup, returns the watermark of each rollup
+    '''
+    watermarks = compact_rollups(session, dialect_name, now, grace)
+    watermarks[ROOM_ROLLUP] = refresh_room_rollup(session, dialect_name, now, grace)
+    return watermarks
+
+
+def provision_sensor(session: Session, dialect_name: str, sensor_in: SensorIn) -> Union[Sensor, PlantSensor]:
+    '''
+    Register a sensor with its room (and plant), see SQLModel_repository.provision_sensor
+    '''
+    room_id = get_or_create(session, dialect_name, Room, sensor_in.room, {})
+
+    if sensor_in.plant is not None:
+        #plant names are stored in lower case, see add_plant
+        plant_id = get_or_create(session, dialect_name, Plant, sensor_in.plant.lower(), {"room_id": room_id})
+        sensor = PlantSensor(serial_number = sensor_in.serial_number, plant_id = plant_id)
+    else:
+        sensor = Sensor(serial_number = sensor_in.serial_number, room_id = room_id)
+
+    session.execute(insert(type(sensor)).values(**sensor.model_dump()))
+    session.commit()
+    return sensor
+
+
+def get_or_create(session: Session, dialect_name: str, table, name: str, values: dict) -> int:
+    '''
+    Return the id of the room or plant with this name (case insensitive), inserting it if it
+    does not exist yet. The insert skips the names conflicting on the unique lower(name) index,
+    so concurrent registrations of the same room or plant (whatever their case) do not fail or
+    create two rows, the row created by the other request is used instead.
+    '''
+    lookup = select(table.id).where(func.lower(table.name) == name.lower())
+    row_id = session.scalar(lookup)
+    if row_id is not None:
+        return row_id
+
+    statement = dialect_insert(dialect_name, table).values(name = name, **values)
+    if dialect_name in ("postgresql", "sqlite"):
+        statement = statement.on_conflict_do_nothing(index_elements = [func.lower(table.name)])
+    row_id = session.execute(statement.returning(table.id)).scalar()
+    if row_id is None:
+        #lost the race against another registration, read the row it created
+        row_id = session.scalar(lookup)
+    return row_id
+
+
+def provision_sensors(session: Session, dialect_name: str, sensors_in: List[SensorIn]) -> List[EntryResult]:
+    '''
+    Register a fleet of sensors in a single transaction, see SQLModel_repository.provision_sensors
+    '''
+    results = [EntryResult(index = index, sensor_id = sensor_in.serial_number, status = ENTRY_CREATED)
+               for index, sensor_in in enumerate(sensors_in)]
+
+    #the first spelling of a name in the batch is the one that gets saved
+    rooms = {}
+    for sensor_in in sensors_in:
+        rooms.setdefault(sensor_in.room.lower(), {"name": sensor_in.room})
+    room_ids = get_or_create_many(session, dialect_name, Room, rooms)
+
+    plants = {}
+    for sensor_in in sensors_in:
+        if sensor_in.plant is not None:
+            plants.setdefault(sensor_in.plant.lower(), {"name": sensor_in.plant.lower(),
+                                                        "room_id": room_ids[sensor_in.room.lower()]})
+    plant_ids = get_or_create_many(session, dialect_name, Plant, plants)
+
+    serial_numbers = [sensor_in.serial_number for sensor_in in sensors_in]
+    existing = set(session.execute(select(Sensor.serial_number).where(Sensor.serial_number.in_(serial_numbers))).scalars())
+    existing.update(session.execute(select(PlantSensor.serial_number).where(PlantSensor.serial_number.in_(serial_numbers))).scalars())
+
+    tables = {Sensor: [], PlantSensor: []}
+    for index, sensor_in in enumerate(sensors_in):
+        if sensor_in.serial_number in existing:
+            results[index].status = ENTRY_FAILED
+            results[index].detail = "Sensor already exists in database"
+            continue
+        #a serial number repeated in the batch is only created once
+        existing.add(sensor_in.serial_number)
+        if sensor_in.plant is not None:
+            tables[PlantSensor].append((index, {"serial_number": sensor_in.serial_number,
+                                                "plant_id": plant_ids[sensor_in.plant.lower()]}))
+        else:
+            tables[Sensor].append((index, {"serial_number": sensor_in.serial_number,
+                                           "room_id": room_ids[sensor_in.room.lower()]}))
+
+    try:
+        with session.begin_nested():
+            for table, rows in tables.items():
+                if rows:
+                    session.execute(insert(table), [row for _, row in rows])
+    except IntegrityError as e:
+        #a sensor was registered concurrently, insert one by one to find which
+        logger.warning('bulk sensor insert rejected, retrying one by one')
+        logger.debug(e)
+        for table, rows in tables.items():
+            for index, row in rows:
+                try:
+                    with session.begin_nested():
+                        session.execute(insert(table), row)
+                except IntegrityError as e:
+                    results[index].status = ENTRY_FAILED
+                    results[index].detail = str(e.orig)
+    session.commit()
+
+    return results
+
+
+def get_or_create_many(session: Session, dialect_name: str, table, rows: dict) -> dict:
+    '''
+    Resolve room or plant names to ids with one query, rows maps the lower case name
+    to the values to insert if it is missing. Missing rows are inserted in bulk, skipping
+    names created concurrently. Returns a dict lower case name -> id.
+    '''
+    if not rows:
+        return {}
+
+    lookup = select(func.lower(table.name), table.id).where(func.lower(table.name).in_(list(rows)))
+    ids = dict(session.execute(lookup).all())
+    missing = [values for name, values in rows.items() if name not in ids]
+
+    if missing:
+        statement = dialect_insert(dialect_name, table)
+        if dialect_name in ("postgresql", "sqlite"):
+            statement = statement.on_conflict_do_nothing(index_elements = [func.lower(table.name)])
+        session.execute(statement, missing)
+        ids = dict(session.execute(lookup).all())
+
+    return ids
+
+
+def average_temperature_query(room: Optional[Room] = None):
+    '''
+    (temperature sum, entry count) of a room, or of all the regular sensors, from the running aggregates
+    '''
+    if room is not None:
+        return select(RoomAggregate.temperature_sum, RoomAggregate.entry_count) \
+            .join(Room, RoomAggregate.room_id == Room.id) \
+            .where(room_filter(room))
+    return select(func.sum(SensorAggregate.temperature_sum), func.sum(SensorAggregate.entry_count)) \
+        .join(Sensor, SensorAggregate.sensor_id == Sensor.serial_number)
+
+
+def average_temperature(aggregate) -> Optional[float]:
+    #None when nothing was recorded yet
+    if aggregate is not None and aggregate[1]:
+        return aggregate[0] / aggregate[1]
+    return None
@@ -1,19 +1,41 @@
 from sqlmodel import create_engine, Session, select, func
 from sqlalchemy.orm import joinedload, join
 from ..orm import *
+from ..models import EntryResult, SensorIn
+from ..export import export_query, EXPORT_CHUNK_SIZE
+from ..latest import latest_query, room_sensors_query
+from ..rollups import pick_resolution, rollup_query, ROLLUP_GRACE
+from ..partitions import maintain_partitions
+from ..retention import RetentionEngine
+from ..room_stats import room_stats_query
+from ..cold_storage import Archiver, chunk_export_query, export_rows, EXPORT_CHUNKS_PER_BATCH
+from ..history import HistoryCursor
+from . import operations
 import logging
 from .abstract_repository import AbstractRepository
-from typing import Union
+from typing import Union, List
+from datetime import timedelta
 from sqlalchemy.exc import IntegrityError, OperationalError, DataError, ProgrammingError
 
 
 logger = logging.getLogger(__name__)
 
 
+
 class SQLModel_repository(AbstractRepository):
 
-    def __init__(self, engine):
+    def __init__(self, engine, lean_writes: bool = False, rollup_grace: timedelta = ROLLUP_GRACE,
+                 write_horizon: Optional[timedelta] = None):
         self.engine = engine
+        #when set, single entries are written on a plain connection and returned as passed in,
+        #without the session and the round trip reading the stored entry back
+        self.lean_writes = lean_writes
+        #a minute is compacted into the rollups rollup_grace after it ends, the entries inserted
+        #later are queued for the compaction (see src/rollups.py)
+        self.rollup_grace = rollup_grace
+        #readings older than write_horizon are rejected: their window may already be archived (see
+        #src/cold_storage.py) or deleted by the retention, written again they would be counted twice
+        self.write_horizon = write_horizon
     
     
     def get_room(self, room: Room):
@@ -24,14 +46,10 @@ class SQLModel_repository(AbstractRepository):
         with Session(self.engine) as session:
             #this method is case insensitive
             if isinstance(room.name, str):
-                statement = select(Room).where(func.lower(Room.name) == room.name.lower())
-                room = session.exec(statement).first()
+                room = session.exec(operations.name_query(Room, room.name)).first()
             else: 
                 room = None
         return room
-    
-    #Validation is not performed by pydantic when the SQLmodel as Table set to True, so this method
-    #makes sure the room name is a string
     def add_room(self,room: Room):
         '''
         Add a room to the database table is it does not exist
@@ -97,8 +115,7 @@ class SQLModel_repository(AbstractRepository):
         '''
         with Session(self.engine) as session:
             if isinstance(plant.name, str):
-                statement = select(Plant).where(func.lower(Plant.name) == plant.name.lower())
-                plant = session.exec(statement).first()
+                plant = session.exec(operations.name_query(Plant, plant.name)).first()
             else:
                 plant = None
         return plant
@@ -126,12 +143,8 @@ class SQLModel_repository(AbstractRepository):
         Get sensor, depending on the class of sensor it will find the plant or regular sensor
         '''
         with Session(self.engine) as session:
-            if isinstance(sensor, Sensor):
-                statement = select(Sensor).where(Sensor.serial_number == sensor.serial_number)
-                sensor = session.exec(statement).first()
-            elif isinstance(sensor, PlantSensor):
-                statement = select(PlantSensor).where(PlantSensor.serial_number == sensor.serial_number)
-                sensor = session.exec(statement).first()
+            if isinstance(sensor, (Sensor, PlantSensor)):
+                sensor = session.exec(operations.sensor_query(sensor)).first()
 
         return sensor
     
@@ -139,42 +152,170 @@ class SQLModel_repository(AbstractRepository):
     def add_data_entry(self, sensor_entry: Union[PlantSensorEntry, HumidityTemperatureEntry]):
         '''
         Add measurements to the database, depending on the type of data,
-        it will be added to the relevent table
+        it will be added to the relevent table.
+        Sensors resend a reading when they miss the ack, a reading that is already recorded
+        (same sensor and timestamp) is skipped and None is returned instead of the entry.
+        With lean_writes the entry is returned as passed in, without reading it back.
+        Raises ValueError if the reading is older than the write horizon.
         '''
+        if self.lean_writes:
+            with self.engine.begin() as connection:
+                return operations.add_entry_lean(connection, self.engine.dialect.name, sensor_entry, self.rollup_grace,
+                                                 self.write_horizon)
         with Session(self.engine) as session:
-            try:
-                session.add(sensor_entry)
-            except Exception as e:
-                session.rollback()
-                logger.error('could save the sensor entry in the database')
-                logger.error(e)
-            else:
-                session.commit()
-                session.refresh(sensor_entry)
-                
+            return operations.add_entry(session, self.engine.dialect.name, sensor_entry, self.rollup_grace, self.write_horizon)
+
+    def add_data_entries(self, sensor_entries: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]) -> List[EntryResult]:
+        '''
+        Add a batch of measurements to the database in a single transaction.
+        Entries are split between the plant and regular sensor tables and each table
+        is written with one set-based insert. Readings already recorded are skipped by
+        the insert and reported as duplicates. If the insert is rejected (unknown sensor,
+        invalid value), the batch is replayed row by row inside savepoints so that
+        only the faulty readings are reported as failed, like the readings older than the write horizon.
+        The returned results are in the same order as the entries passed in.
+        '''
+        with Session(self.engine) as session:
+            return operations.add_entries(session, self.engine.dialect.name, sensor_entries, self.rollup_grace, self.write_horizon)
+
+    def rebuild_aggregates(self):
+        '''
+        Recompute the sensor and room aggregates from the raw entries, in a single transaction
+        '''
+        with Session(self.engine) as session:
+            operations.rebuild_aggregates(session, self.engine.dialect.name)
+
+    def get_measurements(self, sensor_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                         after: Union[HistoryCursor, datetime, None] = None, limit: int = 100) -> List[Union[HumidityTemperatureEntry, PlantSensorEntry]]:
+        '''
+        Return a page of the measurements of a sensor in (entry_timestamp, plant_sensor, sensor_id)
+        order, starting after the cursor (the key of the last entry of the previous page, see
+        src/history.py). A timestamp as cursor skips every entry at that timestamp.
+        Archived entries (see src/cold_storage.py) are decoded and merged in.
+        '''
+        with Session(self.engine) as session:
+            return operations.get_measurements(session, sensor_id, start, end, after, limit)
+
+    def stream_measurements(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                            sensor_id: Optional[int] = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+        '''
+        Generator yielding the entries as lists of plain tuples (see src/export.py), read with
+        a server side cursor so the whole range is never loaded in memory, followed by the
+        archived entries decoded a few chunks at a time
+        '''
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=chunk_size) \
+                .execute(export_query(start, end, sensor_id))
+            for rows in result.partitions():
+                yield rows
+            result = connection.execution_options(stream_results=True, yield_per=EXPORT_CHUNKS_PER_BATCH) \
+                .execute(chunk_export_query(start, end, sensor_id))
+            for chunks in result.partitions():
+                yield export_rows(chunks, start, end)
+
+    def compact_rollups(self, now: Optional[datetime] = None) -> dict:
+        '''
+        Fill the minute, hour and day rollups up to the last closed bucket, see src/rollups.py,
+        and refresh the room rollup (see src/room_stats.py). Returns the watermark of each rollup.
+        The entries inserted later below a watermark are queued by the insert and merged here first.
+        '''
+        with Session(self.engine) as session:
+            return operations.compact(session, self.engine.dialect.name, now, self.rollup_grace)
+
+    def get_rollup(self, sensor_id: int, start: datetime, end: datetime, points: int):
+        '''
+        Return the rollup of a sensor over [start, end) at the coarsest resolution giving
+        at least the requested number of points, as a tuple (resolution name, rows)
+        '''
+        resolution = pick_resolution(start, end, points)
+        with Session(self.engine) as session:
+            rows = session.exec(rollup_query(resolution, sensor_id, start, end)).all()
+        return resolution.name, rows
+
+    def get_room_stats(self, room: Optional[Room] = None, start: Optional[datetime] = None,
+                       end: Optional[datetime] = None) -> List[tuple]:
+        '''
+        Statistics of every room (or of one room) over the measurements of its sensors and of the
+        sensors of its plants, read from the room rollup: only the minutes already refreshed are counted
+        '''
+        with Session(self.engine) as session:
+            return session.exec(room_stats_query(room, start, end)).all()
+
+    def maintain_partitions(self, months_ahead: int = 3) -> dict:
+        '''
+        Create the monthly partitions of the entry tables up to months_ahead months ahead on postgres
+        (once the tables are partitioned), see src/partitions.py. Returns the partitions created per table.
+        '''
+        with self.engine.begin() as connection:
+            return maintain_partitions(connection, months_ahead = months_ahead)
+
+    def apply_retention(self, retention: RetentionEngine) -> dict:
+        '''
+        Delete the entries and rollups expired under the retention policy in bounded chunks
+        (dropping whole partitions on postgres), see src/retention.py
+        '''
+        with self.engine.connect() as connection:
+            return retention.run(connection)
+
+    def archive_measurements(self, archiver: Archiver) -> dict:
+        '''
+        Move the closed windows of entries older than the archiver's delay into compressed chunks,
+        see src/cold_storage.py. Returns the rows and chunks archived.
+        '''
+        with Session(self.engine) as session:
+            return archiver.run(session)
+
+    def get_latest_readings(self) -> List[tuple]:
+        '''
+        Last entry of every sensor as plain tuples following LATEST_COLUMNS (see src/latest.py)
+        '''
+        with Session(self.engine) as session:
+            return session.execute(latest_query()).all()
+
+    def get_room_sensors(self) -> List[tuple]:
+        '''
+        (room name, serial number) of every sensor, rooms without sensors have a null serial number
+        '''
+        with Session(self.engine) as session:
+            return session.execute(room_sensors_query()).all()
+
+    def provision_sensor(self, sensor_in: SensorIn) -> Union[Sensor, PlantSensor]:
+        '''
+        Register a sensor in a single transaction: the room (and plant for plant sensors)
+        are looked up case insensitively and created if missing, then the sensor is inserted.
+        Raises IntegrityError if the sensor already exists.
+        '''
+        with Session(self.engine) as session:
+            return operations.provision_sensor(session, self.engine.dialect.name, sensor_in)
+
+    def provision_sensors(self, sensors_in: List[SensorIn]) -> List[EntryResult]:
+        '''
+        Register a fleet of sensors in a single transaction.
+        Distinct room and plant names are resolved with one query each (case insensitive),
+        the missing ones are created in bulk and the sensors are inserted with one insert
+        per sensor table. Sensors that already exist are reported as failed, the others
+        are still created. The returned results are in the same order as the sensors passed in.
+        '''
+        with Session(self.engine) as session:
+            return operations.provision_sensors(session, self.engine.dialect.name, sensors_in)
 
-        return sensor_entry
-    
-   
     def get_average_temperature(self, room : Optional[Room] = None):
         '''
-        This method calculates the average temperature of a room
+        This method returns the average temperature of a room (or of all sensors if no
+        room is given). It is read from the running aggregates so its cost does not
+        depend on the size of the history.
         For now it only considers temperature from regular sensor
         '''
 
         average_temperature = None
 
         with Session(self.engine) as session:
-            query = select(func.avg(HumidityTemperatureEntry.temperature)).join(Sensor, HumidityTemperatureEntry.sensor_id == Sensor.serial_number)
-
-            if room is not None:
-                query =  query.where(Sensor.room == room)
-
             try:
-                average_temperature = session.scalar(query)
-            
+                aggregate = session.exec(operations.average_temperature_query(room)).first()
             except Exception as e:
                 logger.error("could not calculate average temperature")
                 logger.error(e)
+            else:
+                average_temperature = operations.average_temperature(aggregate)
 
-        return average_temperature
\ No newline at end of file
+        return average_temperature
@@ -0,0 +1,223 @@
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from sqlalchemy import case, delete, select, text, tuple_
+from src.orm import HumidityTemperatureEntry, PlantSensorEntry, MeasurementChunk, RollupWatermark
+from src.rollups import RESOLUTIONS
+from src.room_stats import ROOM_ROLLUP
+from src.partitions import partitioned_tables, existing_partitions, add_months
+from src.helper_functions import dialect_insert, to_naive_utc, utc_now
+
+
+logger = logging.getLogger(__name__)
+
+
+#Retention of the raw entries and of the rollups, e.g. "raw=30d,1h=2y": raw readings are kept
+#30 days, the hourly rollups 2 years, the other resolutions forever.
+#Data is downsampled before it is dropped: rows are only deleted once they are compacted into the
+#next resolution (below its rollup watermark, and the room rollup's for the raw entries), whatever the policy says. Expired rows are deleted
+#in chunks of chunk_size rows, one transaction each, so the tables are never locked for long, and
+#on postgres the monthly partitions that are entirely expired are dropped instead.
+#The running aggregates (average endpoints) are not affected, they keep covering the whole history.
+#The time before which readings (raw or archived) were deleted is recorded in rollup_watermark (EXPIRED),
+#the aggregates cannot be rebuilt from the remaining readings afterwards.
+#The archived entries (key archive, see src/cold_storage.py) are only archived once compacted, a
+#chunk is deleted once its last reading is expired.
+
+RAW = "raw"
+ARCHIVE = "archive"
+#policy key -> tables and their time column
+RETENTION_TABLES = {
+    RAW: [(HumidityTemperatureEntry.__table__, "entry_timestamp"), (PlantSensorEntry.__table__, "entry_timestamp")],
+    **{resolution.name: [(resolution.table.__table__, "bucket")] for resolution in RESOLUTIONS},
+    ARCHIVE: [(MeasurementChunk.__table__, "last_timestamp")],
+}
+#policy key -> rollups its rows are compacted into, the raw entries also feed the room rollup
+#policy keys whose rows are the readings themselves
+READING_KEYS = (RAW, ARCHIVE)
+#rollup_watermark row holding the time before which readings were deleted
+EXPIRED = "expired"
+DOWNSAMPLED_INTO = {RAW: (RESOLUTIONS[0].name, ROOM_ROLLUP),
+                    **{resolution.source.name: (resolution.name,) for resolution in RESOLUTIONS if resolution.source is not None}}
+
+DURATION_UNITS = {"h": timedelta(hours=1), "d": timedelta(days=1), "w": timedelta(weeks=1), "y": timedelta(days=365)}
+DURATION_PATTERN = re.compile(r"^(\d+)([hdwy])$")
+PARTITION_MONTH_PATTERN = re.compile(r"_y(\d{4})m(\d{2})$")
+
+
+def parse_duration(value: str) -> timedelta:
+    '''
+    Parse a duration like "30d" (units h, d, w and y), raises ValueError if it is malformed
+    '''
+    match = DURATION_PATTERN.match(value.strip())
+    if match is None:
+        raise ValueError(f"invalid duration '{value}', expected <number><h|d|w|y>")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def parse_retention(spec: str) -> Dict[str, timedelta]:
+    '''
+    Parse a policy like "raw=30d,1h=2y" (units h, d, w and y), raises ValueError if it is malformed
+    '''
+    policy = {}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        key, _, duration = item.partition("=")
+        key = key.strip()
+        match = DURATION_PATTERN.match(duration.strip())
+        if key not in RETENTION_TABLES or match is None:
+            raise ValueError(f"invalid retention '{item}', expected <{'|'.join(RETENTION_TABLES)}>=<number><h|d|w|y>")
+        policy[key] = int(match.group(1)) * DURATION_UNITS[match.group(2)]
+    return policy
+
+
+def format_duration(duration: timedelta) -> str:
+    for unit in ("y", "w", "d", "h"):
+        if duration % DURATION_UNITS[unit] == timedelta(0):
+            return f"{duration // DURATION_UNITS[unit]}{unit}"
+    return str(duration)
+
+
+def compacted_until(watermarks: Dict[str, datetime], key: str) -> Optional[datetime]:
+    '''
+    Timestamp before which the rows of a policy key are compacted into all the rollups they feed,
+    None while one of them has nothing compacted yet
+    '''
+    rollups = [watermarks.get(name) for name in DOWNSAMPLED_INTO[key]]
+    return None if None in rollups else min(rollups)
+
+
+def retention_cutoffs(connection, policy: Dict[str, timedelta], now: Optional[datetime] = None) -> Dict[str, Optional[datetime]]:
+    '''
+    Timestamp before which the rows of each policy key can be deleted: the retention period,
+    held back to the watermark of the resolution they are compacted into. None while nothing
+    is compacted yet.
+    '''
+    now = to_naive_utc(now) if now is not None else utc_now()
+    watermarks = dict(connection.execute(select(RollupWatermark.resolution, RollupWatermark.watermark)).all())
+    cutoffs = {}
+    for key, retention in policy.items():
+        cutoff = now - retention
+        if key in DOWNSAMPLED_INTO:
+            watermark = compacted_until(watermarks, key)
+            cutoff = min(cutoff, watermark) if watermark is not None else None
+        cutoffs[key] = cutoff
+    return cutoffs
+
+
+def expiry_statement(dialect_name: str, cutoff: datetime):
+    '''
+    Record that the readings before the cutoff were deleted, the recorded time only moves forward
+    '''
+    statement = dialect_insert(dialect_name, RollupWatermark).values(resolution = EXPIRED, watermark = cutoff)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(index_elements = ["resolution"], set_ = {
+        "watermark": case((excluded.watermark > RollupWatermark.watermark, excluded.watermark), else_ = RollupWatermark.watermark)})
+
+
+def readings_expired_before(connection) -> Optional[datetime]:
+    '''
+    Time before which the retention deleted readings, None if it never did
+    '''
+    return connection.scalar(select(RollupWatermark.watermark).where(RollupWatermark.resolution == EXPIRED))
+
+
+def expired_partitions(connection, table: str, cutoff: datetime) -> List[str]:
+    '''
+    Monthly partitions of a table whose whole month is before the cutoff (postgres)
+    '''
+    expired = []
+    for name in sorted(existing_partitions(connection, table)):
+        match = PARTITION_MONTH_PATTERN.search(name)
+        if match is not None and add_months(datetime(int(match.group(1)), int(match.group(2)), 1), 1) <= cutoff:
+            expired.append(name)
+    return expired
+
+
+def delete_chunk_statement(table, column: str, cutoff: datetime, chunk_size: int):
+    '''
+    Delete at most chunk_size rows older than the cutoff, selected by primary key
+    '''
+    key = tuple_(*table.primary_key.columns)
+    chunk = select(*table.primary_key.columns).where(table.c[column] < cutoff).limit(chunk_size)
+    return delete(table).where(key.in_(chunk))
+
+
+class RetentionEngine:
+    '''
+    Apply a retention policy, the progress of the current (or last) run is kept for status()
+    '''
+
+    def __init__(self, policy: Dict[str, timedelta], chunk_size: int = 5000, max_chunks: Optional[int] = None):
+        self.policy = policy
+        self.chunk_size = chunk_size
+        #chunks deleted per run at most, the next run carries on
+        self.max_chunks = max_chunks
+
+        #progress exposed through status()
+        self.running = False
+        self.started: Optional[datetime] = None
+        self.finished: Optional[datetime] = None
+        self.cutoffs: Dict[str, Optional[datetime]] = {}
+        self.tables: Dict[str, dict] = {}
+        self.deleted_rows_total = 0
+
+    def run(self, connection, now: Optional[datetime] = None) -> dict:
+        '''
+        Delete the expired rows, takes a sync connection (not in a transaction), every chunk is
+        committed. Use AsyncConnection.run_sync with the async engine.
+        Returns the rows deleted and partitions dropped per table.
+        '''
+        self.running = True
+        self.started = datetime.now(timezone.utc)
+        self.finished = None
+        self.tables = {}
+        chunks = 0
+        try:
+            self.cutoffs = retention_cutoffs(connection, self.policy, now)
+            connection.commit()
+            partitioned = set(partitioned_tables(connection)) if connection.dialect.name == "postgresql" else set()
+            for key, cutoff in self.cutoffs.items():
+                for table, column in RETENTION_TABLES[key]:
+                    progress = self.tables[table.name] = {"cutoff": cutoff, "deleted_rows": 0, "dropped_partitions": [],
+                                                          "chunks": 0, "done": cutoff is None}
+                    if cutoff is None:
+                        continue
+
+                    if table.name in partitioned:
+                        for partition in expired_partitions(connection, table.name, cutoff):
+                            if key in READING_KEYS:
+                                connection.execute(expiry_statement(connection.dialect.name, cutoff))
+                            connection.execute(text(f"DROP TABLE {partition}"))
+                            connection.commit()
+                            progress["dropped_partitions"].append(partition)
+                            logger.info(f'retention dropped partition {partition}')
+
+                    while self.max_chunks is None or chunks < self.max_chunks:
+                        deleted = connection.execute(delete_chunk_statement(table, column, cutoff, self.chunk_size)).rowcount
+                        if deleted and key in READING_KEYS:
+                            connection.execute(expiry_statement(connection.dialect.name, cutoff))
+                        connection.commit()
+                        chunks += 1
+                        progress["chunks"] += 1
+                        progress["deleted_rows"] += deleted
+                        self.deleted_rows_total += deleted
+                        if deleted < self.chunk_size:
+                            progress["done"] = True
+                            break
+        finally:
+            self.running = False
+            self.finished = datetime.now(timezone.utc)
+        return {name: {"deleted_rows": progress["deleted_rows"], "dropped_partitions": progress["dropped_partitions"]}
+                for name, progress in self.tables.items()}
+
+    def status(self) -> dict:
+        return {
+            "policy": {key: format_duration(retention) for key, retention in self.policy.items()},
+            "chunk_size": self.chunk_size,
+            "running": self.running,
+            "started": self.started,
+            "finished": self.finished,
+            "tables": {name: dict(progress) for name, progress in list(self.tables.items())},
+            "deleted_rows_total": self.deleted_rows_total,
+        }
@@ -0,0 +1,348 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, List, Optional
+from sqlalchemy import delete, func, insert, literal, null
+from sqlmodel import Session, select
+from src.helper_functions import dialect_insert, precompiled, to_naive_utc, utc_now
+from src.orm import HumidityTemperatureEntry, PlantSensorEntry, MinuteRollup, HourRollup, DayRollup, RollupWatermark, LateEntry
+
+
+#Multi resolution rollups of the sensor entries.
+#The minute rollup is computed from the raw entries, the hour rollup from the minute rollup and the
+#day rollup from the hour rollup. Each resolution keeps a watermark, only buckets that are closed
+#(older than the grace period) are compacted, once, so a compaction pass only reads new data.
+#Entries written later, in a minute a compaction may already have read (spool replay, gateway
+#batches, device timestamps), are queued in late_entry by their insert. The inserts take no lock:
+#whether an entry is late is decided from the clock (see late_cutoff), not from the watermarks.
+#Every compaction step of the minute rollup consumes the queued entries of its range in the snapshot
+#it reads the raw entries from (they are counted with them), a pass starts by merging the entries
+#queued below the watermarks into the buckets already compacted, see drain_late_entries.
+#The watermark rows are locked by the compaction steps, so concurrent compactions wait for each other.
+
+#how long the compaction waits for the readings of a minute before compacting it, readings arriving
+#later are queued for the next compaction pass
+ROLLUP_GRACE = timedelta(minutes=1)
+#entries older than the grace period minus this margin are queued: it covers the time an insert takes
+#to commit once it classified its entries and the clock skew between the servers
+LATE_MARGIN = timedelta(seconds=30)
+
+ROLLUP_COLUMNS = [
+    "sensor_id", "plant_sensor", "bucket", "entry_count",
+    "temperature_avg", "temperature_min", "temperature_max",
+    "humidity_avg", "humidity_min", "humidity_max",
+    "wetness_avg", "wetness_min", "wetness_max",
+]
+
+
+class Resolution:
+
+    def __init__(self, name: str, unit: str, table, seconds: int, step: timedelta, source: Optional["Resolution"]):
+        self.name = name
+        #unit understood by date_trunc
+        self.unit = unit
+        self.table = table
+        self.seconds = seconds
+        #largest period compacted in one transaction
+        self.step = step
+        #resolution the buckets are computed from, None for the raw entries
+        self.source = source
+
+    def floor(self, timestamp: datetime) -> datetime:
+        timestamp = timestamp.replace(second=0, microsecond=0)
+        if self.unit in ("hour", "day"):
+            timestamp = timestamp.replace(minute=0)
+        if self.unit == "day":
+            timestamp = timestamp.replace(hour=0)
+        return timestamp
+
+
+MINUTE = Resolution("1m", "minute", MinuteRollup, 60, timedelta(hours=1), None)
+HOUR = Resolution("1h", "hour", HourRollup, 3600, timedelta(days=1), MINUTE)
+DAY = Resolution("1d", "day", DayRollup, 86400, timedelta(days=30), HOUR)
+
+#from the finest to the coarsest
+RESOLUTIONS = [MINUTE, HOUR, DAY]
+
+#sqlite has no date_trunc, buckets are formatted like the timestamps sqlalchemy stores
+SQLITE_BUCKET_FORMATS = {
+    "minute": "%Y-%m-%d %H:%M:00.000000",
+    "hour": "%Y-%m-%d %H:00:00.000000",
+    "day": "%Y-%m-%d 00:00:00.000000",
+}
+
+
+def bucket_expression(dialect_name: str, column, unit: str):
+    if dialect_name == "sqlite":
+        return func.strftime(SQLITE_BUCKET_FORMATS[unit], column)
+    return func.date_trunc(unit, column)
+
+
+def pick_resolution(start: datetime, end: datetime, points: int) -> Resolution:
+    '''
+    Coarsest resolution that still gives at least the requested number of points over the range,
+    the finest one if none does
+    '''
+    span = (end - start).total_seconds()
+    for resolution in reversed(RESOLUTIONS):
+        if span / resolution.seconds >= points:
+            return resolution
+    return RESOLUTIONS[0]
+
+
+def compaction_statements(dialect_name: str, resolution: Resolution, start: datetime, end: datetime) -> list:
+    '''
+    INSERT ... SELECT statements computing the buckets of the resolution in [start, end)
+    '''
+    statements = []
+
+    if resolution.source is None:
+        for entry_table, plant_sensor in ((HumidityTemperatureEntry, False), (PlantSensorEntry, True)):
+            bucket = bucket_expression(dialect_name, entry_table.entry_timestamp, resolution.unit)
+            if plant_sensor:
+                wetness = (func.avg(PlantSensorEntry.wetness), func.min(PlantSensorEntry.wetness), func.max(PlantSensorEntry.wetness))
+            else:
+                wetness = (null(), null(), null())
+            query = select(
+                entry_table.sensor_id, literal(plant_sensor), bucket, func.count(),
+                func.avg(entry_table.temperature), func.min(entry_table.temperature), func.max(entry_table.temperature),
+                func.avg(entry_table.humidity), func.min(entry_table.humidity), func.max(entry_table.humidity),
+                *wetness
+            ).where(entry_table.entry_timestamp >= start, entry_table.entry_timestamp < end) \
+             .group_by(entry_table.sensor_id, bucket)
+            statement = insert(resolution.table).from_select(ROLLUP_COLUMNS, query)
+
+            #the late entries of the range are counted with the raw entries, their queue rows are deleted
+            #in the same snapshot: a data modifying CTE on postgres, the next statement of the transaction
+            #on sqlite where the writers are serialized
+            consumed = delete(LateEntry.__table__).where(
+                LateEntry.rollup == resolution.name, LateEntry.plant_sensor == plant_sensor,
+                LateEntry.entry_timestamp >= start, LateEntry.entry_timestamp < end)
+            if dialect_name == "postgresql":
+                statements.append(statement.add_cte(consumed.cte("consumed")))
+            else:
+                statements += [statement, consumed]
+
+    else:
+        source = resolution.source.table
+        bucket = bucket_expression(dialect_name, source.bucket, resolution.unit)
+
+        def weighted_average(column):
+            return func.sum(column * source.entry_count) / func.sum(source.entry_count)
+
+        query = select(
+            source.sensor_id, source.plant_sensor, bucket, func.sum(source.entry_count),
+            weighted_average(source.temperature_avg), func.min(source.temperature_min), func.max(source.temperature_max),
+            weighted_average(source.humidity_avg), func.min(source.humidity_min), func.max(source.humidity_max),
+            weighted_average(source.wetness_avg), func.min(source.wetness_min), func.max(source.wetness_max),
+        ).where(source.bucket >= start, source.bucket < end) \
+         .group_by(source.sensor_id, source.plant_sensor, bucket)
+        statements.append(insert(resolution.table).from_select(ROLLUP_COLUMNS, query))
+
+    return statements
+
+
+def _first_timestamp(session: Session, resolution: Resolution, after: Optional[datetime] = None) -> Optional[datetime]:
+    '''
+    Earliest timestamp of the data the resolution is computed from (at or after a given time),
+    None if there is none
+    '''
+    if resolution.source is None:
+        columns = [HumidityTemperatureEntry.entry_timestamp, PlantSensorEntry.entry_timestamp]
+    else:
+        columns = [resolution.source.table.bucket]
+
+    candidates = []
+    for column in columns:
+        query = select(func.min(column))
+        if after is not None:
+            query = query.where(column >= after)
+        candidates.append(session.scalar(query))
+    candidates = [to_naive_utc(candidate) for candidate in candidates if candidate is not None]
+    return min(candidates) if candidates else None
+
+
+def compact_rollups(session: Session, dialect_name: str, now: Optional[datetime] = None,
+                    grace: timedelta = ROLLUP_GRACE) -> Dict[str, Optional[datetime]]:
+    '''
+    Compact every resolution up to the last closed bucket, one transaction per step.
+    Returns the new watermark of each resolution.
+    '''
+    now = to_naive_utc(now) if now is not None else utc_now()
+    closed_until = MINUTE.floor(now - grace)
+    watermarks = {}
+    drain_late_entries(session, dialect_name)
+
+    for resolution in RESOLUTIONS:
+        #a bucket can only be computed once all the buckets of its source are
+        if resolution.source is not None:
+            source_watermark = watermarks.get(resolution.source.name)
+            if source_watermark is None:
+                watermarks[resolution.name] = None
+                continue
+            closed_until = resolution.floor(source_watermark)
+
+        #locked until the step is committed, concurrent compactions wait for each other (postgres)
+        state = session.get(RollupWatermark, resolution.name, with_for_update = True, populate_existing = True)
+        if state is not None:
+            watermark = state.watermark
+        else:
+            first = _first_timestamp(session, resolution)
+            watermark = resolution.floor(first) if first is not None else None
+        if watermark is None:
+            watermarks[resolution.name] = None
+            continue
+
+        while watermark < closed_until:
+            end = min(watermark + resolution.step, closed_until)
+            inserted = 0
+            for statement in compaction_statements(dialect_name, resolution, watermark, end):
+                if statement.is_insert:
+                    inserted += session.execute(statement).rowcount
+                else:
+                    session.execute(statement)
+            if inserted == 0:
+                #nothing in this window, jump over the gap to the next data
+                next_timestamp = _first_timestamp(session, resolution, end)
+                if next_timestamp is None:
+                    end = closed_until
+                else:
+                    end = max(end, min(resolution.floor(next_timestamp), closed_until))
+            session.merge(RollupWatermark(resolution = resolution.name, watermark = end))
+            session.commit()
+            watermark = end
+
+        watermarks[resolution.name] = watermark
+
+    return watermarks
+
+
+def late_rows(entries: Dict[type, List[dict]]) -> List[tuple]:
+    '''
+    (plant_sensor, row) of the entries inserted per table, with naive UTC timestamps
+    '''
+    return [(table is PlantSensorEntry, {**row, "entry_timestamp": to_naive_utc(row["entry_timestamp"])})
+            for table, rows in entries.items() for row in rows]
+
+
+def merge_statement(dialect_name: str, table):
+    '''
+    INSERT ... ON CONFLICT DO UPDATE merging late entries into the bucket of a rollup, the averages
+    are weighted by the entry counts
+    '''
+    if dialect_name not in ("postgresql", "sqlite"):
+        raise NotImplementedError(f"Rollups are not supported on {dialect_name}")
+
+    columns = table.__table__.c
+    statement = dialect_insert(dialect_name, table)
+    excluded = statement.excluded
+    merged = {"entry_count": columns.entry_count + excluded.entry_count}
+    for measure in ("temperature", "humidity", "wetness"):
+        average, minimum, maximum = (f"{measure}_avg", f"{measure}_min", f"{measure}_max")
+        merged[average] = (columns[average] * columns.entry_count + excluded[average] * excluded.entry_count) \
+            / (columns.entry_count + excluded.entry_count)
+        merged[minimum] = func.min(columns[minimum], excluded[minimum]) if dialect_name == "sqlite" \
+            else func.least(columns[minimum], excluded[minimum])
+        merged[maximum] = func.max(columns[maximum], excluded[maximum]) if dialect_name == "sqlite" \
+            else func.greatest(columns[maximum], excluded[maximum])
+    return statement.on_conflict_do_update(index_elements = ["sensor_id", "plant_sensor", "bucket"], set_ = merged)
+
+
+def _bucket_rows(rows: List[tuple], resolution: Resolution) -> List[dict]:
+    buckets = {}
+    for plant_sensor, row in rows:
+        key = (row["sensor_id"], plant_sensor, resolution.floor(row["entry_timestamp"]))
+        buckets.setdefault(key, []).append(row)
+
+    bucket_rows = []
+    for (sensor_id, plant_sensor, bucket), readings in sorted(buckets.items()):
+        bucket_row = {"sensor_id": sensor_id, "plant_sensor": plant_sensor, "bucket": bucket, "entry_count": len(readings)}
+        for measure in ("temperature", "humidity", "wetness"):
+            values = [reading[measure] for reading in readings] if plant_sensor or measure != "wetness" else None
+            bucket_row[f"{measure}_avg"] = sum(values) / len(values) if values else None
+            bucket_row[f"{measure}_min"] = min(values) if values else None
+            bucket_row[f"{measure}_max"] = max(values) if values else None
+        bucket_rows.append(bucket_row)
+    return bucket_rows
+
+
+def late_cutoff(grace: timedelta = ROLLUP_GRACE) -> datetime:
+    '''
+    Entries older than this may be in a minute a compaction already read, their insert queues them.
+    A compaction only reads a minute grace after its end, by the clock of the server running it
+    '''
+    return utc_now() - grace + LATE_MARGIN
+
+
+def late_entries(entries: Dict[type, List[dict]], cutoff: datetime, rollups: List[str]) -> List[dict]:
+    '''
+    Queue rows (see LateEntry) of the entries inserted per table that are older than the cutoff,
+    one per rollup
+    '''
+    return [{"rollup": rollup, "plant_sensor": plant_sensor, "sensor_id": row["sensor_id"],
+             "entry_timestamp": row["entry_timestamp"], "temperature": row["temperature"],
+             "humidity": row["humidity"], "wetness": row.get("wetness")}
+            for plant_sensor, row in late_rows(entries) if row["entry_timestamp"] < cutoff for rollup in rollups]
+
+
+def queue_late_entries(session: Session, dialect_name: str, entries: Dict[type, List[dict]], cutoff: datetime,
+                       rollups: List[str]) -> int:
+    '''
+    Queue the entries just inserted (rows per entry table) that are older than the cutoff for the
+    rollups read from the raw entries, in the transaction of the insert. Returns the entries queued.
+    '''
+    rows = late_entries(entries, cutoff, rollups)
+    if rows:
+        session.execute(queue_statement(dialect_name), rows)
+    return len(rows)
+
+
+@lru_cache(maxsize = None)
+def queue_statement(dialect_name: str):
+    '''
+    Insert into the late entry queue, compiled once (see precompiled)
+    '''
+    statement = dialect_insert(dialect_name, LateEntry.__table__)
+    if dialect_name in ("postgresql", "sqlite"):
+        #a reading archived or deleted by the retention and written again may still be queued
+        statement = statement.on_conflict_do_nothing()
+    return precompiled(statement, dialect_name)
+
+
+def drain_late_entries(session: Session, dialect_name: str) -> Dict[str, int]:
+    '''
+    Merge the late entries queued below the minute watermark into the buckets of every resolution
+    already compacted, in one transaction with the watermarks locked. The entries queued above it
+    are consumed by the compaction steps. Returns the buckets updated per resolution.
+    '''
+    watermarks = dict(session.execute(
+        select(RollupWatermark.resolution, RollupWatermark.watermark)
+        .where(RollupWatermark.resolution.in_([resolution.name for resolution in RESOLUTIONS]))
+        .order_by(RollupWatermark.resolution).with_for_update()).all())
+    if MINUTE.name not in watermarks:
+        session.rollback()
+        return {}
+
+    queue = LateEntry.__table__
+    drained = session.execute(delete(queue).where(queue.c.rollup == MINUTE.name, queue.c.entry_timestamp < watermarks[MINUTE.name])
+                              .returning(queue.c.plant_sensor, queue.c.sensor_id, queue.c.entry_timestamp,
+                                         queue.c.temperature, queue.c.humidity, queue.c.wetness)).all()
+    rows = [(row.plant_sensor, row._asdict()) for row in drained]
+
+    merged = {}
+    for resolution in RESOLUTIONS:
+        watermark = watermarks.get(resolution.name)
+        late = [(plant_sensor, row) for plant_sensor, row in rows
+                if watermark is not None and resolution.floor(row["entry_timestamp"]) < watermark]
+        if late:
+            bucket_rows = _bucket_rows(late, resolution)
+            session.execute(merge_statement(dialect_name, resolution.table), bucket_rows)
+            merged[resolution.name] = len(bucket_rows)
+    session.commit()
+    return merged
+
+
+def rollup_query(resolution: Resolution, sensor_id: int, start: datetime, end: datetime):
+    table = resolution.table
+    return select(table) \
+        .where(table.sensor_id == sensor_id, table.bucket >= to_naive_utc(start), table.bucket < to_naive_utc(end)) \
+        .order_by(table.bucket)
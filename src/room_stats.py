@@ -0,0 +1,210 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import case, delete, func
+from sqlmodel import Session, select
+from src.helper_functions import dialect_insert, to_naive_utc, utc_now
+from src.orm import Room, Plant, Sensor, PlantSensor, RoomRollup, RollupWatermark, LateEntry, room_measurement
+from src.rollups import MINUTE, HOUR, ROLLUP_GRACE, bucket_expression, queue_late_entries
+from src.aggregates import room_filter
+
+
+#Room statistics over the measurements of both entry tables (the room_measurement view, see src/orm.py).
+#The view is rolled up into hourly buckets per room (room_rollup_1h), refreshed incrementally with the
+#other rollups: every pass only reads the minutes closed since its watermark and adds them to their hour
+#bucket with INSERT ... ON CONFLICT DO UPDATE, one short transaction per step, so the readers and the
+#inserts are never blocked and an hour bucket is complete as soon as its last minute is closed.
+#Entries written later, in a minute a refresh may already have read, are queued by their insert like for
+#the sensor rollups (see src/rollups.py): each step consumes the queued entries of its range, a refresh
+#starts by adding the ones queued below the watermark to their buckets, see drain_late_room_entries.
+#A sensor moved to another room is counted in its new room from the next refresh on.
+
+ROOM_ROLLUP = "room_1h"
+
+ROOM_ROLLUP_COLUMNS = [
+    "room_id", "bucket", "entry_count",
+    "temperature_sum", "temperature_min", "temperature_max",
+    "humidity_sum", "humidity_min", "humidity_max",
+    "last_timestamp",
+]
+
+#largest period refreshed in one transaction, the watermark row stays locked until it commits
+ROOM_ROLLUP_STEP = timedelta(hours=1)
+
+
+def refresh_statements(dialect_name: str, start: datetime, end: datetime) -> list:
+    '''
+    INSERT ... SELECT adding the measurements of [start, end) to the hour buckets of their room,
+    and the deletion of the late entries of the range queued for the room rollup
+    '''
+    if dialect_name not in ("postgresql", "sqlite"):
+        raise NotImplementedError(f"Room rollups are not supported on {dialect_name}")
+
+    bucket = bucket_expression(dialect_name, room_measurement.c.entry_timestamp, HOUR.unit)
+    query = select(
+        room_measurement.c.room_id, bucket, func.count(),
+        func.sum(room_measurement.c.temperature), func.min(room_measurement.c.temperature), func.max(room_measurement.c.temperature),
+        func.sum(room_measurement.c.humidity), func.min(room_measurement.c.humidity), func.max(room_measurement.c.humidity),
+        func.max(room_measurement.c.entry_timestamp),
+    ).where(room_measurement.c.entry_timestamp >= start, room_measurement.c.entry_timestamp < end) \
+     .group_by(room_measurement.c.room_id, bucket)
+
+    statement = dialect_insert(dialect_name, RoomRollup).from_select(ROOM_ROLLUP_COLUMNS, query)
+    statement = statement.on_conflict_do_update(index_elements = ["room_id", "bucket"], set_ = _merged(statement.excluded))
+
+    #the late entries of the range are counted with the view, in the same snapshot, see compaction_statements
+    consumed = delete(LateEntry.__table__).where(
+        LateEntry.rollup == ROOM_ROLLUP, LateEntry.entry_timestamp >= start, LateEntry.entry_timestamp < end)
+    if dialect_name == "postgresql":
+        return [statement.add_cte(consumed.cte("consumed"))]
+    return [statement, consumed]
+
+
+def _merged(excluded) -> dict:
+    '''
+    SET clause adding a delta (the excluded row) to the bucket of a room
+    '''
+    columns = RoomRollup.__table__.c
+    return {
+        "entry_count": columns.entry_count + excluded.entry_count,
+        "temperature_sum": columns.temperature_sum + excluded.temperature_sum,
+        "temperature_min": case((excluded.temperature_min < columns.temperature_min, excluded.temperature_min),
+                                else_ = columns.temperature_min),
+        "temperature_max": case((excluded.temperature_max > columns.temperature_max, excluded.temperature_max),
+                                else_ = columns.temperature_max),
+        "humidity_sum": columns.humidity_sum + excluded.humidity_sum,
+        "humidity_min": case((excluded.humidity_min < columns.humidity_min, excluded.humidity_min),
+                             else_ = columns.humidity_min),
+        "humidity_max": case((excluded.humidity_max > columns.humidity_max, excluded.humidity_max),
+                             else_ = columns.humidity_max),
+        "last_timestamp": case((excluded.last_timestamp > columns.last_timestamp, excluded.last_timestamp),
+                               else_ = columns.last_timestamp),
+    }
+
+
+def queue_late_measurements(session: Session, dialect_name: str, entries: Dict[type, List[dict]], cutoff: datetime) -> int:
+    '''
+    Queue the entries just inserted (rows per entry table) older than the cutoff for the minute rollup
+    and the room rollup, in the transaction of the insert. Returns the entries queued.
+    '''
+    return queue_late_entries(session, dialect_name, entries, cutoff, [MINUTE.name, ROOM_ROLLUP])
+
+
+def drain_late_room_entries(session: Session, dialect_name: str) -> int:
+    '''
+    Add the late entries queued below the watermark to the hour buckets of their room, in one transaction
+    with the watermark locked. Returns the buckets updated.
+    '''
+    state = session.get(RollupWatermark, ROOM_ROLLUP, with_for_update = True, populate_existing = True)
+    if state is None:
+        session.rollback()
+        return 0
+    queue = LateEntry.__table__
+    rows = session.execute(delete(queue).where(queue.c.rollup == ROOM_ROLLUP, queue.c.entry_timestamp < state.watermark)
+                           .returning(queue.c.plant_sensor, queue.c.sensor_id, queue.c.entry_timestamp,
+                                      queue.c.temperature, queue.c.humidity)).all()
+    if not rows:
+        session.rollback()
+        return 0
+
+    #room of each sensor, like the room_measurement view
+    sensor_ids = {row.sensor_id for row in rows if not row.plant_sensor}
+    plant_sensor_ids = {row.sensor_id for row in rows if row.plant_sensor}
+    rooms = {(sensor_id, False): room_id for sensor_id, room_id in session.execute(
+        select(Sensor.serial_number, Sensor.room_id).where(Sensor.serial_number.in_(sensor_ids))).all()}
+    rooms.update({(sensor_id, True): room_id for sensor_id, room_id in session.execute(
+        select(PlantSensor.serial_number, Plant.room_id).join(Plant, PlantSensor.plant_id == Plant.id)
+        .where(PlantSensor.serial_number.in_(plant_sensor_ids))).all()})
+
+    buckets = {}
+    for row in rows:
+        room_id = rooms.get((row.sensor_id, row.plant_sensor))
+        if room_id is not None:
+            buckets.setdefault((room_id, HOUR.floor(row.entry_timestamp)), []).append(row)
+
+    bucket_rows = [{
+        "room_id": room_id, "bucket": bucket, "entry_count": len(readings),
+        "temperature_sum": sum(reading.temperature for reading in readings),
+        "temperature_min": min(reading.temperature for reading in readings),
+        "temperature_max": max(reading.temperature for reading in readings),
+        "humidity_sum": sum(reading.humidity for reading in readings),
+        "humidity_min": min(reading.humidity for reading in readings),
+        "humidity_max": max(reading.humidity for reading in readings),
+        "last_timestamp": max(reading.entry_timestamp for reading in readings),
+    } for (room_id, bucket), readings in sorted(buckets.items())]
+    if bucket_rows:
+        statement = dialect_insert(dialect_name, RoomRollup)
+        session.execute(statement.on_conflict_do_update(index_elements = ["room_id", "bucket"], set_ = _merged(statement.excluded)),
+                        bucket_rows)
+    session.commit()
+    return len(bucket_rows)
+
+
+def _first_timestamp(session: Session, after: Optional[datetime] = None) -> Optional[datetime]:
+    query = select(func.min(room_measurement.c.entry_timestamp))
+    if after is not None:
+        query = query.where(room_measurement.c.entry_timestamp >= after)
+    first = session.scalar(query)
+    return to_naive_utc(first) if first is not None else None
+
+
+def refresh_room_rollup(session: Session, dialect_name: str, now: Optional[datetime] = None,
+                        grace: timedelta = ROLLUP_GRACE) -> datetime:
+    '''
+    Add the minutes closed since the last refresh to the room rollup, one transaction per step.
+    Returns the new watermark.
+    '''
+    now = to_naive_utc(now) if now is not None else utc_now()
+    closed_until = MINUTE.floor(now - grace)
+    drain_late_room_entries(session, dialect_name)
+
+    while True:
+        #the watermark row is locked until the step is committed, concurrent refreshes wait for each other (postgres)
+        state = session.get(RollupWatermark, ROOM_ROLLUP, with_for_update = True, populate_existing = True)
+        if state is not None:
+            watermark = state.watermark
+        else:
+            first = _first_timestamp(session)
+            #no measurement resolved to a room yet, there is nothing to miss before closed_until
+            watermark = MINUTE.floor(first) if first is not None else closed_until
+        if watermark >= closed_until and state is not None:
+            session.rollback()
+            return watermark
+
+        end = min(watermark + ROOM_ROLLUP_STEP, closed_until)
+        inserted = 0
+        for statement in refresh_statements(dialect_name, watermark, end):
+            if statement.is_insert:
+                inserted += session.execute(statement).rowcount
+            else:
+                session.execute(statement)
+        if inserted == 0:
+            #nothing in this window, jump over the gap to the next data
+            next_timestamp = _first_timestamp(session, end)
+            end = closed_until if next_timestamp is None else max(end, min(MINUTE.floor(next_timestamp), closed_until))
+        session.merge(RollupWatermark(resolution = ROOM_ROLLUP, watermark = end))
+        session.commit()
+
+
+def room_stats_query(room: Optional[Room] = None, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    '''
+    Statistics of every room (or of one room) over the hour buckets in [start, end),
+    start and end are rounded down to the hour
+    '''
+    entry_count = func.sum(RoomRollup.entry_count)
+    query = select(
+        Room.name.label("room"), entry_count.label("entry_count"),
+        (func.sum(RoomRollup.temperature_sum) / entry_count).label("temperature_avg"),
+        func.min(RoomRollup.temperature_min).label("temperature_min"),
+        func.max(RoomRollup.temperature_max).label("temperature_max"),
+        (func.sum(RoomRollup.humidity_sum) / entry_count).label("humidity_avg"),
+        func.min(RoomRollup.humidity_min).label("humidity_min"),
+        func.max(RoomRollup.humidity_max).label("humidity_max"),
+        func.max(RoomRollup.last_timestamp).label("last_timestamp"),
+    ).join(Room, RoomRollup.room_id == Room.id)
+    if room is not None:
+        query = query.where(room_filter(room))
+    if start is not None:
+        query = query.where(RoomRollup.bucket >= HOUR.floor(to_naive_utc(start)))
+    if end is not None:
+        query = query.where(RoomRollup.bucket < HOUR.floor(to_naive_utc(end)))
+    return query.group_by(Room.name).order_by(Room.name)
@@ -0,0 +1,78 @@
+import asyncio
+import inspect
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    '''
+    Run a maintenance function in the background every interval_seconds.
+    The function can be a coroutine function or a regular one, regular functions
+    run in a worker thread so they do not block the event loop.
+    '''
+
+    def __init__(self, name: str, function, interval_seconds: float):
+        self.name = name
+        self.function = function
+        self.interval = interval_seconds
+        self._task: Optional[asyncio.Task] = None
+
+        #status exposed through status()
+        self.runs = 0
+        self.failures = 0
+        self.last_run: Optional[datetime] = None
+        self.last_duration = 0.0
+        self.last_result = None
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self):
+        start = time.perf_counter()
+        self.last_run = datetime.now(timezone.utc)
+        try:
+            if inspect.iscoroutinefunction(self.function):
+                self.last_result = await self.function()
+            else:
+                self.last_result = await asyncio.to_thread(self.function)
+        except Exception as e:
+            logger.error(f'job {self.name} failed')
+            logger.error(e)
+            self.failures += 1
+            self.last_error = str(e)
+        else:
+            self.last_error = None
+        self.runs += 1
+        self.last_duration = time.perf_counter() - start
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "interval_seconds": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_run": self.last_run,
+            "last_duration_ms": round(self.last_duration * 1000, 3),
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+
+#Opt-in log of the statements slower than a threshold, hooked into the cursor events of the engines.
+#Each slow statement is recorded with the shape of its parameters (types, not values), its duration
+#and the route of the request that ran it. The most recent ones are kept in a ring buffer, and the
+#slowest run of the slowest statements is kept aside so its plan can be captured on demand.
+
+#ASGI scope of the request being served, the router adds the matched route to it
+request_scope: ContextVar[Optional[dict]] = ContextVar("request_scope", default = None)
+
+#longest parameter list described type by type
+MAX_SHAPE_LENGTH = 10
+
+
+class RequestScopeMiddleware:
+    '''
+    Pure ASGI middleware making the scope of the current request available to the statement hooks
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        token = request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_scope.reset(token)
+
+
+def current_route() -> str:
+    '''
+    Route template of the request running the statement, "background" outside of a request
+    '''
+    scope = request_scope.get()
+    if scope is None:
+        return "background"
+    route = scope.get("route")
+    return f'{scope.get("method", "WS")} {route.path if route is not None else scope["path"]}'
+
+
+def parameters_shape(parameters: Any, executemany: bool = False) -> Any:
+    '''
+    Types of the parameters of a statement, without their values
+    '''
+    if executemany:
+        return {"rows": len(parameters), "row": parameters_shape(parameters[0]) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        shape = [type(value).__name__ for value in parameters[:MAX_SHAPE_LENGTH]]
+        if len(parameters) > MAX_SHAPE_LENGTH:
+            shape.append(f"... {len(parameters)} parameters")
+        return shape
+    return type(parameters).__name__
+
+
+def explain_prefix(dialect_name: str) -> Optional[str]:
+    if dialect_name == "postgresql":
+        return "EXPLAIN (ANALYZE, BUFFERS) "
+    if dialect_name == "sqlite":
+        return "EXPLAIN QUERY PLAN "
+    return None
+
+
+class SlowQueryLog:
+    '''
+    Ring buffer of the statements slower than threshold_ms, safe to use from several threads
+    '''
+
+    def __init__(self, threshold_ms: float, size: int = 100, worst_size: int = 5):
+        self.threshold = threshold_ms / 1000
+        self.recent = deque(maxlen = size)
+        self.worst_size = worst_size
+        #statement -> its slowest run, with the parameters needed to explain it
+        self._worst: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.slow_statements = 0
+
+    def instrument_engine(self, engine):
+        '''
+        Time the statements of an engine, for an async engine pass its sync_engine
+        '''
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            connection.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            duration = time.perf_counter() - connection.info["slow_query_start"].pop()
+            #the plans captured by explain() are not logged themselves
+            if duration >= self.threshold and not statement.startswith("EXPLAIN"):
+                self.record(statement, parameters, executemany, duration)
+
+    def record(self, statement: str, parameters: Any, executemany: bool, duration: float):
+        entry = {
+            "statement": statement,
+            "parameters": parameters_shape(parameters, executemany),
+            "duration_ms": round(duration * 1000, 3),
+            "route": current_route(),
+            "timestamp": datetime.now(timezone.utc),
+        }
+        logger.warning(f'slow query ({entry["duration_ms"]} ms, {entry["route"]}): {statement}')
+        with self._lock:
+            self.slow_statements += 1
+            self.recent.append(entry)
+            worst = self._worst.get(statement)
+            if worst is not None:
+                if duration > worst["duration"]:
+                    self._worst[statement] = {"entry": entry, "duration": duration, "parameters": parameters,
+                                              "executemany": executemany}
+                return
+            if len(self._worst) >= self.worst_size:
+                fastest = min(self._worst, key = lambda key: self._worst[key]["duration"])
+                if self._worst[fastest]["duration"] >= duration:
+                    return
+                del self._worst[fastest]
+            self._worst[statement] = {"entry": entry, "duration": duration, "parameters": parameters,
+                                      "executemany": executemany}
+
+    def entries(self) -> List[dict]:
+        '''
+        Recent slow statements, newest first
+        '''
+        with self._lock:
+            return list(reversed(self.recent))
+
+    def worst(self) -> List[dict]:
+        '''
+        Slowest run of the slowest statements, slowest first
+        '''
+        with self._lock:
+            return [worst["entry"] for worst in sorted(self._worst.values(), key = lambda worst: -worst["duration"])]
+
+    def explain(self, connection) -> List[dict]:
+        '''
+        Slowest statements with their query plan, EXPLAIN ANALYZE on postgres. Only the select
+        statements are explained since EXPLAIN ANALYZE runs the statement, and the transaction is
+        rolled back. Takes a sync connection, use AsyncConnection.run_sync with the async engine.
+        '''
+        prefix = explain_prefix(connection.dialect.name)
+        with self._lock:
+            worst = sorted(self._worst.values(), key = lambda worst: -worst["duration"])
+        explained = []
+        for slowest in worst:
+            entry = {**slowest["entry"], "plan": None}
+            if prefix is not None and not slowest["executemany"] and entry["statement"].lstrip().upper().startswith("SELECT"):
+                try:
+                    rows = connection.exec_driver_sql(prefix + entry["statement"], slowest["parameters"]).fetchall()
+                    entry["plan"] = "\n".join(" ".join(str(value) for value in row) for row in rows)
+                except Exception as e:
+                    entry["plan"] = f"could not explain the statement: {e}"
+                finally:
+                    connection.rollback()
+            explained.append(entry)
+        return explained
+
+    def stats(self) -> dict:
+        return {"threshold_ms": self.threshold * 1000, "slow_statements": self.slow_statements}
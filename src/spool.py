@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional, Union
+from src.orm import PlantSensorEntry, HumidityTemperatureEntry
+from src.helper_functions import to_naive_utc
+
+
+logger = logging.getLogger(__name__)
+
+
+#Durable on-disk spool for the readings that could not be written because the database was
+#unavailable. It is append only and split in segment files: a record is a batch of readings
+#stored as json, prefixed with its length and crc32. Once a segment is sealed it is replayed
+#into the database and deleted. A record cut short by a crash fails its length or crc check
+#and ends the replay of its segment. Replaying a segment twice is harmless, readings that are
+#already recorded are skipped by the insert.
+
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+
+#fsync policies: after every append, when a segment is sealed, or never (left to the OS)
+FSYNC_ALWAYS = "always"
+FSYNC_SEGMENT = "segment"
+FSYNC_NEVER = "never"
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_SEGMENT, FSYNC_NEVER)
+
+
+def encode_entries(sensor_entries: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]) -> bytes:
+    rows = []
+    for sensor_entry in sensor_entries:
+        wetness = sensor_entry.wetness if isinstance(sensor_entry, PlantSensorEntry) else None
+        rows.append([sensor_entry.sensor_id, to_naive_utc(sensor_entry.entry_timestamp).isoformat(),
+                     sensor_entry.temperature, sensor_entry.humidity, wetness])
+    return json.dumps(rows, separators = (",", ":")).encode()
+
+
+def decode_entries(payload: bytes) -> List[Union[PlantSensorEntry, HumidityTemperatureEntry]]:
+    sensor_entries = []
+    for sensor_id, entry_timestamp, temperature, humidity, wetness in json.loads(payload):
+        entry_timestamp = datetime.fromisoformat(entry_timestamp)
+        if wetness is not None:
+            sensor_entries.append(PlantSensorEntry(sensor_id = sensor_id, entry_timestamp = entry_timestamp,
+                                                   temperature = temperature, humidity = humidity, wetness = wetness))
+        else:
+            sensor_entries.append(HumidityTemperatureEntry(sensor_id = sensor_id, entry_timestamp = entry_timestamp,
+                                                           temperature = temperature, humidity = humidity))
+    return sensor_entries
+
+
+class Spool:
+    '''
+    Append only segment spool, safe to use from several threads.
+    Appends go to the active segment, which is sealed once it reaches segment_bytes
+    (or when the replayer asks for it) and a new one is started on the next append.
+    '''
+
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, fsync: str = FSYNC_ALWAYS):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}")
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_path: Optional[str] = None
+        #segments left by a previous run are sealed, numbering continues after them
+        existing = self.segments()
+        self._sequence = int(os.path.basename(existing[-1])[:-len(SEGMENT_SUFFIX)]) if existing else 0
+
+        #counters exposed through stats()
+        self.appended_rows = 0
+        self.replayed_rows = 0
+        self.last_replay: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    def append(self, sensor_entries: List[Union[PlantSensorEntry, HumidityTemperatureEntry]]):
+        '''
+        Write a batch of readings to the active segment, it is on disk when this returns
+        (and synced with the always policy). Blocking, call it from a worker thread in async code.
+        '''
+        payload = encode_entries(sensor_entries)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._active is None:
+                self._sequence += 1
+                self._active_path = os.path.join(self.directory, f"{self._sequence:012d}{SEGMENT_SUFFIX}")
+                self._active = open(self._active_path, "ab")
+            self._active.write(record)
+            self._active.flush()
+            if self.fsync == FSYNC_ALWAYS:
+                os.fsync(self._active.fileno())
+            self.appended_rows += len(sensor_entries)
+            if self._active.tell() >= self.segment_bytes:
+                self._seal()
+
+    def seal(self):
+        '''
+        Close the active segment so it can be replayed
+        '''
+        with self._lock:
+            self._seal()
+
+    def _seal(self):
+        if self._active is None:
+            return
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self._active.fileno())
+        self._active.close()
+        self._active = None
+        self._active_path = None
+
+    def segments(self) -> List[str]:
+        '''
+        Paths of the sealed segments, oldest first
+        '''
+        with self._lock:
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+            active_path = self._active_path
+        paths = [os.path.join(self.directory, name) for name in names]
+        return [path for path in paths if path != active_path]
+
+    def read(self, path: str) -> List[Union[PlantSensorEntry, HumidityTemperatureEntry]]:
+        '''
+        Readings of a sealed segment, the file is memory mapped rather than read in one buffer
+        '''
+        sensor_entries = []
+        with open(path, "rb") as segment:
+            size = os.fstat(segment.fileno()).st_size
+            if size == 0:
+                return sensor_entries
+            with mmap.mmap(segment.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + RECORD_HEADER.size <= size:
+                    length, checksum = RECORD_HEADER.unpack_from(data, offset)
+                    start = offset + RECORD_HEADER.size
+                    payload = data[start:start + length]
+                    if len(payload) < length or zlib.crc32(payload) != checksum:
+                        logger.warning(f'spool segment {path} ends with a torn record at offset {offset}')
+                        break
+                    sensor_entries += decode_entries(payload)
+                    offset = start + length
+        return sensor_entries
+
+    async def replay(self, write: Callable[[list], Awaitable[list]], batch_size: int = 5000) -> int:
+        '''
+        Drain the spool: write every sealed segment with the batch writer (sealing the active one
+        first when there is none)
+        and delete it. If the database is still unavailable the write raises and the segment is
+        kept for the next attempt. Returns the number of readings replayed.
+        '''
+        segments = self.segments()
+        if not segments:
+            #while the database is down, the segments already sealed are retried and the active one
+            #keeps growing, so an outage does not leave a trail of tiny segments
+            self.seal()
+            segments = self.segments()
+        replayed = 0
+        try:
+            for path in segments:
+                sensor_entries = await asyncio.to_thread(self.read, path)
+                for start in range(0, len(sensor_entries), batch_size):
+                    await write(sensor_entries[start:start + batch_size])
+                os.remove(path)
+                replayed += len(sensor_entries)
+                self.replayed_rows += len(sensor_entries)
+        except Exception as e:
+            self.last_error = str(e)
+            raise
+        else:
+            self.last_error = None
+        finally:
+            self.last_replay = datetime.now(timezone.utc)
+        return replayed
+
+    def close(self):
+        self.seal()
+
+    def stats(self) -> dict:
+        segments = self.segments()
+        return {
+            "directory": self.directory,
+            "fsync": self.fsync,
+            "sealed_segments": len(segments),
+            "pending_bytes": sum(os.path.getsize(path) for path in segments),
+            "active_segment": self._active_path,
+            "appended_rows": self.appended_rows,
+            "replayed_rows": self.replayed_rows,
+            "last_replay": self.last_replay,
+            "last_error": self.last_error,
+        }
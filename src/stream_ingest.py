@@ -0,0 +1,116 @@
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple, Union
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from src.models import Measurement, EntryResult, ENTRY_CREATED, ENTRY_DUPLICATE, ENTRY_SPOOLED
+from src.orm import PlantSensorEntry, HumidityTemperatureEntry
+from src.helper_functions import parse_measurement, validate_items
+
+
+#Measurements streamed over a long lived connection (websocket ingest).
+#Every reading received on the connection gets a sequence number, starting at 1. Readings are
+#validated as they arrive and written in batches, after each batch the server acks cumulatively:
+#an ack of n means every reading up to n was processed (stored, already recorded, spooled while
+#the database is unavailable or rejected, rejected readings are listed with their sequence number).
+#Binary frames count as one rejected reading, the connection stays open.
+
+
+class MeasurementStream:
+
+    def __init__(self, flush_rows: int, flush_interval_ms: float):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000
+        self.received = 0
+        self.acked = 0
+        #(sequence number, entry) waiting to be written
+        self.pending: List[Tuple[int, Union[PlantSensorEntry, HumidityTemperatureEntry]]] = []
+        #readings rejected since the last ack
+        self.failed: List[dict] = []
+        #time at which the pending readings must be written at the latest
+        self.deadline: Optional[float] = None
+
+    def receive(self, text: str):
+        '''
+        Add a frame holding one measurement or a list of measurements (same fields as /api/measurement)
+        '''
+        try:
+            items = json.loads(text)
+        except ValueError:
+            self.reject("frame is not valid json")
+            return
+        if not isinstance(items, list):
+            items = [items]
+
+        first = self.received + 1
+        self.received += len(items)
+        valid, positions, results = validate_items(items, Measurement, "sensor_id")
+        for result in results:
+            if result is not None:
+                self.failed.append({"seq": first + result.index, "detail": result.detail})
+        if valid and not self.pending:
+            self.deadline = time.monotonic() + self.flush_interval
+        self.pending += [(first + position, parse_measurement(measurement)) for position, measurement in zip(positions, valid)]
+
+    def reject(self, detail: str):
+        '''
+        Count a frame that cannot be read as one failed reading
+        '''
+        self.received += 1
+        self.failed.append({"seq": self.received, "detail": detail})
+
+    def timeout(self) -> Optional[float]:
+        '''
+        Seconds to wait for the next frame before the pending readings are written, None when nothing is pending
+        '''
+        if not self.pending:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def due(self) -> bool:
+        if self.pending:
+            return len(self.pending) >= self.flush_rows or time.monotonic() >= self.deadline
+        #frames with only invalid readings are acked right away
+        return self.received > self.acked
+
+    async def flush(self, write: Callable[[list], Awaitable[List[EntryResult]]]) -> dict:
+        '''
+        Write the pending readings with the batch writer and return the ack message
+        '''
+        created = duplicates = spooled = 0
+        if self.pending:
+            results = await write([entry for _, entry in self.pending])
+            for (seq, _), result in zip(self.pending, results):
+                if result.status == ENTRY_CREATED:
+                    created += 1
+                elif result.status == ENTRY_DUPLICATE:
+                    duplicates += 1
+                elif result.status == ENTRY_SPOOLED:
+                    spooled += 1
+                else:
+                    self.failed.append({"seq": seq, "detail": result.detail})
+
+        ack = {"ack": self.received, "created": created, "duplicate": duplicates, "spooled": spooled,
+               "failed": sorted(self.failed, key = lambda failure: failure["seq"])}
+        self.acked = self.received
+        self.pending = []
+        self.failed = []
+        self.deadline = None
+        return ack
+
+
+async def receive_frame(websocket: WebSocket, stream: MeasurementStream):
+    '''
+    Wait for the next frame (until the pending readings are due) and add it to the stream.
+    Raises WebSocketDisconnect when the client left.
+    '''
+    try:
+        message = await asyncio.wait_for(websocket.receive(), stream.timeout())
+    except asyncio.TimeoutError:
+        return
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("text") is not None:
+        stream.receive(message["text"])
+    else:
+        stream.reject("binary frames are not accepted, send the measurements as json text")
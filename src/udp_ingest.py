@@ -0,0 +1,83 @@
+import asyncio
+import json
+import logging
+from typing import Callable, Optional, Tuple
+from src.models import Measurement
+from src.helper_functions import parse_measurement, validate_items
+from src.binary_frame import decode_frame
+from src.ingest_buffer import IngestBuffer
+
+
+logger = logging.getLogger(__name__)
+
+
+#Fire-and-forget ingest over UDP. A datagram holds either json (one measurement or a list, same
+#fields as /api/measurement) or a binary frame (see src/binary_frame.py). Nothing is sent back,
+#the readings are queued on an IngestBuffer which coalesces them into batched inserts.
+
+
+class UDPIngestProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, buffer: IngestBuffer, allowed: Callable[[str], bool]):
+        #the readings written are reported by the on_flushed callback of the buffer
+        self.buffer = buffer
+        #checks the source address against the allow-list
+        self.allowed = allowed
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+        #counters exposed through stats()
+        self.received = 0
+        #from a source that is not allowed, or the buffer was full
+        self.dropped = 0
+        #could not be decoded, or held at least one reading out of range
+        self.invalid = 0
+        self.accepted_rows = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]):
+        self.received += 1
+        if not self.allowed(address[0]):
+            self.dropped += 1
+            return
+
+        try:
+            entries, results = self.decode(data)
+        except ValueError as e:
+            logger.debug(f'invalid datagram from {address[0]}: {e}')
+            self.invalid += 1
+            return
+        if any(result is not None for result in results):
+            self.invalid += 1
+
+        for entry in entries:
+            try:
+                self.buffer.put(entry)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                break
+            self.accepted_rows += 1
+
+    def decode(self, data: bytes) -> Tuple[list, list]:
+        '''
+        Entries of a datagram and the results of validate_items (None for the valid readings).
+        Raises ValueError if the datagram can not be decoded.
+        '''
+        if data[:1] in (b"{", b"["):
+            items = json.loads(data)
+            if not isinstance(items, list):
+                items = [items]
+            valid, positions, results = validate_items(items, Measurement, "sensor_id")
+            return [parse_measurement(measurement) for measurement in valid], results
+
+        entries, positions, results = decode_frame(data)
+        return entries, results
+
+    def stats(self) -> dict:
+        return {
+            "received_packets": self.received,
+            "dropped_packets": self.dropped,
+            "invalid_packets": self.invalid,
+            "accepted_rows": self.accepted_rows,
+        }
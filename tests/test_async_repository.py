@@ -0,0 +1,198 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlmodel import SQLModel
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.exc import IntegrityError
+from src.orm import *
+from src.models import SensorIn, ENTRY_CREATED, ENTRY_FAILED, ENTRY_DUPLICATE
+from src.repository.async_sqlmodel_repository import AsyncSQLModelRepository
+from src.retention import RetentionEngine
+from src.cold_storage import Archiver
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+@pytest.fixture(name="async_repo")
+def fixture_async_repo():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+    async def create_tables():
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+
+    run(create_tables())
+    return AsyncSQLModelRepository(engine)
+
+def test_get_room_doesnot_exist(async_repo):
+    assert run(async_repo.get_room(Room(name = "not_in_database"))) is None
+
+def test_add_room(async_repo):
+    room = run(async_repo.add_room(Room(name = "bedroom")))
+    assert room.id is not None
+    assert run(async_repo.get_room(Room(name = "BedRoom"))).name == "bedroom"
+
+def test_add_existing_room_raises_error(async_repo):
+    run(async_repo.add_room(Room(name = "bedroom")))
+    with pytest.raises(ValueError):
+        run(async_repo.add_room(Room(name = "Bedroom")))
+
+def test_add_room_with_wrong_type_raises(async_repo):
+    with pytest.raises(TypeError):
+        run(async_repo.add_room(Room(name = 1234)))
+
+@pytest.mark.parametrize("plant_name", ['Plant1', 'plant1'])
+def test_add_existing_plant_raises_error(async_repo, plant_name):
+    run(async_repo.add_plant(Plant(name = "plant1")))
+    with pytest.raises(IntegrityError):
+        run(async_repo.add_plant(Plant(name = plant_name)))
+
+def test_add_and_get_sensor(async_repo):
+    room = run(async_repo.add_room(Room(name = "bedroom")))
+    run(async_repo.add_sensor(Sensor(serial_number = 10, room = room)))
+    sensor = run(async_repo.get_sensor(Sensor(serial_number = 10)))
+    assert sensor.room_id == room.id
+
+def test_add_data_entries(async_repo):
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    entries = [
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 20, humidity = 0.5),
+        PlantSensorEntry(sensor_id = 2, entry_timestamp = timestamp, temperature = 21, humidity = 0.4, wetness = 0.3),
+    ]
+    run(async_repo.add_data_entry(entries[0]))
+    assert run(async_repo.add_data_entry(entries[0])) is None
+    results = run(async_repo.add_data_entries(entries))
+    assert [result.status for result in results] == [ENTRY_DUPLICATE, ENTRY_CREATED]
+
+def test_add_data_entries_falls_back_to_savepoints():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def foreign_keys_on(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    async def scenario():
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+        async_repo = AsyncSQLModelRepository(engine)
+        await async_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+        timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        results = await async_repo.add_data_entries([
+            HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 20, humidity = 0.5),
+            HumidityTemperatureEntry(sensor_id = 99, entry_timestamp = timestamp, temperature = 50, humidity = 0.5),
+            HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(minutes=1), temperature = 23, humidity = 0.5),
+        ])
+        return results, await async_repo.get_average_temperature(Room(name = "bedroom"))
+
+    results, average = run(scenario())
+    assert [result.status for result in results] == [ENTRY_CREATED, ENTRY_FAILED, ENTRY_CREATED]
+    assert average == pytest.approx(21.5)
+
+def test_concurrent_calls(async_repo):
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+    async def scenario():
+        await async_repo.add_sensor(Sensor(serial_number = 1))
+        await asyncio.gather(*[
+            async_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(seconds=i),
+                                                               temperature = 10 + i, humidity = 0.5))
+            for i in range(10)
+        ])
+        return await async_repo.get_average_temperature()
+
+    assert run(scenario()) == pytest.approx(14.5)
+
+def test_provision_sensor(async_repo):
+    first = run(async_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom", plant = "Pothos")))
+    second = run(async_repo.provision_sensor(SensorIn(serial_number = 2, room = "Bedroom")))
+    plant = run(async_repo.get_plant(Plant(name = "pothos")))
+    assert first.plant_id == plant.id and second.room_id == plant.room_id
+    with pytest.raises(IntegrityError):
+        run(async_repo.provision_sensor(SensorIn(serial_number = 2, room = "bedroom")))
+
+def test_provision_sensors(async_repo):
+    sensors = [SensorIn(serial_number = 1, room = "bedroom", plant = "Pothos"), SensorIn(serial_number = 1, room = "Bedroom")]
+    results = run(async_repo.provision_sensors(sensors))
+    assert [result.status for result in results] == [ENTRY_CREATED, ENTRY_FAILED]
+    assert run(async_repo.get_plant(Plant(name = "pothos"))).room_id == run(async_repo.get_room(Room(name = "bedroom"))).id
+
+def test_rebuild_aggregates(async_repo):
+    run(async_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom")))
+    run(async_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc),
+                                                           temperature = 18, humidity = 0.5)))
+    assert run(async_repo.get_average_temperature(Room(name = "Bedroom"))) == pytest.approx(18)
+    run(async_repo.rebuild_aggregates())
+    assert run(async_repo.get_average_temperature(Room(name = "Bedroom"))) == pytest.approx(18)
+
+def test_compact_rollups(async_repo):
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    run(async_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(minutes=i),
+                                                              temperature = 20, humidity = 0.5) for i in range(5)]))
+    watermarks = run(async_repo.compact_rollups(now = timestamp + timedelta(hours=2)))
+    assert watermarks["1h"] == datetime(2024, 3, 1, 1)
+    resolution, rows = run(async_repo.get_rollup(1, timestamp, timestamp + timedelta(hours=1), 1))
+    assert resolution == "1h" and rows[0].entry_count == 5
+
+def test_stream_measurements(async_repo):
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    run(async_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(minutes=i),
+                                                              temperature = 20, humidity = 0.5) for i in range(5)]))
+
+    async def collect():
+        return [chunk async for chunk in async_repo.stream_measurements(chunk_size = 2)]
+
+    assert [len(chunk) for chunk in run(collect())] == [2, 2, 1]
+
+def test_lean_add_data_entry(async_repo):
+    lean_repo = AsyncSQLModelRepository(async_repo.engine, lean_writes = True)
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    run(lean_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 19, humidity = 0.5)))
+    assert len(run(lean_repo.get_measurements(1))) == 1
+
+def test_get_latest_readings(async_repo):
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    run(async_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom")))
+    run(async_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(minutes=i),
+                                                              temperature = 20 + i, humidity = 0.5) for i in range(3)]))
+    readings = run(async_repo.get_latest_readings())
+    assert len(readings) == 1 and readings[0].temperature == 22
+    assert run(async_repo.get_room_sensors()) == [("bedroom", 1, None)]
+
+def test_maintain_partitions_is_a_no_op_on_sqlite(async_repo):
+    assert run(async_repo.maintain_partitions()) == {}
+
+def test_apply_retention(async_repo):
+    start = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    run(async_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(hours=i),
+                                                              temperature = 20, humidity = 0.5) for i in range(48)]))
+    run(async_repo.compact_rollups(now = start + timedelta(days=1)))
+    retention = RetentionEngine({"raw": timedelta(hours=1)}, chunk_size = 10)
+    assert run(async_repo.apply_retention(retention))["humidity_temperature_entry"]["deleted_rows"] == 24
+
+def test_archive_measurements(async_repo):
+    start = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    run(async_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(hours=i),
+                                                              temperature = 20, humidity = 0.5) for i in range(48)]))
+    run(async_repo.compact_rollups(now = start + timedelta(days=2)))
+    #the second day is not entirely compacted yet
+    assert run(async_repo.archive_measurements(Archiver(timedelta(hours=1)))) == {"archived_rows": 24, "chunks": 1}
+    assert len(run(async_repo.get_measurements(1, start = start + timedelta(hours=20)))) == 28
+
+    async def collect():
+        return [row async for chunk in async_repo.stream_measurements() for row in chunk]
+
+    assert len(run(collect())) == 48
+
+def test_get_room_stats(async_repo):
+    start = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    run(async_repo.provision_sensors([SensorIn(serial_number = 1, room = "bedroom"), SensorIn(serial_number = 2, room = "bedroom", plant = "pothos")]))
+    run(async_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start, temperature = 20, humidity = 0.5),
+                                     PlantSensorEntry(sensor_id = 2, entry_timestamp = start, temperature = 24, humidity = 0.5, wetness = 0.2)]))
+    assert run(async_repo.compact_rollups(now = start + timedelta(hours=1)))["room_1h"] == datetime(2024, 3, 1, 0, 59)
+    stats = run(async_repo.get_room_stats(Room(name = "bedroom")))
+    assert stats[0].entry_count == 2 and stats[0].temperature_avg == 22
@@ -0,0 +1,26 @@
+import pytest
+from datetime import datetime, timezone
+from src.orm import *
+from src.models import ENTRY_FAILED
+from src.binary_frame import encode_frame, decode_frame, HEADER, RECORD
+
+
+def test_decode_frame():
+    frame = encode_frame([(1, 1700000000, 20.5, 0.5, None), (2, 1700000000, 21, 0.25, 0.75)])
+    assert len(frame) == HEADER.size + 2 * RECORD.size
+    entries, positions, results = decode_frame(frame)
+    assert positions == [0, 1] and results == [None, None]
+    assert isinstance(entries[0], HumidityTemperatureEntry) and entries[0].temperature == 20.5
+    assert isinstance(entries[1], PlantSensorEntry) and entries[1].wetness == 0.75
+    assert entries[0].entry_timestamp == datetime.fromtimestamp(1700000000, tz = timezone.utc)
+
+def test_decode_frame_range_checks():
+    entries, positions, results = decode_frame(encode_frame([(1, 0, 71, 0.5, None), (2, 0, 20, 0.5, 0.5), (3, 0, 20, -0.1, 1.5)]))
+    assert positions == [1]
+    assert results[0].status == ENTRY_FAILED and results[0].detail == "temperature: out of range"
+    assert results[2].detail == "humidity: out of range; wetness: out of range"
+
+@pytest.mark.parametrize("frame", [b"\x01", b"\x02\x00\x00\x00", encode_frame([(1, 0, 20, 0.5, None)])[:-1]])
+def test_decode_malformed_frame_raises(frame):
+    with pytest.raises(ValueError):
+        decode_frame(frame)
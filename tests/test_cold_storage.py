@@ -0,0 +1,195 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event
+from sqlmodel import SQLModel, create_engine, Session, select, func
+from src.orm import *
+from src.cold_storage import Archiver, window_floor
+from src.export import format_chunks
+from src.history import entry_cursor
+from src.retention import RetentionEngine, parse_retention
+from src.repository.sqlmodel_repository import SQLModel_repository
+
+
+@pytest.fixture(name="engine")
+def fixture_engine():
+    engine = create_engine("sqlite:///:memory:")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+@pytest.fixture(name="sql_repo")
+def fixture_repo(engine):
+    return SQLModel_repository(engine)
+
+@pytest.fixture
+def start():
+    return datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+@pytest.fixture
+def entries(start):
+    #one reading per hour over 10 days for a sensor and a plant sensor
+    return [HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(hours=hour), temperature = 20 + hour % 7,
+                                     humidity = 0.5) for hour in range(240)] + \
+           [PlantSensorEntry(sensor_id = 2, entry_timestamp = start + timedelta(hours=hour), temperature = 18, humidity = 0.4,
+                             wetness = hour / 1000) for hour in range(240)]
+
+def count(engine, table):
+    with Session(engine) as session:
+        return session.exec(select(func.count()).select_from(table)).one()
+
+def archive(engine, archiver, now):
+    with Session(engine) as session:
+        return archiver.run(session, now = now)
+
+def test_window_floor():
+    assert window_floor(datetime(2024, 3, 1, 17, 5), timedelta(days=1)) == datetime(2024, 3, 1)
+    assert window_floor(datetime(2024, 3, 1, 17, 5), timedelta(hours=6)) == datetime(2024, 3, 1, 12)
+
+def test_nothing_is_archived_before_compaction(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    assert sql_repo.archive_measurements(Archiver(timedelta(days=1))) == {"archived_rows": 0, "chunks": 0}
+    assert count(engine, MeasurementChunk) == 0
+
+def test_closed_windows_are_archived(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    archiver = Archiver(timedelta(days=5))
+    result = archive(engine, archiver, start + timedelta(days=10, hours=12))
+
+    #5 daily windows of both sensors
+    assert result == {"archived_rows": 2 * 5 * 24, "chunks": 10}
+    assert count(engine, HumidityTemperatureEntry) == 120 and count(engine, PlantSensorEntry) == 120
+    assert archiver.status()["cutoff"] == datetime(2024, 3, 6) and archiver.status()["done"]
+    with Session(engine) as session:
+        chunk = session.get(MeasurementChunk, (2, True, datetime(2024, 3, 1)))
+    assert chunk.entry_count == 24 and chunk.last_timestamp == datetime(2024, 3, 1, 23)
+
+def test_archive_is_held_to_the_minute_rollup(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=3, hours=6))
+    archive(engine, Archiver(timedelta(days=1)), start + timedelta(days=20))
+    assert count(engine, HumidityTemperatureEntry) == 240 - 3 * 24
+
+def test_history_and_export_merge_archived_entries(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    archive(engine, Archiver(timedelta(days=5)), start + timedelta(days=10, hours=12))
+
+    page = sql_repo.get_measurements(1, start = start + timedelta(days=4, hours=20), limit = 10)
+    assert [entry.entry_timestamp for entry in page] == [datetime(2024, 3, 5, 20) + timedelta(hours=i) for i in range(10)]
+    assert [entry.temperature for entry in page] == [20 + (116 + i) % 7 for i in range(10)]
+    page = sql_repo.get_measurements(2, after = datetime(2024, 3, 2, 5), end = start + timedelta(days=1, hours=8))
+    assert len(page) == 2 and page[0].wetness == 30 / 1000
+
+    rows = [row for chunk in sql_repo.stream_measurements(start = start + timedelta(days=4), end = start + timedelta(days=6))
+            for row in chunk]
+    assert len(rows) == 2 * 48 and len({row[:3] for row in rows}) == 2 * 48
+    assert ("plant_sensor", 2, datetime(2024, 3, 5, 1), 18, 0.4, 97 / 1000) in rows
+    assert "".join(format_chunks(iter([rows[-1:]]), "csv")).count("\n") == 2
+
+def test_history_cursor_splits_equal_timestamps_in_chunks(engine, sql_repo, start):
+    #regular and plant sensor 1 read at the same hours, the first day is archived
+    sql_repo.add_data_entries([entry_type(sensor_id = 1, entry_timestamp = start + timedelta(hours=hour), temperature = hour,
+                                          humidity = 0.5, **extra) for hour in range(48)
+                               for entry_type, extra in ((HumidityTemperatureEntry, {}), (PlantSensorEntry, {"wetness": 0.1}))])
+    sql_repo.compact_rollups(now = start + timedelta(days=3))
+    archive(engine, Archiver(timedelta(days=1)), start + timedelta(days=2, hours=12))
+    assert count(engine, HumidityTemperatureEntry) == 24
+
+    entries = []
+    after = None
+    while True:
+        page = sql_repo.get_measurements(1, after = after, limit = 7)
+        entries += page
+        if len(page) < 7:
+            break
+        after = entry_cursor(page[-1])
+    assert [(entry.temperature, isinstance(entry, PlantSensorEntry)) for entry in entries] == \
+           [(hour, plant) for hour in range(48) for plant in (False, True)]
+
+def test_late_entries_are_merged_into_their_chunk(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    archiver = Archiver(timedelta(days=5))
+    archive(engine, archiver, start + timedelta(days=10, hours=12))
+
+    sql_repo.add_data_entries([
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=30), temperature = 5, humidity = 0.5),
+        #resent reading, the archived one is kept
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(hours=1), temperature = 5, humidity = 0.5),
+    ])
+    assert archive(engine, archiver, start + timedelta(days=10, hours=12)) == {"archived_rows": 2, "chunks": 1}
+
+    page = sql_repo.get_measurements(1, end = start + timedelta(hours=2))
+    assert [(entry.entry_timestamp.minute, entry.temperature) for entry in page] == [(0, 20), (30, 5), (0, 21)]
+    with Session(engine) as session:
+        assert session.get(MeasurementChunk, (1, False, datetime(2024, 3, 1))).entry_count == 25
+
+def test_readings_beyond_the_write_horizon_are_rejected(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    archive(engine, Archiver(timedelta(days=5)), start + timedelta(days=10, hours=12))
+
+    #the windows before March 6th are archived, a resent reading of these windows would be counted twice
+    repo = SQLModel_repository(engine, write_horizon = datetime.now(timezone.utc) - (start + timedelta(days=5)))
+    resent = HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(hours=1), temperature = 21, humidity = 0.5)
+    with pytest.raises(ValueError):
+        repo.add_data_entry(resent)
+    results = repo.add_data_entries([resent, HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(days=6, minutes=30),
+                                                                      temperature = 20, humidity = 0.5)])
+    assert [result.status for result in results] == ["failed", "created"]
+    assert "write horizon" in results[0].detail
+    assert count(engine, HumidityTemperatureEntry) == 240 - 5 * 24 + 1
+    with Session(engine) as session:
+        assert session.get(SensorAggregate, 1).entry_count == 241
+
+def test_an_emptied_window_is_not_archived(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    archiver = Archiver(timedelta(days=5))
+    with Session(engine) as session:
+        assert archiver._archive_window(session, HumidityTemperatureEntry, False, 1, datetime(2024, 2, 1)) == 0
+    assert count(engine, MeasurementChunk) == 0
+
+def test_history_pages_only_decode_the_chunks_they_need(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    archive(engine, Archiver(timedelta(days=5)), start + timedelta(days=10, hours=12))
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    page = sql_repo.get_measurements(1, start = start + timedelta(hours=20), limit = 10)
+    assert [entry.entry_timestamp for entry in page] == [datetime(2024, 3, 1, 20) + timedelta(hours=i) for i in range(10)]
+    #the chunks of March 1st and 2nd hold the page, the next ones are not loaded
+    assert sum("measurement_chunk.data" in statement for statement in statements) == 2
+
+def test_runs_are_bounded(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    archiver = Archiver(timedelta(days=5), max_windows = 3)
+    assert archive(engine, archiver, start + timedelta(days=10))["chunks"] == 3
+    assert not archiver.status()["done"]
+    for _ in range(3):
+        archive(engine, archiver, start + timedelta(days=10))
+    assert count(engine, MeasurementChunk) == 10 and archiver.archived_rows == 240
+
+def test_expired_chunks_are_deleted(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    archive(engine, Archiver(timedelta(days=5)), start + timedelta(days=10, hours=12))
+    retention = RetentionEngine(parse_retention("archive=8d"))
+    with engine.connect() as connection:
+        result = retention.run(connection, now = start + timedelta(days=11))
+    #the windows of March 1st to 3rd end before the cutoff (March 4th)
+    assert result["measurement_chunk"]["deleted_rows"] == 2 * 3
+
+def test_rebuild_aggregates_adds_archived_entries(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    average = sql_repo.get_average_temperature()
+    archive(engine, Archiver(timedelta(days=5)), start + timedelta(days=10, hours=12))
+
+    sql_repo.rebuild_aggregates()
+    assert sql_repo.get_average_temperature() == pytest.approx(average)
+    with Session(engine) as session:
+        aggregate = session.get(SensorAggregate, 1)
+    assert aggregate.entry_count == 240 and aggregate.last_timestamp == datetime(2024, 3, 10, 23)
+
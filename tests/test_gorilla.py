@@ -0,0 +1,48 @@
+import math
+import random
+import struct
+import pytest
+from datetime import datetime, timedelta
+from src.gorilla import encode_chunk, decode_chunk
+
+
+def bits(value):
+    return struct.pack("<d", value)
+
+def test_roundtrip_is_exact():
+    rng = random.Random(0)
+    start = datetime(2024, 3, 1)
+    timestamps = [start + timedelta(seconds=60 * i, microseconds=rng.randint(0, 999999)) for i in range(1440)]
+    temperature = [round(20 + rng.gauss(0, 2), 1) for _ in timestamps]
+    humidity = [rng.random() for _ in timestamps]
+    assert decode_chunk(encode_chunk(timestamps, temperature, humidity)) == (timestamps, temperature, humidity, None)
+
+def test_regular_series_compress_well():
+    start = datetime(2024, 3, 1)
+    timestamps = [start + timedelta(minutes=i) for i in range(1440)]
+    data = encode_chunk(timestamps, [21.5] * 1440, [0.5] * 1440, [0.3] * 1440)
+    #about one bit per timestamp and per value after the first reading, instead of 32 bytes per reading
+    assert len(data) < 800
+    assert decode_chunk(data)[3] == [0.3] * 1440
+
+def test_edge_values():
+    values = [0.0, -0.0, math.inf, -math.inf, 5e-324, 1.7976931348623157e308, -1.5, 1.5, 1.5]
+    timestamps = [datetime(1969, 12, 31), datetime(1970, 1, 1), datetime(2262, 1, 1)] + \
+        [datetime(2262, 1, 1) + timedelta(microseconds=i) for i in range(1, 7)]
+    decoded = decode_chunk(encode_chunk(timestamps, values, values, [math.nan] * len(values)))
+    assert decoded[0] == timestamps
+    assert [bits(value) for value in decoded[1]] == [bits(value) for value in values]
+    assert all(math.isnan(value) for value in decoded[3])
+
+def test_single_reading():
+    timestamp = datetime(2024, 3, 1, 12)
+    assert decode_chunk(encode_chunk([timestamp], [20.0], [0.5])) == ([timestamp], [20.0], [0.5], None)
+
+def test_empty_chunks_are_rejected():
+    with pytest.raises(ValueError):
+        encode_chunk([], [], [])
+
+@pytest.mark.parametrize("data", [b"", b"\x02\x00\x01\x00\x00\x00", b"\x01\x00\x05\x00\x00\x00\x00"])
+def test_malformed_chunks_raise_value_error(data):
+    with pytest.raises(ValueError):
+        decode_chunk(data)
@@ -0,0 +1,39 @@
+import ipaddress
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from src.ip_filter import IPFilter, IPFilterMiddleware, NetworkSet
+
+
+NETWORKS = [ipaddress.ip_network(network) for network in ("192.168.0.0/24", "127.0.0.1/32", "10.0.0.0/8", "2001:db8::/32")]
+
+@pytest.mark.parametrize("address,allowed", [
+    ("192.168.0.1", True), ("192.168.1.1", False), ("127.0.0.1", True), ("127.0.0.2", False),
+    ("10.200.3.4", True), ("11.0.0.1", False), ("2001:db8::1", True), ("2001:db9::1", False),
+])
+def test_network_set(address, allowed):
+    assert (ipaddress.ip_address(address) in NetworkSet(NETWORKS)) == allowed
+
+def test_decisions_are_cached():
+    ip_filter = IPFilter(NETWORKS, cache_size = 2)
+    assert ip_filter.allowed("192.168.0.1") and ip_filter.allowed("192.168.0.1")
+    assert not ip_filter.allowed("not an ip")
+    assert ip_filter.cache_info().hits == 1
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(IPFilterMiddleware, ip_filter = IPFilter(NETWORKS))
+
+    @app.get("/")
+    def index():
+        return {"message": "ok"}
+
+    return TestClient(app)
+
+def test_middleware(client):
+    assert client.get("/", headers = {"x-forwarded-for": "192.168.0.4, 8.8.8.8"}).status_code == 200
+    response = client.get("/", headers = {"x-forwarded-for": "8.8.8.8"})
+    assert response.status_code == 403 and "8.8.8.8" in response.json()["detail"]["message"]
+    #without forwarding header the peer address is used, "testclient" is not an ip address
+    assert client.get("/").status_code == 403
@@ -0,0 +1,48 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlmodel import SQLModel, create_engine
+from src.orm import *
+from src.models import SensorIn
+from src.latest import LatestReadings
+from src.repository.sqlmodel_repository import SQLModel_repository
+
+@pytest.fixture(name="engine")
+def fixture_engine():
+    engine = create_engine("sqlite:///:memory:")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+@pytest.fixture(name="sql_repo")
+def fixture_repo(engine):
+    return SQLModel_repository(engine)
+
+@pytest.fixture
+def timestamp():
+    return datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+def test_warm_from_database(sql_repo, timestamp):
+    sql_repo.provision_sensors([SensorIn(serial_number = 1, room = "Bedroom"),
+                                SensorIn(serial_number = 2, room = "bedroom", plant = "Pothos")])
+    sql_repo.add_room(Room(name = "attic"))
+    sql_repo.add_data_entries([
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 20, humidity = 0.5),
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(minutes=1), temperature = 21, humidity = 0.5),
+        PlantSensorEntry(sensor_id = 2, entry_timestamp = timestamp, temperature = 19, humidity = 0.4, wetness = 0.3),
+    ])
+
+    latest = LatestReadings()
+    latest.warm(sql_repo.get_latest_readings(), sql_repo.get_room_sensors())
+    assert latest.sensor(1)["temperature"] == 21
+    assert latest.sensor(2)["wetness"] == pytest.approx(0.3)
+    assert [reading["sensor_id"] for reading in latest.room("BEDROOM")] == [1, 2]
+    assert latest.room("attic") == [] and latest.room("kitchen") is None
+
+def test_update_keeps_newest_reading(timestamp):
+    latest = LatestReadings()
+    latest.assign("bedroom", 1)
+    latest.update([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 20, humidity = 0.5)])
+    #a retransmitted older reading does not replace the current one
+    latest.update([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp - timedelta(minutes=1), temperature = 18, humidity = 0.5)])
+    assert latest.sensor(1)["temperature"] == 20
+    assert latest.sensor(1)["entry_timestamp"] == timestamp.replace(tzinfo=None)
+    assert latest.room("Bedroom")[0]["temperature"] == 20
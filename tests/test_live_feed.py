@@ -0,0 +1,37 @@
+import asyncio
+from src.live_feed import LiveFeed, format_event
+
+
+def reading(sensor_id, room = "bedroom", plant = None, temperature = 20):
+    return {"sensor_id": sensor_id, "room": room, "plant": plant, "temperature": temperature}
+
+def test_subscribers_get_matching_readings():
+    async def scenario():
+        feed = LiveFeed()
+        everything = feed.subscribe()
+        by_sensor = feed.subscribe(sensor_id = 2)
+        by_room = feed.subscribe(room = "Office")
+        by_plant = feed.subscribe(plant = "POTHOS")
+        feed.publish([reading(1), reading(2, room = "office", plant = "pothos")])
+        assert everything.queue.qsize() == 2
+        assert (await by_sensor.get())["sensor_id"] == 2
+        assert (await by_room.get())["sensor_id"] == 2
+        assert (await by_plant.get())["sensor_id"] == 2
+        assert await by_plant.get(timeout = 0.01) is None
+
+    asyncio.run(scenario())
+
+def test_slow_subscriber_drops_oldest():
+    async def scenario():
+        feed = LiveFeed(queue_size = 2)
+        subscriber = feed.subscribe()
+        feed.publish(reading(1, temperature = temperature) for temperature in range(5))
+        assert subscriber.dropped == 3
+        assert [(await subscriber.get())["temperature"] for _ in range(2)] == [3, 4]
+        feed.unsubscribe(subscriber)
+        assert feed.stats()["subscribers"] == 0
+
+    asyncio.run(scenario())
+
+def test_format_event():
+    assert format_event({"sensor_id": 1}) == 'data: {"sensor_id": 1}\n\n'
@@ -0,0 +1,62 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from src.metrics import Histogram, Metrics, MetricsMiddleware, RateMeter, statement_labels
+
+
+def test_histogram_is_cumulative():
+    histogram = Histogram("latency", "test", ("route",), (0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, "/a")
+    lines = histogram.expose()
+    assert 'latency_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'latency_bucket{route="/a",le="1"} 3' in lines
+    assert 'latency_bucket{route="/a",le="+Inf"} 4' in lines
+    assert 'latency_count{route="/a"} 4' in lines
+    assert 'latency_sum{route="/a"} 6.05' in lines
+
+def test_rate_meter():
+    meter = RateMeter(window_seconds = 10)
+    meter.add(30)
+    meter.add(20)
+    assert meter.total == 50 and meter.rate() == 5
+
+@pytest.mark.parametrize("statement,labels", [
+    ("SELECT sensor.id FROM sensor WHERE sensor.id = ?", ("SELECT", "sensor")),
+    ('INSERT INTO "plant_sensor_entry" (sensor_id) VALUES (?)', ("INSERT", "plant_sensor_entry")),
+    ("UPDATE room_aggregate SET count = count + 1", ("UPDATE", "room_aggregate")),
+    ("COMMIT", ("COMMIT", "")),
+])
+def test_statement_labels(statement, labels):
+    assert statement_labels(statement) == labels
+
+def test_engine_statements_are_timed(tmp_path):
+    metrics = Metrics()
+    #file databases get a QueuePool, which reports its size and usage
+    engine = create_engine(f"sqlite:///{tmp_path / 'metrics.db'}")
+    metrics.instrument_engine("test", engine)
+    with engine.connect() as connection:
+        connection.execute(text("CREATE TABLE sensor (id INTEGER)"))
+        connection.execute(text("SELECT id FROM sensor"))
+    exposed = metrics.expose()
+    assert 'db_statement_duration_seconds_count{operation="SELECT",table="sensor"} 1' in exposed
+    assert 'db_pool_checked_out{engine="test"} 0' in exposed
+
+def test_middleware_labels_requests_with_the_route():
+    metrics = Metrics()
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware, metrics = metrics)
+
+    @app.get("/sensor/{sensor_id}")
+    def get_sensor(sensor_id: int):
+        return {"sensor_id": sensor_id}
+
+    client = TestClient(app)
+    client.get("/sensor/1")
+    client.get("/sensor/2")
+    client.get("/missing")
+    exposed = metrics.expose()
+    assert 'http_request_duration_seconds_count{method="GET",route="/sensor/{sensor_id}",status="200"} 2' in exposed
+    assert 'http_request_duration_seconds_count{method="GET",route="unmatched",status="404"} 1' in exposed
+    assert "http_requests_in_flight 0" in exposed
@@ -1,6 +1,6 @@
 from src.orm import *
 from src.models import *
-from src.helper_functions import create_db_sensor_entry_from_measurement, parse_measurement
+from src.helper_functions import create_db_sensor_entry_from_measurement, parse_measurement, parse_sensor_rows, validate_items, mark_duplicates, entry_key
 from datetime import datetime, timezone
 import pytz
 import pytest
@@ -174,3 +174,28 @@ def test_parse_measurement_naive_timestamp():
     assert measurement_data["entry_timestamp"].tzinfo == None
     measurement_obj = parse_measurement(Measurement(**measurement_data))
     assert measurement_obj.entry_timestamp.tzinfo == pytz.utc
+
+def test_parse_sensor_rows_csv():
+    content = "serial_number,room,plant\n1,bedroom,\n2,office,Pothos\n"
+    rows = parse_sensor_rows(content, "csv")
+    sensors = [SensorIn(**row) for row in rows]
+    assert sensors[0].serial_number == 1 and sensors[0].plant is None
+    assert sensors[1].room == "office" and sensors[1].plant == "Pothos"
+
+def test_parse_sensor_rows_json_requires_list():
+    assert parse_sensor_rows('[{"serial_number": 1, "room": "bedroom"}]', "json")[0]["room"] == "bedroom"
+    with pytest.raises(ValueError):
+        parse_sensor_rows('{"serial_number": 1}', "json")
+
+def test_validate_items_reports_invalid_items():
+    valid, positions, results = validate_items([{"serial_number": 1, "room": "bedroom"}, {"serial_number": "a"}], SensorIn, "serial_number")
+    assert positions == [0] and results[0] is None
+    assert results[1].status == ENTRY_FAILED and "room" in results[1].detail
+
+def test_mark_duplicates():
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    rows = [(index, {"sensor_id": 1, "entry_timestamp": timestamp}) for index in range(2)]
+    results = [EntryResult(index = index, sensor_id = 1, status = ENTRY_CREATED) for index in range(2)]
+    inserted = mark_duplicates(results, rows, [entry_key(1, timestamp.replace(tzinfo=None))])
+    assert inserted == [rows[0][1]]
+    assert [result.status for result in results] == [ENTRY_CREATED, ENTRY_DUPLICATE]
@@ -0,0 +1,36 @@
+import pytest
+from datetime import datetime
+from sqlmodel import SQLModel, create_engine
+from src.partitions import add_months, month_floor, partition_name, partition_statements
+from src.repository.sqlmodel_repository import SQLModel_repository
+
+
+@pytest.mark.parametrize("month,months,expected", [
+    (datetime(2024, 3, 1), 1, datetime(2024, 4, 1)),
+    (datetime(2024, 11, 1), 3, datetime(2025, 2, 1)),
+    (datetime(2024, 1, 1), -1, datetime(2023, 12, 1)),
+])
+def test_add_months(month, months, expected):
+    assert add_months(month, months) == expected
+
+def test_partition_name():
+    month = month_floor(datetime(2024, 3, 17, 8, 30))
+    assert month == datetime(2024, 3, 1)
+    assert partition_name("plant_sensor_entry", month) == "plant_sensor_entry_y2024m03"
+
+def test_partition_statements():
+    statements = partition_statements("humidity_temperature_entry", datetime(2024, 12, 1), default_has_rows = False)
+    assert statements == ["CREATE TABLE humidity_temperature_entry_y2024m12 PARTITION OF humidity_temperature_entry "
+                          "FOR VALUES FROM ('2024-12-01 00:00:00') TO ('2025-01-01 00:00:00')"]
+
+def test_partition_statements_move_the_rows_of_the_default_partition():
+    statements = partition_statements("humidity_temperature_entry", datetime(2024, 12, 1), default_has_rows = True)
+    assert statements[0] == "ALTER TABLE humidity_temperature_entry DETACH PARTITION humidity_temperature_entry_default"
+    assert statements[1].startswith("CREATE TABLE humidity_temperature_entry_y2024m12")
+    assert statements[2].startswith("INSERT INTO humidity_temperature_entry_y2024m12 SELECT * FROM humidity_temperature_entry_default")
+    assert statements[-1] == "ALTER TABLE humidity_temperature_entry ATTACH PARTITION humidity_temperature_entry_default DEFAULT"
+
+def test_maintain_partitions_is_a_no_op_on_sqlite():
+    engine = create_engine("sqlite:///:memory:")
+    SQLModel.metadata.create_all(engine)
+    assert SQLModel_repository(engine).maintain_partitions() == {}
@@ -0,0 +1,157 @@
+import json
+import os
+import random
+import re
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from sqlmodel import SQLModel, create_engine
+from src.models import SensorIn
+from src.orm import *
+from src.repository.sqlmodel_repository import SQLModel_repository
+from src.cold_storage import Archiver
+
+
+#Query plan regression harness: every repository method runs against a seeded database while its
+#statements are captured, each statement is then explained and the test fails if the plan reads a
+#table of more than SEQ_SCAN_THRESHOLD rows sequentially, i.e. a lookup an index should serve.
+#It runs on sqlite by default, set QUERY_PLAN_DATABASE_URL to an empty postgres database to check
+#the postgres plans (the tables are created and dropped by the test).
+
+SEQ_SCAN_THRESHOLD = 100
+
+ROOMS = 200
+PLANTS = 200
+SENSORS = 1000
+PLANT_SENSORS = 400
+ENTRIES_PER_SENSOR = 5
+START = datetime(2024, 3, 1)
+
+#tables read in full by design: the latest reading and room of every sensor, the global average,
+#the rebuild of the aggregates, and the exports of a time range, which read every sensor and chunk
+#over that range. The compaction and the archiving select the entries and buckets of a time range
+#by their time index
+EXPECTED_SCANS = {
+    "get_latest_readings": {"humidity_temperature_entry", "plant_sensor_entry"},
+    "get_room_sensors": {"room", "sensor", "plant", "plant_sensor"},
+    "get_room_stats": {"room"},
+    "get_average_temperature": {"sensor_aggregate", "sensor"},
+    "rebuild_aggregates": {"humidity_temperature_entry", "sensor", "sensor_aggregate", "room_aggregate"},
+    "stream_measurements": {"humidity_temperature_entry", "plant_sensor_entry", "measurement_chunk"},
+}
+
+
+def sequential_scans(connection, statement: str, parameters) -> set:
+    '''
+    Tables read sequentially by the plan of a statement
+    '''
+    if connection.dialect.name == "postgresql":
+        plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        nodes, tables = [plan[0]["Plan"]], set()
+        while nodes:
+            node = nodes.pop()
+            if node["Node Type"] == "Seq Scan":
+                tables.add(node["Relation Name"])
+            nodes += node.get("Plans", [])
+        return tables
+    rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    #SCAN is a full pass over a table (or one of its indexes), SEARCH a lookup
+    return {match.group(1) for row in rows for match in [re.match(r"SCAN (\w+)", row[-1])] if match}
+
+
+def seed(engine):
+    random.seed(0)
+    with engine.begin() as connection:
+        connection.execute(Room.__table__.insert(), [{"id": id, "name": f"Room {id}"} for id in range(ROOMS)])
+        connection.execute(Plant.__table__.insert(), [{"id": id, "room_id": id % ROOMS, "name": f"Plant {id}"} for id in range(PLANTS)])
+        connection.execute(Sensor.__table__.insert(),
+                           [{"serial_number": serial, "room_id": random.randrange(ROOMS)} for serial in range(SENSORS)])
+        connection.execute(PlantSensor.__table__.insert(),
+                           [{"serial_number": SENSORS + serial, "plant_id": random.randrange(PLANTS)} for serial in range(PLANT_SENSORS)])
+        connection.execute(HumidityTemperatureEntry.__table__.insert(), [
+            {"sensor_id": serial, "entry_timestamp": START + timedelta(minutes=minute), "temperature": 20, "humidity": 0.5}
+            for serial in range(SENSORS) for minute in range(ENTRIES_PER_SENSOR)])
+        connection.execute(PlantSensorEntry.__table__.insert(), [
+            {"sensor_id": SENSORS + serial, "entry_timestamp": START + timedelta(minutes=minute), "temperature": 20,
+             "humidity": 0.5, "wetness": 0.3}
+            for serial in range(PLANT_SENSORS) for minute in range(ENTRIES_PER_SENSOR)])
+    repo = SQLModel_repository(engine)
+    repo.rebuild_aggregates()
+    repo.compact_rollups(now = START + timedelta(days=2))
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+
+
+@pytest.fixture(scope="module", name="engine")
+def fixture_engine(tmp_path_factory):
+    url = os.getenv("QUERY_PLAN_DATABASE_URL") or f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.db'}"
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+    seed(engine)
+    yield engine
+    if engine.dialect.name == "postgresql":
+        SQLModel.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def workload():
+    '''
+    (method name, call) for every query of the repository
+    '''
+    sensor = SENSORS // 2
+    plant_sensor = SENSORS + PLANT_SENSORS // 2
+    end = START + timedelta(minutes=ENTRIES_PER_SENSOR)
+    return [
+        ("get_room", lambda repo: repo.get_room(Room(name = "ROOM 42"))),
+        ("get_plant", lambda repo: repo.get_plant(Plant(name = "plant 42"))),
+        ("get_sensor", lambda repo: repo.get_sensor(Sensor(serial_number = sensor))),
+        ("get_sensor", lambda repo: repo.get_sensor(PlantSensor(serial_number = plant_sensor))),
+        ("get_average_temperature", lambda repo: repo.get_average_temperature(Room(name = "room 7"))),
+        ("get_average_temperature", lambda repo: repo.get_average_temperature()),
+        ("get_measurements", lambda repo: repo.get_measurements(sensor, START, end, limit = 10)),
+        ("get_measurements", lambda repo: repo.get_measurements(plant_sensor, after = START, limit = 10)),
+        ("stream_measurements", lambda repo: list(repo.stream_measurements(START, end))),
+        ("stream_measurements", lambda repo: list(repo.stream_measurements(START, end, sensor_id = sensor))),
+        ("get_rollup", lambda repo: repo.get_rollup(sensor, START, end, 10)),
+        ("get_room_stats", lambda repo: repo.get_room_stats(Room(name = "Room 7"), START, end)),
+        ("get_room_stats", lambda repo: repo.get_room_stats(start = START, end = end)),
+        ("get_latest_readings", lambda repo: repo.get_latest_readings()),
+        ("get_room_sensors", lambda repo: repo.get_room_sensors()),
+        ("add_data_entry", lambda repo: repo.add_data_entry(HumidityTemperatureEntry(
+            sensor_id = sensor, entry_timestamp = end, temperature = 21, humidity = 0.4))),
+        ("add_data_entries", lambda repo: repo.add_data_entries([PlantSensorEntry(
+            sensor_id = plant_sensor, entry_timestamp = end, temperature = 21, humidity = 0.4, wetness = 0.2)])),
+        ("provision_sensor", lambda repo: repo.provision_sensor(SensorIn(serial_number = 90000, room = "room 3"))),
+        ("provision_sensors", lambda repo: repo.provision_sensors([SensorIn(serial_number = 90001, room = "Room 4", plant = "PLANT 5")])),
+        ("add_room", lambda repo: repo.add_room(Room(name = "new room"))),
+        ("add_plant", lambda repo: repo.add_plant(Plant(name = "new plant", room_id = 3))),
+        ("add_sensor", lambda repo: repo.add_sensor(Sensor(serial_number = 90002, room_id = 5))),
+        ("compact_rollups", lambda repo: repo.compact_rollups(now = START + timedelta(days=3))),
+        ("rebuild_aggregates", lambda repo: repo.rebuild_aggregates()),
+        ("archive_measurements", lambda repo: repo.archive_measurements(Archiver(timedelta(days=1)))),
+    ]
+
+
+@pytest.mark.parametrize("method,call", workload(), ids = [method for method, _ in workload()])
+def test_no_unexpected_sequential_scan(engine, method, call):
+    statements = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if not executemany and re.match(r"\s*(SELECT|UPDATE|DELETE|INSERT .* SELECT|WITH)", statement, re.IGNORECASE | re.DOTALL):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        call(SQLModel_repository(engine))
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    with engine.connect() as connection:
+        sizes = {table: connection.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+                 for table in SQLModel.metadata.tables}
+        scans = set()
+        for statement, parameters in statements:
+            scans |= {table for table in sequential_scans(connection, statement, parameters)
+                      if sizes.get(table, 0) > SEQ_SCAN_THRESHOLD}
+    assert scans <= EXPECTED_SCANS.get(method, set()), f"{method} reads {scans - EXPECTED_SCANS.get(method, set())} sequentially"
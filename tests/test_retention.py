@@ -0,0 +1,100 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlmodel import SQLModel, create_engine, Session, select, func
+from src.orm import *
+from src.retention import RetentionEngine, parse_retention, format_duration
+from src.repository.sqlmodel_repository import SQLModel_repository
+
+
+@pytest.fixture(name="engine")
+def fixture_engine():
+    engine = create_engine("sqlite:///:memory:")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+@pytest.fixture(name="sql_repo")
+def fixture_repo(engine):
+    return SQLModel_repository(engine)
+
+@pytest.fixture
+def start():
+    return datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+@pytest.fixture
+def entries(start):
+    #one reading per hour over 10 days
+    return [HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(hours=hour), temperature = 20, humidity = 0.5)
+            for hour in range(240)]
+
+def count(engine, table):
+    with Session(engine) as session:
+        return session.exec(select(func.count()).select_from(table)).one()
+
+def test_parse_retention():
+    policy = parse_retention("raw=30d, 1h=2y,1m=1w")
+    assert policy == {"raw": timedelta(days=30), "1h": timedelta(days=730), "1m": timedelta(weeks=1)}
+    assert {key: format_duration(retention) for key, retention in policy.items()} == {"raw": "30d", "1h": "2y", "1m": "1w"}
+
+@pytest.mark.parametrize("spec", ["raw=30", "forever=1d", "raw:30d"])
+def test_parse_retention_rejects_malformed_policies(spec):
+    with pytest.raises(ValueError):
+        parse_retention(spec)
+
+def test_raw_entries_are_kept_until_compacted(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    retention = RetentionEngine(parse_retention("raw=1d"), chunk_size = 50)
+    with engine.connect() as connection:
+        retention.run(connection, now = start + timedelta(days=20))
+    assert count(engine, HumidityTemperatureEntry) == 240
+    assert retention.status()["tables"]["humidity_temperature_entry"]["done"]
+
+def test_expired_rows_are_deleted_in_chunks(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    #only the first 5 days are compacted into the minute rollup
+    sql_repo.compact_rollups(now = start + timedelta(days=5))
+    retention = RetentionEngine(parse_retention("raw=1d"), chunk_size = 50)
+    with engine.connect() as connection:
+        result = retention.run(connection, now = start + timedelta(days=20))
+
+    assert result["humidity_temperature_entry"]["deleted_rows"] == 5 * 24
+    assert count(engine, HumidityTemperatureEntry) == 240 - 120
+    assert count(engine, MinuteRollup) > 0
+    progress = retention.status()["tables"]["humidity_temperature_entry"]
+    assert progress["chunks"] == 3 and progress["done"]
+
+def test_runs_are_bounded(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    retention = RetentionEngine(parse_retention("raw=1d"), chunk_size = 50, max_chunks = 2)
+    sql_repo.apply_retention(retention)
+    assert count(engine, HumidityTemperatureEntry) == 140
+    assert not retention.status()["tables"]["humidity_temperature_entry"]["done"]
+    sql_repo.apply_retention(retention)
+    sql_repo.apply_retention(retention)
+    assert count(engine, HumidityTemperatureEntry) == 0 and retention.deleted_rows_total == 240
+
+def test_rollups_are_deleted_once_downsampled(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    retention = RetentionEngine(parse_retention("1m=2d,1d=1d"), chunk_size = 1000)
+    with engine.connect() as connection:
+        result = retention.run(connection, now = start + timedelta(days=12))
+    assert result["rollup_1m"]["deleted_rows"] == 240
+    #the coarsest resolution is not held back by a watermark
+    assert count(engine, DayRollup) == 0
+    assert count(engine, HourRollup) == 240
+
+def test_rebuild_aggregates_is_refused_once_readings_expired(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=11))
+    sql_repo.rebuild_aggregates()
+    with engine.connect() as connection:
+        RetentionEngine(parse_retention("raw=5d")).run(connection, now = start + timedelta(days=10))
+
+    #the aggregates still count the deleted readings, a rebuild would lose them
+    with pytest.raises(ValueError):
+        sql_repo.rebuild_aggregates()
+    with Session(engine) as session:
+        assert session.get(SensorAggregate, 1).entry_count == 240
+        assert session.get(RollupWatermark, "expired").watermark == datetime(2024, 3, 6)
+
@@ -0,0 +1,153 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlmodel import SQLModel, create_engine, Session, select
+from sqlalchemy import event
+from src.orm import *
+from src.rollups import pick_resolution, MINUTE, HOUR, DAY
+from src.repository.sqlmodel_repository import SQLModel_repository
+from src.spool import Spool
+
+@pytest.fixture(name="engine")
+def fixture_engine():
+    engine = create_engine("sqlite:///:memory:")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+@pytest.fixture(name="sql_repo")
+def fixture_repo(engine):
+    return SQLModel_repository(engine)
+
+@pytest.fixture
+def start():
+    return datetime(2024, 3, 1, 10, 0, tzinfo=timezone.utc)
+
+@pytest.fixture
+def entries(start):
+    #two readings per minute over two hours for a regular sensor, one per minute for a plant sensor
+    entries = []
+    for minute in range(120):
+        timestamp = start + timedelta(minutes=minute)
+        entries.append(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 20, humidity = 0.4))
+        entries.append(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(seconds=30), temperature = 22, humidity = 0.6))
+        entries.append(PlantSensorEntry(sensor_id = 2, entry_timestamp = timestamp, temperature = minute, humidity = 0.5, wetness = 0.3))
+    return entries
+
+def test_compact_rollups(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    watermarks = sql_repo.compact_rollups(now = start + timedelta(days=1, hours=1))
+
+    assert watermarks["1m"] == datetime(2024, 3, 2, 10, 59)
+    assert watermarks["1h"] == datetime(2024, 3, 2, 10)
+    assert watermarks["1d"] == datetime(2024, 3, 2)
+
+    with Session(engine) as session:
+        minutes = session.exec(select(MinuteRollup).where(MinuteRollup.sensor_id == 1)).all()
+        hours = session.exec(select(HourRollup).order_by(HourRollup.sensor_id, HourRollup.bucket)).all()
+        day = session.exec(select(DayRollup).where(DayRollup.sensor_id == 2)).one()
+
+    assert len(minutes) == 120
+    assert minutes[0].entry_count == 2 and minutes[0].temperature_avg == pytest.approx(21) and minutes[0].wetness_avg is None
+    assert [hour.entry_count for hour in hours] == [120, 120, 60, 60]
+    assert hours[2].plant_sensor and hours[2].temperature_avg == pytest.approx(29.5) and hours[2].wetness_max == pytest.approx(0.3)
+    assert day.entry_count == 120 and day.temperature_min == 0 and day.temperature_max == 119
+
+def test_compaction_is_incremental(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries[:90])
+    #only the first 30 minutes are closed
+    sql_repo.compact_rollups(now = start + timedelta(minutes=31))
+    sql_repo.add_data_entries(entries[90:])
+    sql_repo.compact_rollups(now = start + timedelta(hours=3))
+    sql_repo.compact_rollups(now = start + timedelta(hours=3))
+
+    with Session(engine) as session:
+        minutes = session.exec(select(MinuteRollup).where(MinuteRollup.sensor_id == 1)).all()
+    assert len(minutes) == 120 and sum(minute.entry_count for minute in minutes) == 240
+
+def test_get_rollup_picks_resolution(sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(hours=3))
+
+    resolution, rows = sql_repo.get_rollup(1, start, start + timedelta(hours=2), 2)
+    assert resolution == "1h" and len(rows) == 2
+    resolution, rows = sql_repo.get_rollup(1, start, start + timedelta(hours=2), 60)
+    assert resolution == "1m" and len(rows) == 120
+
+def rollup_rows(engine):
+    with Session(engine) as session:
+        return {resolution.name: [row.model_dump() for row in session.exec(select(resolution.table).order_by(
+                    resolution.table.sensor_id, resolution.table.plant_sensor, resolution.table.bucket)).all()]
+                for resolution in (MINUTE, HOUR, DAY)}
+
+def test_spooled_reading_older_than_the_watermark_is_merged(engine, sql_repo, entries, start, tmp_path):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(days=1, hours=1))
+
+    #readings spooled while the database was down are replayed after their buckets were compacted
+    late = [HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=5, seconds=15), temperature = 30, humidity = 0.5),
+            PlantSensorEntry(sensor_id = 2, entry_timestamp = start + timedelta(minutes=5, seconds=45), temperature = 5, humidity = 0.5, wetness = 0.6)]
+    spool = Spool(str(tmp_path))
+    spool.append(late)
+
+    async def write(sensor_entries):
+        return sql_repo.add_data_entries(sensor_entries)
+
+    assert asyncio.run(spool.replay(write)) == 2
+    #the insert only queues them, the next compaction merges the queue
+    with Session(engine) as session:
+        assert len(session.exec(select(LateEntry).where(LateEntry.rollup == MINUTE.name)).all()) == 2
+    sql_repo.compact_rollups(now = start + timedelta(days=1, hours=1))
+
+    with Session(engine) as session:
+        assert session.exec(select(LateEntry).where(LateEntry.rollup == MINUTE.name)).all() == []
+        minute = session.get(MinuteRollup, (1, False, datetime(2024, 3, 1, 10, 5)))
+        plant_minute = session.get(MinuteRollup, (2, True, datetime(2024, 3, 1, 10, 5)))
+        hour = session.get(HourRollup, (1, False, datetime(2024, 3, 1, 10)))
+        day = session.get(DayRollup, (1, False, datetime(2024, 3, 1)))
+    assert minute.entry_count == 3 and minute.temperature_avg == pytest.approx(24) and minute.temperature_max == 30
+    assert plant_minute.entry_count == 2 and plant_minute.wetness_avg == pytest.approx(0.45) and plant_minute.wetness_max == 0.6
+    assert hour.entry_count == 121 and day.entry_count == 241
+
+    #same rollups as if the readings had arrived on time
+    on_time = create_engine("sqlite:///:memory:")
+    SQLModel.metadata.create_all(on_time)
+    SQLModel_repository(on_time).add_data_entries(entries + late)
+    SQLModel_repository(on_time).compact_rollups(now = start + timedelta(days=1, hours=1))
+    merged, expected = rollup_rows(engine), rollup_rows(on_time)
+    for name in expected:
+        assert len(merged[name]) == len(expected[name])
+        for row, expected_row in zip(merged[name], expected[name]):
+            assert row == pytest.approx(expected_row)
+
+def test_late_entries_are_queued_without_reading_the_watermarks(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries)
+    sql_repo.compact_rollups(now = start + timedelta(hours=3))
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    sql_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=5, seconds=15),
+                                                        temperature = 30, humidity = 0.5)])
+    assert not [statement for statement in statements if "rollup_watermark" in statement]
+    assert any("INSERT INTO late_entry" in statement for statement in statements)
+
+def test_queued_entries_of_open_buckets_wait_for_their_step(engine, sql_repo, entries, start):
+    sql_repo.add_data_entries(entries[:90])
+    sql_repo.compact_rollups(now = start + timedelta(minutes=31))
+    #an entry still in the grace period of the compaction is queued as it may arrive after the compaction ran,
+    #the step compacting its minute consumes it without counting it twice
+    sql_repo.add_data_entries(entries[90:])
+    sql_repo.compact_rollups(now = start + timedelta(hours=3))
+
+    with Session(engine) as session:
+        assert session.exec(select(LateEntry).where(LateEntry.rollup == MINUTE.name)).all() == []
+        minutes = session.exec(select(MinuteRollup).where(MinuteRollup.sensor_id == 1)).all()
+    assert sum(minute.entry_count for minute in minutes) == 240
+
+@pytest.mark.parametrize("span, points, expected", [
+    (timedelta(days=365), 300, DAY),
+    (timedelta(days=30), 300, HOUR),
+    (timedelta(days=1), 300, MINUTE),
+    (timedelta(minutes=10), 300, MINUTE),
+])
+def test_pick_resolution(start, span, points, expected):
+    assert pick_resolution(start, start + span, points) is expected
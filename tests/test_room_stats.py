@@ -0,0 +1,122 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlmodel import SQLModel, create_engine, Session, select, func
+from src.models import SensorIn
+from src.orm import *
+from src.room_stats import ROOM_ROLLUP, refresh_room_rollup
+from src.retention import RetentionEngine, parse_retention
+from src.repository.sqlmodel_repository import SQLModel_repository
+
+
+@pytest.fixture(name="engine")
+def fixture_engine():
+    engine = create_engine("sqlite:///:memory:")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+@pytest.fixture(name="sql_repo")
+def fixture_repo(engine):
+    repo = SQLModel_repository(engine)
+    repo.provision_sensors([SensorIn(serial_number = 1, room = "bedroom"), SensorIn(serial_number = 2, room = "Bedroom", plant = "pothos"),
+                            SensorIn(serial_number = 3, room = "kitchen")])
+    repo.add_sensor(Sensor(serial_number = 4))
+    return repo
+
+@pytest.fixture
+def start():
+    return datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+def readings(start, minutes, temperature):
+    #a regular sensor in the bedroom, a plant sensor in the bedroom, a kitchen sensor and a sensor without room
+    return [entry for minute in range(minutes) for entry in (
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=minute), temperature = temperature, humidity = 0.5),
+        PlantSensorEntry(sensor_id = 2, entry_timestamp = start + timedelta(minutes=minute), temperature = temperature + 2, humidity = 0.7,
+                         wetness = 0.3),
+        HumidityTemperatureEntry(sensor_id = 3, entry_timestamp = start + timedelta(minutes=minute), temperature = 25, humidity = 0.4),
+        HumidityTemperatureEntry(sensor_id = 4, entry_timestamp = start + timedelta(minutes=minute), temperature = 0, humidity = 0.1),
+    )]
+
+def test_view_resolves_both_tables_to_their_room(engine, sql_repo, start):
+    sql_repo.add_data_entries(readings(start, 2, 20))
+    with Session(engine) as session:
+        rows = session.exec(select(room_measurement.c.room_id, room_measurement.c.sensor_id, room_measurement.c.plant_sensor)
+                            .order_by(room_measurement.c.sensor_id)).all()
+        rooms = dict(session.exec(select(Room.name, Room.id)).all())
+    assert sorted(set(rows)) == [(rooms["bedroom"], 1, False), (rooms["bedroom"], 2, True), (rooms["kitchen"], 3, False)]
+
+def test_room_stats_cover_plant_sensors(sql_repo, start):
+    sql_repo.add_data_entries(readings(start, 90, 20))
+    watermarks = sql_repo.compact_rollups(now = start + timedelta(hours=2))
+    assert watermarks[ROOM_ROLLUP] == datetime(2024, 3, 1, 1, 59)
+
+    stats = {row.room: row for row in sql_repo.get_room_stats()}
+    assert set(stats) == {"bedroom", "kitchen"}
+    assert stats["bedroom"].entry_count == 180
+    assert stats["bedroom"].temperature_avg == 21 and stats["bedroom"].temperature_max == 22
+    assert stats["bedroom"].humidity_min == 0.5 and stats["bedroom"].humidity_max == 0.7
+    assert stats["bedroom"].last_timestamp == datetime(2024, 3, 1, 1, 29)
+
+    #rooms are matched case insensitively, the range is rounded down to the hour
+    rows = sql_repo.get_room_stats(Room(name = "BEDROOM"), start + timedelta(hours=1, minutes=10))
+    assert len(rows) == 1 and rows[0].entry_count == 60
+
+def test_refresh_is_incremental(engine, sql_repo, start):
+    sql_repo.add_data_entries(readings(start, 30, 20))
+    sql_repo.compact_rollups(now = start + timedelta(minutes=20))
+    assert sql_repo.get_room_stats(Room(name = "kitchen"))[0].entry_count == 19
+
+    #the rest of the hour is added to the same bucket
+    sql_repo.add_data_entries(readings(start + timedelta(minutes=30), 30, 30))
+    sql_repo.compact_rollups(now = start + timedelta(hours=1, minutes=1))
+    with Session(engine) as session:
+        buckets = session.exec(select(RoomRollup).order_by(RoomRollup.room_id)).all()
+    assert [bucket.entry_count for bucket in buckets] == [120, 60]
+    bedroom = sql_repo.get_room_stats(Room(name = "bedroom"))[0]
+    assert bedroom.temperature_min == 20 and bedroom.temperature_max == 32 and bedroom.temperature_avg == 26
+
+def test_late_reading_is_merged_into_the_room_rollup(sql_repo, start):
+    sql_repo.add_data_entries(readings(start, 60, 20))
+    sql_repo.compact_rollups(now = start + timedelta(hours=2))
+    #older than the watermark, queued by the insert and added to its bucket by the next refresh
+    sql_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 3, entry_timestamp = start + timedelta(minutes=10, seconds=30),
+                                                     temperature = 86, humidity = 0.4))
+    sql_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 4, entry_timestamp = start + timedelta(minutes=10, seconds=30),
+                                                     temperature = 0, humidity = 0.4))
+    assert sql_repo.get_room_stats(Room(name = "kitchen"))[0].entry_count == 60
+    sql_repo.compact_rollups(now = start + timedelta(hours=2))
+    kitchen = sql_repo.get_room_stats(Room(name = "kitchen"))[0]
+    assert kitchen.entry_count == 61 and kitchen.temperature_avg == 26 and kitchen.temperature_max == 86
+    assert kitchen.last_timestamp == datetime(2024, 3, 1, 0, 59)
+    #merged once, the next refresh does not count it again
+    sql_repo.compact_rollups(now = start + timedelta(hours=3))
+    assert sql_repo.get_room_stats(Room(name = "kitchen"))[0].entry_count == 61
+
+def test_queued_entries_of_the_refreshed_range_are_counted_once(engine, sql_repo, start):
+    sql_repo.add_data_entries(readings(start, 30, 20))
+    sql_repo.compact_rollups(now = start + timedelta(minutes=31))
+    #older than the grace period by the clock, queued although no refresh read their minutes yet,
+    #the steps reading them consume their queue rows
+    sql_repo.add_data_entries(readings(start + timedelta(minutes=30), 30, 20))
+    with Session(engine) as session:
+        assert session.exec(select(func.count()).select_from(LateEntry).where(LateEntry.rollup == ROOM_ROLLUP)).one() == 120
+    sql_repo.compact_rollups(now = start + timedelta(hours=2))
+    with Session(engine) as session:
+        assert session.exec(select(LateEntry)).all() == []
+    assert sql_repo.get_room_stats(Room(name = "kitchen"))[0].entry_count == 60
+
+def test_refresh_without_rooms_moves_the_watermark(engine, start):
+    with Session(engine) as session:
+        assert refresh_room_rollup(session, "sqlite", now = start) == datetime(2024, 2, 29, 23, 59)
+        assert session.exec(select(func.count()).select_from(RoomRollup)).one() == 0
+
+def test_retention_waits_for_the_room_rollup(engine, sql_repo, start):
+    sql_repo.add_data_entries(readings(start, 60, 20))
+    sql_repo.compact_rollups(now = start + timedelta(hours=2))
+    #the room rollup is behind the minute rollup
+    with Session(engine) as session:
+        session.merge(RollupWatermark(resolution = ROOM_ROLLUP, watermark = datetime(2024, 3, 1, 0, 30)))
+        session.commit()
+    retention = RetentionEngine(parse_retention("raw=1h"))
+    with engine.connect() as connection:
+        result = retention.run(connection, now = start + timedelta(days=1))
+    assert result["humidity_temperature_entry"]["deleted_rows"] == 3 * 30
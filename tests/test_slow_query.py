@@ -0,0 +1,50 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+from src.slow_query import SlowQueryLog, RequestScopeMiddleware, parameters_shape
+
+
+def test_parameters_shape():
+    assert parameters_shape({"sensor_id": 1, "name": "kitchen"}) == {"sensor_id": "int", "name": "str"}
+    assert parameters_shape((1, 2.5)) == ["int", "float"]
+    assert parameters_shape(tuple(range(12)))[-1] == "... 12 parameters"
+    assert parameters_shape([(1,), (2,)], executemany = True) == {"rows": 2, "row": ["int"]}
+
+def test_keeps_the_slowest_statements():
+    slow_query_log = SlowQueryLog(threshold_ms = 0, size = 2, worst_size = 2)
+    for statement, duration in (("a", 0.3), ("b", 0.1), ("a", 0.2), ("c", 0.2)):
+        slow_query_log.record(statement, (), False, duration)
+    assert [entry["statement"] for entry in slow_query_log.entries()] == ["c", "a"]
+    assert [entry["statement"] for entry in slow_query_log.worst()] == ["a", "c"]
+    assert slow_query_log.worst()[0]["duration_ms"] == 300
+    assert slow_query_log.slow_statements == 4
+
+def test_statements_are_attributed_to_the_route():
+    slow_query_log = SlowQueryLog(threshold_ms = 0)
+    engine = create_engine("sqlite://", connect_args = {"check_same_thread": False}, poolclass = StaticPool)
+    slow_query_log.instrument_engine(engine)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE room (id INTEGER PRIMARY KEY, name TEXT)"))
+
+    app = FastAPI()
+    app.add_middleware(RequestScopeMiddleware)
+
+    @app.get("/room/{room_id}")
+    def get_room(room_id: int):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT name FROM room WHERE id = :id"), {"id": room_id})
+        return {}
+
+    TestClient(app).get("/room/1")
+    entries = slow_query_log.entries()
+    assert entries[0]["route"] == "GET /room/{room_id}" and entries[0]["parameters"] == ["int"]
+    assert entries[-1]["route"] == "background"
+
+    with engine.connect() as connection:
+        explained = {entry["statement"]: entry["plan"] for entry in slow_query_log.explain(connection)}
+    assert "SEARCH room USING INTEGER PRIMARY KEY" in explained["SELECT name FROM room WHERE id = ?"]
+    #only select statements are explained
+    assert explained["CREATE TABLE room (id INTEGER PRIMARY KEY, name TEXT)"] is None
+    #the plans are not logged as slow statements
+    assert not any(entry["statement"].startswith("EXPLAIN") for entry in slow_query_log.entries())
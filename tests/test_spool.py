@@ -0,0 +1,68 @@
+import asyncio
+import os
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.exc import OperationalError
+from src.orm import *
+from src.spool import Spool, FSYNC_SEGMENT
+
+
+def make_entries(number, start = 0):
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    entries = [HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(seconds=i),
+                                        temperature = 20, humidity = 0.5) for i in range(start, start + number)]
+    entries.append(PlantSensorEntry(sensor_id = 2, entry_timestamp = timestamp, temperature = 21, humidity = 0.4, wetness = 0.3))
+    return entries
+
+def test_append_and_read(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(make_entries(2))
+    spool.append(make_entries(2, start = 2))
+    assert spool.segments() == []
+    spool.seal()
+    [segment] = spool.segments()
+    entries = spool.read(segment)
+    assert len(entries) == 6
+    assert isinstance(entries[2], PlantSensorEntry) and entries[2].wetness == 0.3
+    assert entries[3].entry_timestamp == datetime(2024, 3, 1, 0, 0, 2)
+
+def test_segments_rotate_and_survive_restart(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes = 100, fsync = FSYNC_SEGMENT)
+    for i in range(3):
+        spool.append(make_entries(2, start = 2 * i))
+    assert len(spool.segments()) == 3
+    spool.close()
+    #a new spool on the same directory keeps the segments and numbers the next ones after them
+    spool = Spool(str(tmp_path), segment_bytes = 100)
+    spool.append(make_entries(1))
+    spool.seal()
+    assert len(spool.segments()) == 4 and spool.segments()[-1].endswith("000000000004.seg")
+
+def test_torn_record_ends_segment(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(make_entries(1))
+    spool.append(make_entries(1, start = 1))
+    spool.seal()
+    [segment] = spool.segments()
+    os.truncate(segment, os.path.getsize(segment) - 5)
+    assert len(spool.read(segment)) == 2
+
+def test_replay(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(make_entries(4))
+    written = []
+
+    async def unavailable(entries):
+        raise OperationalError("INSERT", {}, Exception("connection refused"))
+
+    async def write(entries):
+        written.append(len(entries))
+        return []
+
+    with pytest.raises(OperationalError):
+        asyncio.run(spool.replay(unavailable))
+    assert len(spool.segments()) == 1 and spool.last_error is not None
+
+    assert asyncio.run(spool.replay(write, batch_size = 2)) == 5
+    assert written == [2, 2, 1]
+    assert spool.segments() == [] and spool.replayed_rows == 5 and spool.last_error is None
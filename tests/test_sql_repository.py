@@ -1,9 +1,15 @@
 import pytest
 from sqlmodel import SQLModel, create_engine, Session, text
 from src.models import *
+from src.orm import *
 from src.repository.sqlmodel_repository import SQLModel_repository
 import psycopg2
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta, timezone
+import json
+from src.export import format_chunks
+from src.history import entry_cursor, format_cursor, parse_cursor
 
 @pytest.fixture(name="engine")
 def fixture_engine():
@@ -67,4 +73,249 @@ def test_add_existing_room_raises_error(sql_repo, plant_name):
     with pytest.raises(IntegrityError):
         sql_repo.add_plant(Plant(name= plant_name))
 
-        
\ No newline at end of file
+        
+@pytest.fixture
+def batch_entries():
+    timestamp = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+    return [
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 20.5, humidity = 0.5),
+        PlantSensorEntry(sensor_id = 2, entry_timestamp = timestamp, temperature = 21.5, humidity = 0.4, wetness = 0.3),
+        HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp + timedelta(minutes=1), temperature = 22.5, humidity = 0.5),
+    ]
+
+def test_add_data_entries(engine, sql_repo, batch_entries):
+    results = sql_repo.add_data_entries(batch_entries)
+    assert [result.status for result in results] == [ENTRY_CREATED] * 3
+    assert [result.index for result in results] == [0, 1, 2]
+    with Session(engine) as session:
+        assert session.exec(text('SELECT COUNT(*) FROM humidity_temperature_entry')).one()[0] == 2
+        assert session.exec(text('SELECT COUNT(*) FROM plant_sensor_entry')).one()[0] == 1
+
+def test_add_data_entries_reports_duplicates(engine, sql_repo, batch_entries):
+    sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+    sql_repo.add_data_entries(batch_entries[:1])
+    results = sql_repo.add_data_entries(batch_entries + batch_entries[2:])
+    assert [result.status for result in results] == [ENTRY_DUPLICATE, ENTRY_CREATED, ENTRY_CREATED, ENTRY_DUPLICATE]
+    assert results[0].detail is not None
+    #duplicates are not counted twice in the aggregates
+    assert sql_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(21.5)
+    with Session(engine) as session:
+        assert session.exec(text('SELECT COUNT(*) FROM humidity_temperature_entry')).one()[0] == 2
+        assert session.exec(text('SELECT COUNT(*) FROM plant_sensor_entry')).one()[0] == 1
+
+def test_provision_sensor_creates_room(engine, sql_repo):
+    sensor = sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "Bedroom"))
+    room = sql_repo.get_room(Room(name = "bedroom"))
+    assert isinstance(sensor, Sensor) and sensor.room_id == room.id and room.name == "Bedroom"
+    assert sql_repo.get_sensor(Sensor(serial_number = 1)).room_id == room.id
+
+def test_provision_sensor_reuses_room_and_plant(engine, sql_repo):
+    room = sql_repo.add_room(Room(name = "bedroom"))
+    first = sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "BEDROOM", plant = "Pothos"))
+    second = sql_repo.provision_sensor(SensorIn(serial_number = 2, room = "bedroom", plant = "pothos"))
+    plant = sql_repo.get_plant(Plant(name = "POTHOS"))
+    assert isinstance(first, PlantSensor) and first.plant_id == second.plant_id == plant.id
+    assert plant.name == "pothos" and plant.room_id == room.id
+    with Session(engine) as session:
+        assert session.exec(text('SELECT COUNT(*) FROM room')).one()[0] == 1
+
+def test_provision_sensor_race_on_room_name_case(engine, sql_repo):
+    #"Bedroom" is created by another request between the lookup and the insert of "bedroom"
+    created = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def create_concurrently(connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO room") and not created:
+            created.append(True)
+            cursor.execute("INSERT INTO room (name) VALUES ('Bedroom')")
+
+    sensor = sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+    assert sensor.room_id == sql_repo.get_room(Room(name = "BEDROOM")).id
+    with Session(engine) as session:
+        assert session.exec(text('SELECT COUNT(*) FROM room')).one()[0] == 1
+
+def test_provision_existing_sensor_raises(sql_repo):
+    sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+    with pytest.raises(IntegrityError):
+        sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "kitchen"))
+    #the transaction was rolled back, the new room must not exist
+    assert sql_repo.get_room(Room(name = "kitchen")) is None
+
+def test_provision_sensors(engine, sql_repo):
+    sql_repo.add_room(Room(name = "Bedroom"))
+    sql_repo.provision_sensor(SensorIn(serial_number = 3, room = "kitchen"))
+    sensors = [
+        SensorIn(serial_number = 1, room = "bedroom"),
+        SensorIn(serial_number = 2, room = "Office", plant = "Pothos"),
+        SensorIn(serial_number = 3, room = "office"),
+        SensorIn(serial_number = 4, room = "OFFICE", plant = "pothos"),
+        SensorIn(serial_number = 4, room = "office"),
+    ]
+    results = sql_repo.provision_sensors(sensors)
+    assert [result.status for result in results] == [ENTRY_CREATED, ENTRY_CREATED, ENTRY_FAILED, ENTRY_CREATED, ENTRY_FAILED]
+    with Session(engine) as session:
+        assert session.exec(text('SELECT COUNT(*) FROM room')).one()[0] == 3
+        assert session.exec(text('SELECT COUNT(*) FROM plant')).one()[0] == 1
+        assert session.exec(text('SELECT COUNT(*) FROM plant_sensor')).one()[0] == 2
+    assert sql_repo.get_sensor(Sensor(serial_number = 1)).room_id == sql_repo.get_room(Room(name = "bedroom")).id
+
+def test_average_temperature_from_aggregates(engine, sql_repo, batch_entries):
+    sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "Bedroom"))
+    sql_repo.provision_sensor(SensorIn(serial_number = 3, room = "kitchen"))
+    sql_repo.add_data_entries(batch_entries)
+    sql_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 3, entry_timestamp = datetime(2024, 3, 2, tzinfo=timezone.utc),
+                                                     temperature = 30, humidity = 0.5))
+    assert sql_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(21.5)
+    assert sql_repo.get_average_temperature(Room(name = "kitchen")) == pytest.approx(30)
+    assert sql_repo.get_average_temperature() == pytest.approx((20.5 + 22.5 + 30) / 3)
+    assert sql_repo.get_average_temperature(Room(name = "attic")) is None
+    with Session(engine) as session:
+        aggregate = session.get(SensorAggregate, 1)
+    assert aggregate.entry_count == 2 and aggregate.temperature_min == 20.5 and aggregate.temperature_max == 22.5
+
+def test_room_aggregates_of_several_sensors_in_one_statement(engine, sql_repo):
+    sql_repo.provision_sensors([SensorIn(serial_number = 1, room = "bedroom"), SensorIn(serial_number = 2, room = "bedroom"),
+                                SensorIn(serial_number = 3, room = "kitchen")])
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    sql_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = sensor_id, entry_timestamp = timestamp, temperature = temperature,
+                                                        humidity = 0.5)
+                               for sensor_id, temperature in ((2, 24), (1, 18), (3, 30), (4, 10))])
+    #the rooms are resolved by the room aggregate upsert, no lookup of their own
+    assert sum("room_aggregate" in statement for statement in statements) == 1
+    assert not any(statement.lstrip().startswith("SELECT") for statement in statements)
+    assert sql_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(21)
+    assert sql_repo.get_average_temperature(Room(name = "kitchen")) == pytest.approx(30)
+    with Session(engine) as session:
+        bedroom = session.get(RoomAggregate, sql_repo.get_room(Room(name = "bedroom")).id)
+    assert bedroom.entry_count == 2 and bedroom.temperature_min == 18 and bedroom.temperature_max == 24
+
+def enforce_foreign_keys(engine):
+    #sqlite only checks the foreign keys when asked to, on every connection
+    @event.listens_for(engine, "connect")
+    def foreign_keys_on(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+def test_add_data_entries_falls_back_to_savepoints(batch_entries):
+    engine = create_engine("sqlite:///:memory:")
+    enforce_foreign_keys(engine)
+    SQLModel.metadata.create_all(engine)
+    sql_repo = SQLModel_repository(engine)
+    sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+
+    #the unknown sensor rejects the batch insert, the rows are replayed one by one
+    unknown = HumidityTemperatureEntry(sensor_id = 99, entry_timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc),
+                                       temperature = 50, humidity = 0.5)
+    results = sql_repo.add_data_entries([batch_entries[0], unknown, batch_entries[2]])
+    assert [result.status for result in results] == [ENTRY_CREATED, ENTRY_FAILED, ENTRY_CREATED]
+    assert "FOREIGN KEY" in results[1].detail
+    assert sql_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(21.5)
+    assert sql_repo.get_average_temperature() == pytest.approx(21.5)
+    with Session(engine) as session:
+        assert session.exec(text('SELECT COUNT(*) FROM humidity_temperature_entry')).one()[0] == 2
+
+def test_failed_entries_are_not_aggregated(sql_repo, batch_entries):
+    sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+    sql_repo.add_data_entries(batch_entries[:1])
+    sql_repo.add_data_entries(batch_entries)
+    assert sql_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(21.5)
+
+def test_rebuild_aggregates(engine, sql_repo):
+    sql_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+    with Session(engine) as session:
+        #rows written behind the repository back are not in the aggregates until they are rebuilt
+        session.exec(text("INSERT INTO humidity_temperature_entry VALUES (1, '2024-03-01 00:00:00', 10, 0.5), (1, '2024-03-01 00:01:00', 20, 0.5)"))
+        session.commit()
+    assert sql_repo.get_average_temperature() is None
+    sql_repo.rebuild_aggregates()
+    assert sql_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(15)
+    with Session(engine) as session:
+        assert session.get(RoomAggregate, sql_repo.get_room(Room(name = "bedroom")).id).entry_count == 2
+
+def test_get_measurements_pages_with_cursor(sql_repo):
+    start = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    sql_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=i),
+                                                        temperature = i, humidity = 0.5) for i in range(25)] +
+                              [HumidityTemperatureEntry(sensor_id = 2, entry_timestamp = start, temperature = 50, humidity = 0.5)])
+    pages = []
+    after = None
+    while True:
+        page = sql_repo.get_measurements(1, after = after, limit = 10)
+        pages.append(page)
+        if len(page) < 10:
+            break
+        after = page[-1].entry_timestamp
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [entry.temperature for page in pages for entry in page] == list(range(25))
+
+def test_get_measurements_cursor_splits_equal_timestamps(sql_repo):
+    start = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    #serial number 1 is both a regular and a plant sensor, every reading has a twin at the same timestamp
+    sql_repo.add_data_entries([HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=i),
+                                                        temperature = i, humidity = 0.5) for i in range(5)] +
+                              [PlantSensorEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=i),
+                                                temperature = i, humidity = 0.5, wetness = 0.2) for i in range(5)])
+    pages = []
+    after = None
+    while True:
+        page = sql_repo.get_measurements(1, after = after, limit = 3)
+        pages.append(page)
+        if len(page) < 3:
+            break
+        #the cursor goes through its string form, as it does through the api
+        after = parse_cursor(format_cursor(entry_cursor(page[-1])))
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    #the first page ends between the two readings of minute 1
+    assert isinstance(pages[0][-1], HumidityTemperatureEntry) and isinstance(pages[1][0], PlantSensorEntry)
+    assert [(entry.temperature, isinstance(entry, PlantSensorEntry)) for page in pages for entry in page] == \
+           [(i, plant) for i in range(5) for plant in (False, True)]
+
+def test_parse_cursor():
+    assert parse_cursor("2024-03-01T00:01:00,1,7") == (datetime(2024, 3, 1, 0, 1), True, 7)
+    assert parse_cursor("2024-03-01T00:01:00+00:00") == datetime(2024, 3, 1, 0, 1, tzinfo=timezone.utc)
+    for cursor in ("yesterday", "2024-03-01T00:01:00,2,7", "2024-03-01T00:01:00,1"):
+        with pytest.raises(ValueError):
+            parse_cursor(cursor)
+
+def test_get_measurements_time_range(sql_repo):
+    start = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    sql_repo.add_data_entries([PlantSensorEntry(sensor_id = 1, entry_timestamp = start + timedelta(minutes=i),
+                                                temperature = i, humidity = 0.5, wetness = 0.2) for i in range(10)])
+    entries = sql_repo.get_measurements(1, start = start + timedelta(minutes=2), end = start + timedelta(minutes=5))
+    assert [entry.temperature for entry in entries] == [2, 3, 4] and entries[0].wetness == 0.2
+
+def test_stream_measurements(sql_repo, batch_entries):
+    sql_repo.add_data_entries(batch_entries)
+    chunks = list(sql_repo.stream_measurements(chunk_size = 2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    rows = [row for chunk in chunks for row in chunk]
+    assert sorted(row[0] for row in rows) == ["plant_sensor", "sensor", "sensor"]
+    assert len(list(sql_repo.stream_measurements(sensor_id = 2))[0]) == 1
+
+def test_export_formats(sql_repo, batch_entries):
+    sql_repo.add_data_entries(batch_entries)
+    csv_export = "".join(format_chunks(sql_repo.stream_measurements(), "csv")).splitlines()
+    assert csv_export[0] == "sensor_type,sensor_id,entry_timestamp,temperature,humidity,wetness" and len(csv_export) == 4
+    ndjson_export = "".join(format_chunks(sql_repo.stream_measurements(sensor_id = 2), "ndjson")).splitlines()
+    assert json.loads(ndjson_export[0])["wetness"] == 0.3
+
+def test_lean_add_data_entry(engine):
+    lean_repo = SQLModel_repository(engine, lean_writes = True)
+    lean_repo.provision_sensor(SensorIn(serial_number = 1, room = "bedroom"))
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    entry = lean_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 19, humidity = 0.5))
+    lean_repo.add_data_entry(PlantSensorEntry(sensor_id = 2, entry_timestamp = timestamp, temperature = 20, humidity = 0.5, wetness = 0.1))
+    assert entry.sensor_id == 1
+    assert lean_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(19)
+    assert len(lean_repo.get_measurements(2)) == 1
+    assert lean_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 25, humidity = 0.5)) is None
+    assert lean_repo.get_average_temperature(Room(name = "bedroom")) == pytest.approx(19)
+
+def test_add_data_entry_skips_duplicate(engine, sql_repo):
+    timestamp = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    entry = sql_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 19, humidity = 0.5))
+    assert entry.sensor_id == 1 and entry.temperature == 19
+    assert sql_repo.add_data_entry(HumidityTemperatureEntry(sensor_id = 1, entry_timestamp = timestamp, temperature = 19, humidity = 0.5)) is None
+    with Session(engine) as session:
+        assert session.exec(text('SELECT entry_count FROM sensor_aggregate')).one()[0] == 1
@@ -0,0 +1,58 @@
+import asyncio
+import json
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.testclient import TestClient
+from src.models import EntryResult, ENTRY_CREATED, ENTRY_DUPLICATE
+from src.stream_ingest import MeasurementStream, receive_frame
+
+
+def measurement(sensor_id = 1, timestamp = 1700000000, temperature = 20):
+    return {"sensor_id": sensor_id, "entry_timestamp": timestamp, "temperature": temperature, "humidity": 0.5}
+
+async def write(entries):
+    #the second reading of every batch is reported as already recorded
+    return [EntryResult(index = index, sensor_id = entry.sensor_id, status = ENTRY_DUPLICATE if index == 1 else ENTRY_CREATED)
+            for index, entry in enumerate(entries)]
+
+def test_stream_batches_and_acks():
+    stream = MeasurementStream(flush_rows = 3, flush_interval_ms = 60000)
+    stream.receive(json.dumps([measurement(), measurement(timestamp = 1700000001)]))
+    assert not stream.due() and stream.timeout() > 0
+    stream.receive(json.dumps(measurement(temperature = 500)))
+    stream.receive(json.dumps(measurement(timestamp = 1700000002)))
+    assert stream.due()
+
+    ack = asyncio.run(stream.flush(write))
+    assert ack["ack"] == 4 and ack["created"] == 2 and ack["duplicate"] == 1
+    assert [failure["seq"] for failure in ack["failed"]] == [3]
+    assert stream.pending == [] and stream.timeout() is None
+
+def test_invalid_frames_are_acked_right_away():
+    stream = MeasurementStream(flush_rows = 100, flush_interval_ms = 60000)
+    stream.receive("not json")
+    assert stream.due()
+    ack = asyncio.run(stream.flush(write))
+    assert ack == {"ack": 1, "created": 0, "duplicate": 0, "spooled": 0, "failed": [{"seq": 1, "detail": "frame is not valid json"}]}
+    assert not stream.due()
+
+def test_binary_frame_is_rejected_and_the_connection_stays_open():
+    app = FastAPI()
+
+    @app.websocket("/ws")
+    async def stream_endpoint(websocket: WebSocket):
+        await websocket.accept()
+        stream = MeasurementStream(flush_rows = 1, flush_interval_ms = 60000)
+        try:
+            while True:
+                await receive_frame(websocket, stream)
+                if stream.due():
+                    await websocket.send_json(await stream.flush(write))
+        except WebSocketDisconnect:
+            pass
+
+    with TestClient(app).websocket_connect("/ws") as websocket:
+        websocket.send_bytes(b"\x01\x02")
+        ack = websocket.receive_json()
+        assert ack["ack"] == 1 and ack["created"] == 0 and [failure["seq"] for failure in ack["failed"]] == [1]
+        websocket.send_text(json.dumps(measurement()))
+        assert websocket.receive_json() == {"ack": 2, "created": 1, "duplicate": 0, "spooled": 0, "failed": []}
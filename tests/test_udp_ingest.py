@@ -0,0 +1,45 @@
+import asyncio
+import json
+import pytest
+from sqlmodel import SQLModel, create_engine, Session, text
+from sqlalchemy.pool import StaticPool
+from src.orm import *
+from src.binary_frame import encode_frame
+from src.ingest_buffer import IngestBuffer
+from src.udp_ingest import UDPIngestProtocol
+from src.repository.sqlmodel_repository import SQLModel_repository
+
+@pytest.fixture(name="engine")
+def fixture_engine():
+    #the buffer writes from a worker thread, all threads must share the same in memory database
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+@pytest.fixture(name="sql_repo")
+def fixture_repo(engine):
+    return SQLModel_repository(engine)
+
+def measurement(sensor_id, temperature = 20):
+    return {"sensor_id": sensor_id, "entry_timestamp": 1700000000, "temperature": temperature, "humidity": 0.5}
+
+def test_datagrams_are_counted_and_written(engine, sql_repo):
+    recorded = []
+
+    async def scenario():
+        buffer = IngestBuffer(sql_repo, flush_rows = 100, flush_interval_ms = 10, on_flushed = recorded.extend)
+        buffer.start()
+        protocol = UDPIngestProtocol(buffer, lambda address: address.startswith("192.168."))
+        protocol.datagram_received(json.dumps(measurement(1)).encode(), ("192.168.0.10", 5000))
+        protocol.datagram_received(json.dumps([measurement(2), measurement(3, temperature = 99)]).encode(), ("192.168.0.10", 5000))
+        protocol.datagram_received(encode_frame([(4, 1700000000, 21, 0.5, None)]), ("192.168.0.11", 5000))
+        protocol.datagram_received(b"not a measurement", ("192.168.0.10", 5000))
+        protocol.datagram_received(json.dumps(measurement(5)).encode(), ("10.0.0.1", 5000))
+        await buffer.stop()
+        return protocol.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats == {"received_packets": 5, "dropped_packets": 1, "invalid_packets": 2, "accepted_rows": 3}
+    assert [entry.sensor_id for entry in recorded] == [1, 2, 4]
+    with Session(engine) as session:
+        assert session.exec(text('SELECT COUNT(*) FROM humidity_temperature_entry')).one()[0] == 3